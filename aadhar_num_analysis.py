@@ -40,7 +40,8 @@ specific_folder = 'person_phone_aadhar-bihar'
 gen_func.start_logging(output_dir)
 
 # identify all the states files to go through
-folder_list = os.listdir(target_dir)
+catalog = gen_func.dataset_catalog(target_dir, case_data_regex)
+folder_list = catalog.index.tolist()
 if use_specific_folder:
     folder_list = specific_folder
 case_date_cols = ['opened_date', 'dob']
@@ -56,7 +57,7 @@ for folder in folder_list:
     bad_df = bad_df.fillna('')
 
     if os.path.isdir(os.path.join(target_dir, folder)):
-        location_name = gen_func.folder_name_to_location(folder)
+        location_name = catalog.loc[folder, 'location']
         logging.info('-------------------------------------------')
         logging.info('Going through data for: %s' % location_name)
         logging.info('-------------------------------------------')
@@ -49,7 +49,7 @@ for folder in gmp_folders:
     gmp_input = gf.csv_files_to_df(os.path.join(gmp_dir, folder), data_regex, date_cols = gmp_date_cols)
     
     # drop data that is out of data range of interest
-    gmp_input['received_on'] = pd.to_datetime(gmp_input['received_on'])
+    gmp_input['received_on'] = gf.to_datetime_fast(gmp_input['received_on'], errors='raise')
     logging.info('Trimming data to before %s' % (end_date))
     gmp_start_size = gmp_input.shape[0]
     #trimmed_gmp_input = gmp_input[(gmp_input['received_on'] >= start_date) & (gmp_input['received_on'] <= end_date)]
@@ -60,9 +60,7 @@ for folder in gmp_folders:
 
 # Limit to real locations
 logging.info('raw gmp forms: %i' % gmp_df.shape[0])
-gmp_df = gf.add_locations_by_username(gmp_df)
-logging.info('raw gmp forms after add locations: %i' % gmp_df.shape[0])
-gmp_df = gmp_df.loc[(gmp_df['state_name'].isin(real_state_list))]
+gmp_df = gf.add_locations_by_username(gmp_df, state_list=real_state_list)
 logging.info('Num GMP forms in real locations: %i' % gmp_df.shape[0])
 logging.info('------------------------------------------')
 
@@ -81,7 +79,7 @@ logging.info('Going through data for: %s' % agmp_dir)
 agmp_input = gf.csv_files_to_df(agmp_dir, data_regex, date_cols = gmp_date_cols)
 
 # drop data that is out of data range of interest
-agmp_input['received_on'] = pd.to_datetime(agmp_input['received_on'])
+agmp_input['received_on'] = gf.to_datetime_fast(agmp_input['received_on'], errors='raise')
 start_size = agmp_input.shape[0]
 logging.info('Trimming data to before %s' % (end_date))
 #agmp_df = agmp_input[(agmp_input['received_on'] >= start_date) & (agmp_input['received_on'] <= end_date)]
@@ -90,9 +88,7 @@ logging.info('Trimmed by %i' % (start_size - agmp_df.shape[0]))
 
 # Limit to real locations
 logging.info('raw agmp forms: %i' % agmp_df.shape[0])
-agmp_df = gf.add_locations_by_username(agmp_df)
-logging.info('raw agmp forms after add locations: %i' % agmp_df.shape[0])
-agmp_df = agmp_df.loc[(agmp_df['state_name'].isin(real_state_list))]
+agmp_df = gf.add_locations_by_username(agmp_df, state_list=real_state_list)
 logging.info('Num AGMP forms in real locations: %i' % agmp_df.shape[0])
 
 # Look at this number in comparison to the numbers above - gives a _rough_ idea of non-linked AGMP submissions
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the generic helpers in gen_func
+
+Builds synthetic data shaped like the ICDS exports and times the helpers
+against the implementations they replaced.  Pick the benchmarks to run and
+their sizes in the 'user edit' section.
+"""
+import logging
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+from io import BytesIO
+import numpy as np
+import pandas as pd
+import requests
+from requests.auth import HTTPBasicAuth
+import gen_func as gf
+from mock_ucr_server import MockUCRServer
+from settings import OUTPUT_DIR
+
+
+def synthetic_case_df(num_rows, num_owners=20000, seed=0):
+    '''
+    Dataframe shaped like a person case export, with columns read the way
+    read_csv would (strings as objects, 64 bit numbers)
+
+    Parameters
+    ----------
+    num_rows : integer
+      Number of rows
+    num_owners : integer
+      Number of distinct owner_id values (optional, defaults to 20000)
+    seed : integer
+      Seed for the random values (optional, defaults to 0)
+
+    Returns
+    -------
+    df : pandas dataframe
+    '''
+    rng = np.random.RandomState(seed)
+    owners = np.array(['%032x' % rng.randint(0, 2 ** 62) for i in range(num_owners)],
+                      dtype=object)
+    dob = pd.date_range('1950-01-01', '2018-06-01').strftime('%Y-%m-%d')
+    dob = np.asarray(dob, dtype=object)
+    return pd.DataFrame({
+        'caseid': np.array(['case%09i' % i for i in range(num_rows)], dtype=object),
+        'owner_id': owners[rng.randint(0, num_owners, num_rows)],
+        'closed': rng.rand(num_rows) < 0.2,
+        'sex': np.array(['F', 'M'], dtype=object)[rng.randint(0, 2, num_rows)],
+        'hh_caste': np.array(['sc', 'st', 'obc', 'other', '---'],
+                             dtype=object)[rng.randint(0, 5, num_rows)],
+        'dob': dob[rng.randint(0, len(dob), num_rows)],
+        'num_visits': rng.randint(0, 50, num_rows).astype(np.int64),
+        'weight': rng.rand(num_rows) * 100})
+
+
+def _timed(func, *args, **kwargs):
+    '''Run func, return its output and the seconds it took'''
+    start = time.time()
+    output = func(*args, **kwargs)
+    return output, time.time() - start
+
+
+# implementation of gen_func.obj_to_cat/optimize_df_memory before the single
+# pass rewrite, kept here to compare against
+def _old_obj_to_cat(df):
+    df_obj = df.select_dtypes(include=['object'])
+    converted_obj = pd.DataFrame()
+    for col in df_obj.columns:
+        num_unique_values = len(df_obj[col].unique())
+        num_total_values = len(df_obj[col])
+        if num_unique_values / num_total_values < 0.5:
+            converted_obj.loc[:, col] = df_obj[col].astype('category')
+        else:
+            converted_obj.loc[:, col] = df_obj[col]
+    df[converted_obj.columns] = converted_obj
+    return df
+
+
+def _old_optimize_df_memory(df):
+    initial_mem = gf.mem_usage(df)
+    types = df.dtypes.unique()
+    if object in types:
+        df = _old_obj_to_cat(df)
+    if float in types:
+        df_float = df.select_dtypes(include=['float'])
+        conv_float = df_float.apply(pd.to_numeric, downcast='float')
+        df[conv_float.columns] = conv_float
+    if int in types:
+        df_int = df.select_dtypes(include=['int'])
+        conv_int = df_int.apply(pd.to_numeric, downcast='integer')
+        df[conv_int.columns] = conv_int
+    end_mem = gf.mem_usage(df)
+    logging.info('Dataframe memory optimized from %s to %s' % (initial_mem, end_mem))
+    return df
+
+
+def bench_optimize(num_rows):
+    '''Time optimize_df_memory against the old implementation'''
+    logging.info('Building synthetic case frame of %i rows' % num_rows)
+    case_df = synthetic_case_df(num_rows)
+    old_df, old_secs = _timed(_old_optimize_df_memory, case_df.copy())
+    new_df, new_secs = _timed(gf.optimize_df_memory, case_df.copy())
+    (_, report), report_secs = _timed(gf.optimize_df_memory, case_df.copy(),
+                                      deep=True, report_out=True)
+    assert (old_df.dtypes == new_df.dtypes).all()
+    for col in new_df.columns:
+        assert old_df[col].astype(object).equals(new_df[col].astype(object))
+    logging.info(report)
+    logging.info('optimize_df_memory on %i rows: old %0.2fs, new %0.2fs '
+                 '(%0.1fx), new with deep report %0.2fs'
+                 % (num_rows, old_secs, new_secs, old_secs / new_secs,
+                    report_secs))
+    return old_secs, new_secs
+
+
+# implementation of gen_func.add_locations_by_username before the site code
+# lookup, kept here to compare against
+def _old_add_locations_by_username(df, location_column_names=['awc_site_code',
+                  'awc_name', 'block_name', 'district_name', 'state_name']):
+    known_dtype = {'awc_name':'object', 'block_name':'category',
+                   'district_name':'category', 'state_name':'category'}
+    location_df = pd.read_csv(gf.location_file_dir,
+                              usecols=location_column_names,
+                              dtype=known_dtype)
+    location_df = gf.optimize_df_memory(location_df)
+    location_df['awc_site_code'] = location_df['awc_site_code'].astype(str)
+    df['username'] = df['username'].astype(str)
+    df['username_fmt'] = df['username'].apply(lambda x: x[1:] if x[0] == '0' else x)
+    return pd.merge(df, location_df, left_on='username_fmt',
+                    right_on='awc_site_code', how='left')
+
+
+def synthetic_form_df(num_rows, seed=0):
+    '''
+    Dataframe shaped like a form export, with usernames taken from the site
+    codes in the location fixture (half with a leading zero) and about 1% of
+    forms from users that aren't in the fixture
+
+    Parameters
+    ----------
+    num_rows : integer
+      Number of rows
+    seed : integer
+      Seed for the random values (optional, defaults to 0)
+
+    Returns
+    -------
+    df : pandas dataframe
+    '''
+    rng = np.random.RandomState(seed)
+    site_codes = gf.location_index()['locations']['awc_site_code'].dropna()
+    users = np.array(['%i' % code for code in site_codes.unique()], dtype=object)
+    users[::2] = '0' + users[::2]
+    users = np.concatenate([users, np.array(['test%i' % i for i in
+                                             range(len(users) // 100 + 1)],
+                                            dtype=object)])
+    return pd.DataFrame({
+        'formid': np.array(['form%09i' % i for i in range(num_rows)], dtype=object),
+        'username': users[rng.randint(0, len(users), num_rows)],
+        'form_duration': rng.rand(num_rows) * 600})
+
+
+def bench_username(num_rows):
+    '''Time add_locations_by_username against the old implementation'''
+    logging.info('Building synthetic form frame of %i rows' % num_rows)
+    form_df = synthetic_form_df(num_rows)
+    old_df, old_secs = _timed(_old_add_locations_by_username, form_df.copy())
+    gf.location_index()
+    (new_df, unmatched), new_secs = _timed(gf.add_locations_by_username,
+                                           form_df.copy(), report_out=True)
+    for col in ['awc_name', 'block_name', 'district_name', 'state_name']:
+        assert old_df[col].astype(object).equals(new_df[col].astype(object))
+    logging.info('%i unmatched usernames' % len(unmatched))
+    logging.info('add_locations_by_username on %i rows: old %0.2fs, new '
+                 '%0.2fs (%0.1fx)' % (num_rows, old_secs, new_secs,
+                                      old_secs / new_secs))
+    return old_secs, new_secs
+
+
+# implementation of gen_func.download_ucr before streaming and the shared
+# session, kept here to compare against
+def _old_download_ucr(url, user, password, new_file_name, target_dir):
+    r = requests.get(url, auth=HTTPBasicAuth(user, password))
+    r.raise_for_status()
+    z = zipfile.ZipFile(BytesIO(r.content))
+    cur_file_name = z.extract(z.namelist()[0], target_dir)
+    shutil.move(cur_file_name, os.path.join(target_dir, new_file_name))
+    z.close()
+    return len(r.content)
+
+
+def _form_download_jobs(base_url, num_files, target_dir):
+    '''usage_forms download jobs for num_files days, as download_form_ucr makes'''
+    jobs = []
+    for day in pd.date_range('2017-03-20', periods=num_files, freq='D'):
+        jobs.append((base_url + 'static-icds-cas-static-usage_forms/?format=csv'
+                     '&form_date=' + day.strftime('%Y-%m-%d'),
+                     'icds.' + day.strftime('%m.%d.%Y') + '.csv', target_dir))
+    return jobs
+
+
+def _log_download(label, num_files, secs, server):
+    '''Log throughput and concurrency of one download run'''
+    logging.info('%s: %i files in %0.2fs, %0.2f files/s, %0.2f MB/s, %i '
+                 'requests, most at once %i, %i failed, %i throttled'
+                 % (label, num_files, secs, num_files / secs,
+                    server.stats['bytes'] / secs / 1024 ** 2,
+                    server.stats['requests'], server.stats['max_active'],
+                    server.stats['failed'], server.stats['throttled']))
+
+
+def bench_download(num_rows):
+    '''
+    Time downloading usage_forms days from a local MockUCRServer, one at a
+    time the old way and with download_ucr_files at each worker count, then
+    once more with failures and throttling injected.  num_rows is split over
+    download_files days.
+    '''
+    server = MockUCRServer(rows_per_file=max(1, num_rows // download_files))
+    base_url = server.start()
+    target_dir = tempfile.mkdtemp(prefix='bench_download')
+    try:
+        jobs = _form_download_jobs(base_url, download_files, target_dir)
+        # build the exports first so making the data isn't timed
+        logging.info('Building %i exports of %i rows' %
+                     (download_files, server.rows_per_file))
+        for url, new_file_name, job_dir in jobs:
+            requests.get(url).raise_for_status()
+        server.latency = download_latency
+        logging.info('Server latency %0.2fs, http host limit %i' %
+                     (download_latency, gf.http_host_limit))
+
+        server.reset_stats()
+        start = time.time()
+        for url, new_file_name, job_dir in jobs:
+            _old_download_ucr(url, 'user', 'pass', new_file_name, job_dir)
+        _log_download('old download_ucr one at a time', len(jobs),
+                      time.time() - start, server)
+
+        times = {}
+        for num_workers in download_worker_counts:
+            for url, new_file_name, job_dir in jobs:
+                os.remove(os.path.join(job_dir, new_file_name))
+            server.reset_stats()
+            gf.http_metrics(reset=True)
+            failed, times[num_workers] = _timed(gf.download_ucr_files, jobs,
+                                                'user', 'pass', num_workers)
+            assert not failed
+            _log_download('download_ucr_files, %i workers' % num_workers,
+                          len(jobs), times[num_workers], server)
+            logging.info('mean time to first byte %0.3fs, mean wait for a '
+                         'host slot %0.3fs' %
+                         (gf.http_metrics()['first_byte_secs'].mean(),
+                          gf.http_metrics()['wait_secs'].mean()))
+
+        for url, new_file_name, job_dir in jobs:
+            os.remove(os.path.join(job_dir, new_file_name))
+        server.fail_rate = download_fail_rate
+        server.max_concurrent = max(1, gf.http_host_limit // 2)
+        server.reset_stats()
+        num_workers = max(download_worker_counts)
+        failed, secs = _timed(gf.download_ucr_files, jobs, 'user', 'pass',
+                              num_workers, retries=10, backoff=0.1)
+        _log_download('download_ucr_files, %i workers, %i%% failures, server '
+                      'limit %i' % (num_workers, download_fail_rate * 100,
+                                    server.max_concurrent),
+                      len(jobs) - len(failed), secs, server)
+        return times
+    finally:
+        server.stop()
+        shutil.rmtree(target_dir, ignore_errors=True)
+
+
+# ----------------  USER EDITS -------------------------------
+benchmarks_to_run = ['optimize', 'username', 'download']
+num_rows = 5000000
+# download benchmark: days of forms, seconds the server takes to answer,
+# worker counts to time and fraction of failed requests in the last run
+download_files = 30
+download_latency = 0.2
+download_worker_counts = [1, 4, 8]
+download_fail_rate = 0.1
+# ------------- don't edit below here -----------------------------
+
+benchmarks = {'optimize': bench_optimize, 'username': bench_username,
+              'download': bench_download}
+
+if __name__ == '__main__':
+    gf.start_logging(OUTPUT_DIR)
+    for name in benchmarks_to_run:
+        logging.info('-------- benchmark: %s --------' % name)
+        benchmarks[name](num_rows)
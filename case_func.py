@@ -45,7 +45,8 @@ def clean_case_data(df, output_dict, awc_test=True):
 
     # get rid of any closed cases by looking for 'closed'==True
     if 'closed' in df.columns.tolist():
-        num_closed = df.groupby('closed').size()[True]
+        # 0 if closed cases were already filtered out while loading
+        num_closed = (df['closed'] == True).sum()
         logging.info('%i closed removed' % num_closed)
         df = df[df['closed'] != True]
     else:
@@ -346,11 +347,11 @@ def add_age_info(df, col_name='age_bracket', bin_type='brackets', relative_date=
     '''
     if 'dob' in df.columns.tolist():
         if relative_date == 'today':
-            df['age_days'] = (datetime.date.today() - pd.to_datetime(
-                    df['dob'], errors='coerce')) / np.timedelta64(1, 'D')
+            df['age_days'] = (datetime.date.today() - gen_func.to_datetime_fast(
+                    df['dob'])) / np.timedelta64(1, 'D')
         else:
-            df['age_days'] = (df[relative_date] - pd.to_datetime(
-                    df['dob'], errors='coerce')) / np.timedelta64(1, 'D')
+            df['age_days'] = (df[relative_date] - gen_func.to_datetime_fast(
+                    df['dob'])) / np.timedelta64(1, 'D')
         if bin_type == 'yearly':
             bins = [-100*365.25, 0*365.25, 1*356.25, 2*365.25, 3*365.25, 4*365.25, 5*365.25,
                     6*365.25, 7*356.25, 8*365.25, 9*365.25, 10*365.25,
@@ -381,11 +382,11 @@ def check_beneficiary(df, relative_date='today'):
     # get age
     if 'dob' in df.columns.tolist():
         if relative_date == 'today':
-            df['age_days'] = (datetime.date.today() - pd.to_datetime(
-                    df['dob'], errors='coerce')) / np.timedelta64(1, 'D')
+            df['age_days'] = (datetime.date.today() - gen_func.to_datetime_fast(
+                    df['dob'])) / np.timedelta64(1, 'D')
         else:
-            df['age_days'] = (df[relative_date] - pd.to_datetime(
-                    df['dob'], errors='coerce')) / np.timedelta64(1, 'D')
+            df['age_days'] = (df[relative_date] - gen_func.to_datetime_fast(
+                    df['dob'])) / np.timedelta64(1, 'D')
         df['child_ben'] = (df['age_days'] >= 0) & (df['age_days'] <= 365.25*5)
     else:
         logging.info('ERROR - could not find dob in columns and unable to \
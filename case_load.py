@@ -16,6 +16,11 @@ import seaborn as sns
 from scipy import stats
 from datetime import date
 
+
+def closed_and_owner_counts(df):
+    '''value counts of closed and owner_id for one chunk of case data'''
+    return df['closed'].value_counts(), df['owner_id'].value_counts()
+
 # define directories
 # data_dir = r'C:\Users\theism\Documents\Dimagi\Data\testing'
 data_dir = r'C:\Users\theism\Documents\Dimagi\Data\case_types'
@@ -64,27 +69,21 @@ for case_type in case_types:
     logging.info('Going through data for: %s' % case_type)
     logging.info('-------------------------------------------')
 
-    # get case dataset
-    input_df = pd.DataFrame()
-    input_df = case_df.fillna('')
-    input_df = gf.csv_files_to_df(os.path.join(data_dir, case_type),
-                                  case_data_regex, date_cols, cols_to_use)
-    
-    # input_df[case_type + '_open'] = input_df['closed'] == False
-    # input_df[case_type + '_closed'] = input_df['closed'] != False
-    
+    # get counts of cases by owner, reading case dataset a chunk at a time
     # get all cases, open or closed.  closed matter for load testing since only
     # removed from phone if parent case closed
-    input_df[case_type] = 1
+    open_closed, owner_counts = gf.map_reduce_csv_files(
+            os.path.join(data_dir, case_type), case_data_regex,
+            closed_and_owner_counts, date_cols=date_cols,
+            cols_to_use=cols_to_use)
     
     # show some open/closed info
-    open_closed = input_df['closed'].value_counts()
     logging.info(open_closed)
     logging.info('Pct of %s open: %0.1f' % (case_type, (open_closed[False]*100./open_closed.sum())))
     closed_df.loc[:, case_type] = open_closed
     
-    # groupby owner to collapse to series of awc_id and count 
-    input_nums = input_df.drop('closed', axis=1).groupby(['owner_id']).sum()
+    # collapse to series of awc_id and count 
+    input_nums = owner_counts.to_frame(case_type)
     
     # add current cycle to the output
     case_df = pd.concat([case_df, input_nums], axis=1)
@@ -96,33 +95,31 @@ if add_person_cases:
     person_case_df = pd.DataFrame()
     person_case_df = person_case_df.fillna('')
     person_target_dir = (r'C:\Users\theism\Documents\Dimagi\Data\Person_Case')
-    folder_list = os.listdir(person_target_dir)
     person_case_data_regex = re.compile(r'cases_\d\d\d.csv')
+    person_catalog = gf.dataset_catalog(person_target_dir,
+                                        person_case_data_regex)
+    folder_list = person_catalog.index.tolist()
     
     for folder in folder_list:
         if os.path.isdir(os.path.join(person_target_dir, folder)):
-            location_name = gf.folder_name_to_location(folder)
+            location_name = person_catalog.loc[folder, 'location']
             logging.info('-------------------------------------------')
             logging.info('Going through person cases for: %s' % location_name)
             logging.info('-------------------------------------------')
     
-            # combine all csv into one dataframe
-            person_input_df = gf.csv_files_to_df(os.path.join(person_target_dir, folder),
-                                                 person_case_data_regex,
-                                                 date_cols, cols_to_use)
-    
-            # only keep open cases
-            # open_person_input_df = person_input_df[person_input_df['closed'] == False]
-            person_input_df['person'] = 1
+            # count cases by owner, reading all csv a chunk at a time
+            open_closed, owner_counts = gf.map_reduce_csv_files(
+                    os.path.join(person_target_dir, folder),
+                    person_case_data_regex, closed_and_owner_counts,
+                    date_cols=date_cols, cols_to_use=cols_to_use)
         
             # show some open/closed info
-            open_closed = person_input_df['closed'].value_counts()
             logging.info(open_closed)
             logging.info('Pct of %s open: %0.1f' % (case_type, (open_closed[False]*100./open_closed.sum())))
             closed_df.loc[:, case_type + '-' + location_name] = open_closed
             
-            # groupby owner to collapse to series of awc_id and count 
-            person_input_df = person_input_df.drop('closed', axis=1).groupby(['owner_id']).sum()
+            # collapse to series of awc_id and count 
+            person_input_df = owner_counts.to_frame('person')
         
             # add current cycle to the output
             person_case_df = person_case_df.append(person_input_df)
@@ -138,8 +135,8 @@ case_df = case_df.fillna(0)
 # get latest location fixture and add location data
 if refresh_locations:
     gf.refresh_locations()
-case_df = gf.add_locations(case_df, None, location_columns)
-case_df = case_df.loc[(case_df['state_name'].isin(real_state_list))]
+case_df = gf.add_locations(case_df, None, location_columns,
+                           state_list=real_state_list)
 
 # get overall stats for case loads
 overall_stats = case_df.describe()
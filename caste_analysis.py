@@ -8,9 +8,17 @@ Created on Mon Jan 22 16:02:33 2018
 import os
 import gen_func as gf
 import pandas as pd
+import numpy as np
 import re
 import logging
 
+
+def counts_by_owner(df, count_cols):
+    '''for one chunk of case data, number of cases by owner and value of
+    each column in count_cols'''
+    return tuple(df.groupby(['owner_id', col], observed=True).size()
+                 for col in count_cols)
+
 # define directories
 data_dir = r'C:\Users\theism\Documents\Dimagi\Data\case_types\household'
 output_dir = r'C:\Users\theism\Documents\Dimagi\Results\Caste\Test'
@@ -23,7 +31,6 @@ case_data_regex = re.compile(r'Cases_\d\d\d.csv')
 date_cols = []
 cols_to_use = ['owner_id', 'closed','hh_bpl_apl','hh_caste','hh_minority','hh_religion']
 data_cols = ['hh_bpl_apl','hh_caste','hh_minority','hh_religion']
-location_columns = ['doc_id', 'block_name', 'district_name', 'state_name']
 real_state_list = ['Madhya Pradesh', 'Chhattisgarh', 'Andhra Pradesh', 'Bihar',
                    'Jharkhand', 'Rajasthan']
 # , 'Uttar Pradesh', 'Maharashtra']
@@ -31,42 +38,42 @@ real_state_list = ['Madhya Pradesh', 'Chhattisgarh', 'Andhra Pradesh', 'Bihar',
 # start logging
 gf.start_logging(output_dir)
 
-# initialize dfs
-input_df = pd.DataFrame()
-input_df = input_df.fillna('')
-input_df = gf.csv_files_to_df(data_dir, case_data_regex, date_cols, cols_to_use)
-    
-# only keep open cases
-case_df = input_df[input_df['closed'] == False]
+# count open cases by owner for each data column, a chunk at a time, so
+# only the counts are ever held in memory
+owner_counts = gf.map_reduce_csv_files(data_dir, case_data_regex,
+                                       lambda df: counts_by_owner(df, data_cols),
+                                       date_cols=date_cols,
+                                       cols_to_use=cols_to_use,
+                                       row_filter=[('closed', '==', False)])
 
-# get latest location fixture and add location data
+# get latest location fixture
 if refresh_locations:
     gf.refresh_locations()
-case_df = gf.add_locations(case_df, 'owner_id', location_columns)
-case_df = case_df.loc[(case_df['state_name'].isin(real_state_list))]
 
 # get caste percentages to df for output
-drop_cols = cols_to_use
-drop_cols.append('state_name')
-drop_cols.append('district_name')
-blocks = case_df['block_name'].unique().tolist()
 new_loc_cols = ['block_name', 'district_name', 'state_name']
-denom = case_df['hh_caste'].count()
 
-for item in data_cols:
+for item, item_counts in zip(data_cols, owner_counts):
     logging.info('Going through %s' % item)
-    loc_df = case_df.drop(drop_cols, axis=1).drop_duplicates('block_name').set_index('block_name')
-    category = case_df[item].value_counts().index.tolist()
-    for cat in category:
-        loc_df[cat] = 0
-    for block in blocks:
-        loc_df.loc[block] = case_df[case_df['block_name'] == block][item].value_counts()
-    loc_df = loc_df.fillna(0)
+    # roll the counts by owner of each value up to blocks in one pass
+    count_df = item_counts.rename('count').reset_index()
+    count_df = gf.filter_real_states(count_df, 'owner_id',
+                                     state_list=real_state_list)
+    category = count_df.groupby(item)['count'].sum().sort_values(ascending=False).index.tolist()
+    values = pd.get_dummies(count_df[item]).mul(count_df['count'], axis=0)
+    rollup = gf.location_rollup(gf.location_rows(count_df['owner_id']),
+                                values, levels=['block']).loc['block']
+    rollup = rollup.set_index(np.asarray(rollup['block_name'], dtype=object)).sort_index()
+    loc_df = rollup[[str(cat) + '_sum' for cat in values.columns]]
+    loc_df.columns = values.columns
+    loc_df = loc_df[category]
+    loc_df.columns.name = None
     loc_df['Total'] = loc_df.sum(axis=1)
     loc_df.loc['All Blocks'] = loc_df.sum()
     for cat in category:
         loc_df[cat + '%'] = loc_df[cat] / loc_df['Total']
-    loc_df = gf.add_locations(loc_df, None, new_loc_cols)
+    loc_df = pd.concat([rollup[new_loc_cols[1:]].reindex(loc_df.index), loc_df],
+                       axis=1)
+    loc_df.index.name = 'block_name'
     loc_df.to_csv(os.path.join(output_dir,item + '.csv'))
     logging.info(loc_df.loc['All Blocks'])
-    
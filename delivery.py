@@ -8,6 +8,7 @@ Created on Fri May 25 07:49:23 2018
 import re
 import os
 import pandas as pd
+import numpy as np
 import gen_func as gf
 import logging
 
@@ -41,19 +42,23 @@ os.chdir(output_dir)
 # combine forms into single dataset
 input_df = gf.forms_to_df(data_dir, data_regex, date_cols=date_fmt_cols, cols_to_use=indicator_list)
 logging.info('raw forms: %i' % input_df.shape[0])
-input_df = gf.add_locations_by_username(input_df)
-logging.info('raw forms after add locations: %i' % input_df.shape[0])
-
-# filter out forms from states dont want in analysis
-del_df = input_df.loc[(input_df['state_name'].isin(real_state_list))]
+# find the location of each form's user, only keeping forms from states we
+# want in analysis.  No location columns are added, the forms are rolled up
+# by location row below
+rows = gf.username_location_rows(input_df['username'], real_state_list)
+in_states = rows >= 0
+del_df = input_df[in_states]
+del_rows = rows[in_states]
 num_forms = del_df.shape[0]
+num_users = len(pd.unique(del_rows))
 logging.info('Num forms in real locations: %i' % num_forms)
-logging.info('%i different users submitted this form' % del_df['awc_name'].nunique())
-logging.info('%.2f average forms per user' % del_df['awc_name'].value_counts().mean())
+logging.info('%i different users submitted this form' % num_users)
+logging.info('%.2f average forms per user' % (num_forms / float(num_users)))
 
 logging.info(del_df['form.has_delivered'].value_counts(dropna=False))
 # Just to be explicit with Pandas
-have_del_df = del_df[del_df['form.has_delivered'] == 'yes'].copy(False)
+have_del = (del_df['form.has_delivered'] == 'yes').values
+have_del_df = del_df[have_del].copy(False)
 logging.info(have_del_df['form.where_born'].value_counts(dropna=False))
 logging.info(have_del_df['form.delivery_nature'].value_counts(dropna=False))
 have_del_df['home_delivery'] = (have_del_df['form.where_born'] == 'home')
@@ -62,32 +67,25 @@ have_del_df['hospital_delivery'] = (have_del_df['form.where_born'] == 'hospital'
 have_del_df['caesarean_delivery'] = (have_del_df['form.delivery_nature'] == 'caesarean')
 have_del_df['delivery'] = (have_del_df['form.has_delivered'] == 'yes')
 
-def _process_metric(df, col, locations, totalname=''):
-    total_col = 'total %s in block' % (totalname)
-    sum_col = 'number %s in block' % (col)
-    count = 0
-    for location in locations:
-        pct_col = '%s %s pct' % (col, location[:-5])
-        loc = locations[count:]
-        new_agg = (df.groupby(loc)[sum_col].sum() / df.groupby(loc)[total_col].sum()).reset_index()
-        new_agg.columns = loc + [pct_col]
-        df = pd.merge(df.reset_index(), new_agg, how='left', on=loc).set_index(locations)
-        count = count + 1
-
-    return df
-
-have_del_block_df = pd.DataFrame()
-
-# aggregate each field by block
+# roll each field up the location hierarchy in one pass, with the pct of
+# deliveries at each level
+rollup = gf.location_rollup(del_rows[have_del], have_del_df[fields + ['delivery']],
+                            ratios=dict((f, (f, 'delivery')) for f in fields),
+                            levels=[loc[:-5] for loc in locations])
+block_rollup = rollup.loc[locations[0][:-5]]
+have_del_block_df = pd.DataFrame(index=pd.MultiIndex.from_arrays(
+        [np.asarray(block_rollup[loc], dtype=object) for loc in locations],
+        names=locations))
 for f in fields:
-    new_col = 'number %s in block' % (f)
-    have_del_block_df[new_col] = have_del_df.groupby(locations)[f].sum()
-
-have_del_block_df['total delivery in block'] = have_del_df.groupby(locations)['delivery'].sum()
+    have_del_block_df['number %s in block' % (f)] = block_rollup['%s_sum' % (f)].values
+have_del_block_df['total delivery in block'] = block_rollup['delivery_sum'].values
 
-# for each field, calculate the pct for each location aggregator
+# for each field, get the pct for each location aggregator
 for f in fields:
-    have_del_block_df = _process_metric(have_del_block_df, f, locations, totalname='delivery')
+    for loc in locations:
+        level_ids = np.asarray(block_rollup['%s_id' % (loc[:-5])], dtype=object)
+        pct_col = '%s %s pct' % (f, loc[:-5])
+        have_del_block_df[pct_col] = rollup.loc[loc[:-5]][f].reindex(level_ids).values
 
 for f in fields:
     for loc in locations[1:]:
@@ -95,6 +93,7 @@ for f in fields:
         start_col = '%s %s pct' % (f, locations[0][:-5])
         end_col = '%s %s pct' % (f, loc[:-5])
         have_del_block_df[new_col] = have_del_block_df[start_col] - have_del_block_df[end_col]
+have_del_block_df = have_del_block_df.sort_index()
 
 
 def _col_names_by_metric(col, locations, totalname):
@@ -39,11 +39,9 @@ os.chdir(output_dir)
 # combine forms into single dataset
 input_df = gf.forms_to_df(data_dir, data_regex, date_cols=date_fmt_cols, cols_to_use=indicator_list)
 logging.info('raw forms: %i' % input_df.shape[0])
-input_df = gf.add_locations_by_username(input_df)
-logging.info('raw forms after add locations: %i' % input_df.shape[0])
 
 # filter out forms from states dont want in analysis
-del_df = input_df.loc[(input_df['state_name'].isin(real_state_list))]
+del_df = gf.add_locations_by_username(input_df, state_list=real_state_list)
 num_forms = del_df.shape[0]
 # logging.info('Num forms in real locations: %i' % num_forms)
 # logging.info('%i different users submitted this form' % del_df['awc_name'].nunique())
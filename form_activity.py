@@ -110,7 +110,8 @@ else:
 # need to download new files if set to True
 if download_new is True:
     file_list = ff.download_form_ucr(download_start, download_stop, gf.credential_path,
-                                     target_dir, refresh_recent, refresh_days, data_regex)
+                                     target_dir, refresh_recent, refresh_days, data_regex,
+                                     ingest=True)
 else:
     file_list = ff.file_subset_by_date(start_date, end_date, target_dir, data_regex)
 
@@ -132,9 +133,7 @@ for data_file in file_list:
         logging.debug(time.strftime('%X %x'))
 
         # get data
-        input_df = pd.read_csv(os.path.join(target_dir, data_file),
-                               usecols=col_names, parse_dates=['form_date'],
-                               infer_datetime_format=True)
+        input_df = ff.read_form_file(target_dir, data_file, col_names)
 
         # add column for totals, name of column is date
         submission_date = input_df.loc[0]['form_date'].strftime('%Y-%m-%d')
@@ -167,17 +166,20 @@ forms_df = forms_df.assign(start_date=forms_df.astype(int).astype(bool).idxmax(1
                            last_submission=forms_df.astype(int).astype(bool)[forms_df.columns[::-1]].idxmax(1))
 forms_df['active_date'] = forms_df['start_date'].apply(lambda x: str((pd.to_datetime(x) + np.timedelta64(startup_period, 'D')).date()))
 
-# add locations to data and set indices
+# add locations to data and set indices.  uses the locations as they were on
+# the last day of data, so rerunning an old period gets the hierarchy of then
+last_date = pd.to_datetime(date_cols[-1])
 forms_df.index.rename('awc_id', True)
 location_columns = ['doc_id', 'block_name', 'district_name', 'state_name']
 locations = location_columns[1:]
-forms_df = gf.add_locations(forms_df, None, location_columns, True)
+gf.refresh_locations(once=True)
+forms_df['location_date'] = last_date
 # get rid of not real states
-forms_df = forms_df.loc[(forms_df['state_name'].isin(real_state_list))]
+forms_df = gf.add_locations_as_of(forms_df, None, 'location_date',
+                                  location_columns, state_list=real_state_list)
 
 #-----------------  daily form submissions ----------------------------
 # days_inactive: today minus last_submission date
-last_date = pd.to_datetime(date_cols[-1])
 forms_df = forms_df.assign(days_inactive= lambda x: ((last_date - pd.to_datetime(x.last_submission)) / np.timedelta64(1, 'D')))
 forms_df = forms_df.assign(days_since_start= lambda x: ((last_date - pd.to_datetime(x.start_date)) / np.timedelta64(1, 'D')) + 1)
 forms_df = forms_df.assign(days_since_active= lambda x: ((last_date - pd.to_datetime(x.active_date)) / np.timedelta64(1, 'D')) + 1)
@@ -203,11 +205,21 @@ tallies_output = os.path.join(output_dir, 'tallies_' + last_date.strftime('%Y-%m
 tallies_df.to_csv(tallies_output, date_format='%m-%d-%Y')
 logging.info('output file saved to %s' % tallies_output)
 
+# earliest active date in each block, district and state, in one pass
+epoch = pd.Timestamp('1970-01-01')
+active_days = (pd.to_datetime(forms_df['active_date']) - epoch) / np.timedelta64(1, 'D')
+active_rollup = gf.location_rollup(gf.location_rows(forms_df.index, as_of=last_date),
+                                   active_days.to_frame('active_days'), aggs=['min'],
+                                   levels=[loc[:-5] for loc in locations], as_of=last_date)
 os.chdir(output_dir)
 count = 0
 for location in locations:
     loc = locations[count:]
-    new_agg = tallies_df.groupby(loc)['active_date'].min()
+    level_df = active_rollup.loc[loc[0][:-5]]
+    new_agg = pd.Series((epoch + pd.to_timedelta(level_df['active_days_min'].values, 'D')).strftime('%Y-%m-%d'),
+                        index=pd.MultiIndex.from_arrays([np.asarray(level_df[l], dtype=object) for l in loc],
+                                                        names=loc),
+                        name='active_date').sort_index()
     new_agg.to_csv('active_date_by_%s.csv' % (loc[0][:-5]))
     count = count + 1
 
@@ -412,9 +424,9 @@ loc_index = pd.Index(location_df.index)
 aww_form_index = pd.Index(activity_df.index)
 awwdiff = loc_index.difference(aww_form_index).values
 aww_no_forms = pd.DataFrame(awwdiff, columns=['awc_id'])
-aww_no_forms = gf.add_locations(aww_no_forms, 'awc_id', location_columns, False)
+aww_no_forms = gf.add_locations(aww_no_forms, 'awc_id', location_columns, False,
+                               state_list=real_state_list)
 aww_no_forms = aww_no_forms.set_index('awc_id')
-aww_no_forms = aww_no_forms.loc[(aww_no_forms['state_name'].isin(real_state_list))]
 aww_no_forms.to_csv('aww_w_no_forms_' + last_date.strftime('%Y-%m-%d') + '.csv')
 logging.info('Users from these states are registered but have not submitted a form between %s and %s' % (start_date, end_date))
 logging.info(aww_no_forms['state_name'].value_counts())
@@ -13,11 +13,50 @@ import numpy as np
 import matplotlib as mpl
 import calendar
 
+# columns of the usage_forms UCR used by forms_by_type, form_activity and
+# form_lag.  Each file is parsed once into a partition with all of them, see
+# read_form_file
+form_cols = ['form_date', 'form_time', 'received_on', 'awc_id', 'pse', 'gmp',
+             'thr', 'add_household', 'add_person', 'add_pregnancy',
+             'home_visit', 'bp_tri1', 'bp_tri2', 'bp_tri3', 'delivery', 'pnc',
+             'ebf', 'cf', 'due_list_ccs', 'due_list_child']
+form_date_cols = ['form_date', 'form_time', 'received_on']
+
+
+def ingest_form_file(file_path):
+    '''Save a usage_forms file as a columnar partition of form_cols'''
+    gen_func.ingest_csv(file_path, form_cols, form_date_cols)
+
+
+def read_form_file(target_dir, data_file, columns):
+    '''
+    Read columns of a usage_forms file from its columnar partition, which is
+    made the first time a file is read if it wasn't ingested on download.
+
+    Parameters
+    ----------
+    target_dir : string
+      Absolute path to directory with all the data
+    data_file : string
+      Name of the file, ie - icds.03.20.2017.csv
+    columns : list of strings
+      Columns to read, from form_cols
+
+    Returns
+    -------
+    output : pandas dataframe
+    '''
+    return gen_func.read_ingested(os.path.join(target_dir, data_file), columns,
+                                  form_cols, form_date_cols)
+
 
 def download_form_ucr(start_date, end_date, cred_path, target_dir,
-                      refresh_recent, refresh_days, data_regex):
+                      refresh_recent, refresh_days, data_regex,
+                      num_workers=None, ingest=False):
     '''
-    Downloads form submission UCR with option to refresh data directory
+    Downloads form submission UCR with option to refresh data directory.
+    Missing days are downloaded several at a time, and days that are already
+    there are kept, so a backfill that stopped part way resumes where it was.
 
     Parameters
     ----------
@@ -35,6 +74,12 @@ def download_form_ucr(start_date, end_date, cred_path, target_dir,
       Number of days to refresh data
     data_regex : re object
       Regex on the type of file that contains data
+    num_workers : integer
+      Number of days to download at a time (optional, defaults to
+      DOWNLOAD_WORKERS in settings)
+    ingest : boolean
+      Parse each new file into its columnar partition as it arrives, see
+      read_form_file (optional, defaults to False)
 
     Returns
     -------
@@ -47,7 +92,7 @@ def download_form_ucr(start_date, end_date, cred_path, target_dir,
     # download files if see that any are missing
     logging.info('Checking if all files have been downloaded')
     all_dates = pd.date_range(start_date, end_date, freq='D')
-    download_link = 'https://www.icds-cas.gov.in/a/icds-cas/configurable_reports/data_sources/export/static-icds-cas-static-usage_forms/?format=csv&form_date='
+    download_link = gen_func.ucr_base_url + 'static-icds-cas-static-usage_forms/?format=csv&form_date='
     user, password = gen_func.get_credentials(cred_path, 'icds')
 
     # get dates of files that have been downloaded
@@ -62,16 +107,22 @@ def download_form_ucr(start_date, end_date, cred_path, target_dir,
             logging.info('Refreshing data file: %s' % remove_name)
             file_dates.remove(date_to_del)
 
+    jobs = []
     for date_to_check in all_dates:
         if date_to_check in file_dates:
             logging.debug('have data for %s already' % date_to_check)
         else:
-            logging.info('Downloading form data for %s' % date_to_check)
+            logging.info('Missing form data for %s' % date_to_check)
             date_to_get = date_to_check.strftime('%Y-%m-%d')
             full_dwnld_link = download_link + date_to_get
             new_file_name = 'icds.' + date_to_check.strftime('%m.%d.%Y') + '.csv'
-            gen_func.download_ucr(full_dwnld_link, user, password,
-                                  new_file_name, target_dir)
+            jobs.append((full_dwnld_link, new_file_name, target_dir))
+    failed = gen_func.download_ucr_files(
+        jobs, user, password, num_workers,
+        ingest=ingest_form_file if ingest else None)
+    if failed:
+        raise IOError('Could not download %i days of form data: %s.  Run again '
+                      'to download the rest.' % (len(failed), sorted(failed)))
 
     # update file list
     file_list = gen_func.data_file_list(target_dir, data_regex)
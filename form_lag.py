@@ -72,13 +72,11 @@ for data_file in file_list:
     file_date = data_file[5:-4]
     logging.info('Going through data for: %s' % data_file)
     # get data into input file
-    input_df = pd.read_csv(os.path.join(target_dir, data_file), 
-                           usecols=col_names, parse_dates=date_cols,
-                           infer_datetime_format=True)
+    input_df = ff.read_form_file(target_dir, data_file, col_names)
     
     # add locations to data and set indices
-    input_df = gf.add_locations(input_df, 'awc_id', location_columns)
-    input_df = input_df.loc[(input_df['state_name'].isin(real_state_list))]
+    input_df = gf.add_locations(input_df, 'awc_id', location_columns,
+                                state_list=real_state_list)
         
     # add a few columns we care about - convert to days decimal point
     input_df['time_lag'] = input_df['received_on'] - input_df['form_time']
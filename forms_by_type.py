@@ -99,7 +99,8 @@ else:
 # need to download new files if set to True
 if download_new is True:
     file_list = ff.download_form_ucr(download_start, download_stop, credential_path,
-                                     target_dir, refresh_recent, refresh_days, data_regex)
+                                     target_dir, refresh_recent, refresh_days, data_regex,
+                                     ingest=True)
 else:
     file_list = gf.data_file_list(target_dir, data_regex)
 
@@ -126,13 +127,13 @@ for data_file in file_list:
         logging.debug(time.strftime('%X %x'))
 
         # get data
-        input_df = pd.read_csv(os.path.join(target_dir, data_file), 
-                               usecols=col_names, parse_dates=date_cols,
-                                infer_datetime_format=True)
+        input_df = ff.read_form_file(target_dir, data_file, col_names)
         
-        # add locations to data and set indices
-        input_df = gf.add_locations(input_df, 'awc_id', location_columns)
-        input_df = input_df.loc[(input_df['state_name'].isin(real_state_list))]
+        # add locations to data and set indices, each form gets the
+        # location its awc had on the form_date
+        input_df = gf.add_locations_as_of(input_df, 'awc_id', 'form_date',
+                                          location_columns,
+                                          state_list=real_state_list)
         
         # apply state filter if exists
         if filter_by_state:
@@ -8,20 +8,69 @@ these functions support generic manipulation of ICDS files for data analysis
 """
 import os
 import pandas as pd
+import numpy as np
 import logging
 import logging.config
 import datetime
 from requests.auth import HTTPBasicAuth
 import requests, zipfile
+from requests.adapters import HTTPAdapter
 from io import BytesIO
 import shutil
+import filecmp
 from dateutil.parser import parse
 import hashlib
+import json
+import re
+import time
+import tempfile
+import threading
+import multiprocessing
+import multiprocessing.pool
 import settings
 from settings import DATA_DIR, OUTPUT_DIR
 
 location_file_dir = os.path.join(DATA_DIR, 'static-awc_location.csv')
 credential_path = os.path.join(os.path.dirname(DATA_DIR), 'Admin' ,'user_info.csv')
+# states with real (not test) locations
+real_state_list = getattr(settings, 'REAL_STATE_LIST',
+                          ['Madhya Pradesh', 'Chhattisgarh', 'Andhra Pradesh',
+                           'Bihar', 'Jharkhand', 'Rajasthan', 'Uttar Pradesh',
+                           'Maharashtra'])
+# folder inside each data directory that holds cached partitions
+cache_dir_name = getattr(settings, 'CACHE_DIR_NAME', 'cache')
+# number of views (sets of columns, dates, schema and filter) of a directory
+# whose caches are kept, the most recently used first
+cache_keep_views = getattr(settings, 'CACHE_KEEP_VIEWS', 1)
+# csv files larger than this many bytes are read as row ranges from an index
+csv_split_size = getattr(settings, 'CSV_SPLIT_SIZE', 1000000000)
+csv_range_rows = 1000000
+# where UCR data sources are exported from
+ucr_base_url = getattr(settings, 'UCR_BASE_URL', 'https://www.icds-cas.gov.in/a/icds-cas/configurable_reports/data_sources/export/')
+# threads used to download several UCR files at once, and how often to retry
+# a failed download (waiting backoff, 2 * backoff, 4 * backoff... seconds)
+download_workers = getattr(settings, 'DOWNLOAD_WORKERS', 4)
+download_retries = getattr(settings, 'DOWNLOAD_RETRIES', 3)
+download_backoff = getattr(settings, 'DOWNLOAD_BACKOFF', 5)
+# downloads are streamed in chunks of this many bytes, and kept in memory
+# until they get bigger than download_spool_size, then in a temp file
+download_chunk_size = 1024 ** 2
+download_spool_size = 4 * 1024 ** 2
+# connections kept open per host by the shared http sessions, and most
+# requests to one host at a time
+http_pool_size = getattr(settings, 'HTTP_POOL_SIZE', 10)
+http_host_limit = getattr(settings, 'HTTP_HOST_LIMIT', 4)
+# seconds to wait to connect to a host, and for the next bytes of a response
+http_connect_timeout = getattr(settings, 'HTTP_CONNECT_TIMEOUT', 10)
+http_read_timeout = getattr(settings, 'HTTP_READ_TIMEOUT', 300)
+# state names for the suffix of data folder names, ie - xxx-mp
+folder_locations = getattr(settings, 'FOLDER_LOCATIONS',
+                           {'ap': 'Andhra Pradesh', 'bihar': 'Bihar',
+                            'ch': 'Chhattisgarh', 'jh': 'Jharkhand',
+                            'mp': 'Madhya Pradesh', 'raj': 'Rajasthan',
+                            'up': 'Uttar Pradesh', 'mah': 'Maharashtra',
+                            'user': 'User', 'test': 'Test',
+                            'ap2': 'Andhra Pradesh2'})
 
 def data_file_list(directory, regex):
     '''
@@ -52,7 +101,7 @@ def data_file_list(directory, regex):
     os.chdir(orig_dir)
     return output
 
-def _hash_from_filesize_and_cols(directory, regex, cols_to_use):
+def _hash_from_filesize_and_cols(directory, regex, cols_to_use, row_filter=None):
   '''
   Return a hash of the summed filesizes of the files in the directory.
   This is used as a rough metric to see if anything has changed in
@@ -71,6 +120,9 @@ def _hash_from_filesize_and_cols(directory, regex, cols_to_use):
 
   regex : regex object
     Regex used to specify filenames of desired csv files
+
+  row_filter : list of tuples
+    Row filter the data was read with (optional, defaults to None)
   
   Returns
   -------
@@ -87,18 +139,161 @@ def _hash_from_filesize_and_cols(directory, regex, cols_to_use):
     sorted_cols = list(cols_to_use) if cols_to_use else []
     sorted_cols.sort()
     return hashlib.sha1(
-      (str(sum(sizes)) + ''.join(sorted_cols)).encode()).hexdigest()
+      (str(sum(sizes)) + ''.join(sorted_cols) +
+       _row_filter_key(row_filter)).encode()).hexdigest()
   except Exception as err:
     logging.error('An exception happened: ' + str(err))
     os.chdir(orig_dir)
     raise
 
 
-def forms_to_df(directory, regex, date_cols=None, cols_to_use=None):
+def _file_fingerprint(file_path, block_size=1024 ** 2):
+  '''
+  Return a sha1 of the contents of a file, read in blocks so that large
+  exports don't have to fit in memory.
+
+  Parameters
+  ----------
+  file_path : string
+    Full path to file
+
+  block_size : integer
+    Number of bytes to read at a time (optional, defaults to 1 MB)
+
+  Returns
+  -------
+  output : string
+    sha1 hex digest of the file contents
+  '''
+  sha = hashlib.sha1()
+  with open(file_path, 'rb') as f:
+    block = f.read(block_size)
+    while block:
+      sha.update(block)
+      block = f.read(block_size)
+  return sha.hexdigest()
+
+
+def _row_filter_key(row_filter):
+  '''Return a stable text version of a row filter to use in cache keys'''
+  if not row_filter:
+    return ''
+  parts = []
+  for col, op, value in row_filter:
+    if op in ('in', 'not in'):
+      value = sorted(str(v) for v in value)
+    parts.append([col, op, value])
+  return json.dumps(parts, default=str)
+
+
+def _view_key(date_cols, cols_to_use, schema=None, row_filter=None):
+  '''
+  Return a short key for a 'view' of the data (the columns and date columns
+  that were requested, the dtype schema used to read them and any row
+  filter) so that different views get their own cache.
+  '''
+  sorted_cols = sorted(cols_to_use) if cols_to_use else []
+  sorted_dates = sorted(date_cols) if date_cols else []
+  schema_text = json.dumps(schema['columns'], sort_keys=True) if schema else ''
+  return hashlib.sha1(('%s|%s|%s|%s' % (','.join(sorted_cols),
+                                        ','.join(sorted_dates),
+                                        schema_text,
+                                        _row_filter_key(row_filter))
+                       ).encode()).hexdigest()[:16]
+
+
+def _load_manifest(manifest_path):
+  '''Return the cache manifest as a dict keyed by file name, or {} if none'''
+  try:
+    with open(manifest_path, 'r') as f:
+      return json.load(f)
+  except (IOError, OSError, ValueError) as ex:
+    logging.info('No usable cache manifest at %s: %s' % (manifest_path, ex))
+    return {}
+
+
+def _save_manifest(manifest_path, manifest):
+  '''
+  Write the cache manifest to a temp file next to it and move that into
+  place, so readers only ever see the old or the new complete file
+  '''
+  handle, tmp_path = tempfile.mkstemp(
+      dir=os.path.dirname(os.path.abspath(manifest_path)),
+      prefix=os.path.basename(manifest_path), suffix='.tmp')
+  try:
+    with os.fdopen(handle, 'w') as f:
+      json.dump(manifest, f, indent=1, sort_keys=True)
+    _move_into_place(tmp_path, manifest_path)
+  except:
+    _remove_path(tmp_path)
+    raise
+
+
+_partition_ext = {'columnar': 'cols', 'hdf': 'hdf'}
+
+
+def _remove_path(path):
+  '''Remove a file or a directory of files if it exists'''
+  if os.path.isdir(path):
+    shutil.rmtree(path)
+  elif os.path.isfile(path):
+    os.remove(path)
+
+
+def _prune_views(cache_dir, keep_path, keep=1):
+  '''
+  Remove the manifests and partitions of all but the keep most recently
+  written views in a cache directory.  keep_path is the manifest that was
+  just written and is always kept.
+  '''
+  suffix = '.manifest.json'
+  manifest_paths = [os.path.join(cache_dir, name)
+                    for name in os.listdir(cache_dir) if name.endswith(suffix)]
+  others = sorted((path for path in manifest_paths if path != keep_path),
+                  key=os.path.getmtime, reverse=True)
+  for path in others[max(keep - 1, 0):]:
+    logging.info('Removing cache of superseded view %s' %
+                 os.path.basename(path)[:-len(suffix)])
+    for entry in _load_manifest(path).values():
+      _remove_path(os.path.join(cache_dir, entry['partition']))
+    _remove_path(path)
+
+
+def _write_partition(df, path, cache_format):
+  '''Save a memory optimized frame as a cached partition'''
+  if cache_format == 'hdf':
+    # fixed format hdf can't store categories
+    _hdf_safe(df).to_hdf(path, settings.HDF_KEY, mode='w')
+  else:
+    save_columnar(df, path)
+
+
+def _read_partition(path, cache_format):
+  '''Load a cached partition, only optimizing it if the format needs it'''
+  if cache_format == 'hdf':
+    return optimize_df_memory(pd.read_hdf(path, settings.HDF_KEY))
+  return load_columnar(path)
+
+
+def forms_to_df(directory, regex, date_cols=None, cols_to_use=None,
+                num_workers=None, export_type=None, row_filter=None):
   '''
   Load in form data to a single dataframe. This is an optimization
-  function that checks for an existing hd5 file and hash before
-  passing off the real work to csv_files_to_df.
+  function that keeps a cached partition for each csv file, so only files
+  that are new or have changed since the last load are parsed again.
+
+  A manifest of the path, size, modified time and sha1 of each file is kept
+  in the cache directory for each set of date_cols/cols_to_use.  If the size
+  and modified time of a file match the manifest, the cached partition is
+  used.  If only the modified time changed, the sha1 decides.
+
+  Partitions are saved with save_columnar, which keeps categories, downcast
+  numbers and datetimes, so a cached file doesn't need to be optimized again.
+  Set settings.CACHE_FORMAT = 'hdf' to use hdf partitions instead.
+
+  When a manifest is written, the caches of other views of the directory
+  are removed, keeping only the settings.CACHE_KEEP_VIEWS (default 1) most
+  recently used views.
 
   Parameters
   ----------
@@ -114,41 +309,843 @@ def forms_to_df(directory, regex, date_cols=None, cols_to_use=None):
   cols_to_use : list of string
     Import a subset of columns (optional, defaults to None)
 
+  num_workers : integer
+    Number of processes used to read csv files (optional, see csv_files_to_df)
+
+  export_type : string
+    Name of the dtype schema to read with (optional, see csv_files_to_df)
+
+  row_filter : list of tuples
+    Only keep rows that match (optional, see csv_files_to_df).  The filter
+    is part of the cache key.
+
   Returns
   -------
   output : pandas dataframe
     Dataframe for these forms
   '''
   try:
-    orig_dir = os.getcwd()
-    os.chdir(directory)
-    current_hash = _hash_from_filesize_and_cols(directory, regex, cols_to_use=cols_to_use)
-    hash_file = open(settings.HASH_FILE, 'r')
-    hash_values = hash_file.readlines()
-
-    assert current_hash+'.hdf\n' in hash_values
-
-    logging.info('Loading cached data from %s.hdf' % (current_hash))
-    df = pd.read_hdf('%s.hdf' % (current_hash),
-                      settings.HDF_KEY, 
-                      usecols=cols_to_use,
-                      parse_dates=date_cols,
-                      infer_datetime_format=True,
-                      low_memory=False)
+    cache_dir = os.path.join(directory, cache_dir_name)
+    if not os.path.exists(cache_dir):
+      os.makedirs(cache_dir)
+    cache_format = getattr(settings, 'CACHE_FORMAT', 'columnar')
+    file_list = data_file_list(directory, regex)
+    schema = _find_dtype_schema(directory, file_list, export_type)
+    view_key = _view_key(date_cols, cols_to_use, schema, row_filter)
+    manifest_path = os.path.join(cache_dir, '%s.manifest.json' % view_key)
+    old_manifest = _load_manifest(manifest_path)
+    new_manifest = {}
+
+    # figure out which files can come from the cache
+    to_parse = []
+    for data_file in file_list:
+      full_path = os.path.join(directory, data_file)
+      stat = os.stat(full_path)
+      entry = {'path': full_path, 'size': stat.st_size,
+               'mtime': stat.st_mtime,
+               'format': cache_format,
+               'partition': '%s.%s.%s' % (view_key,
+                                          os.path.splitext(data_file)[0],
+                                          _partition_ext[cache_format])}
+      old_entry = old_manifest.get(data_file)
+      partition_ok = (old_entry is not None and
+                      old_entry.get('format', 'hdf') == cache_format and
+                      os.path.exists(os.path.join(cache_dir,
+                                                  old_entry['partition'])))
+      if (partition_ok and old_entry['size'] == entry['size'] and
+              old_entry['mtime'] == entry['mtime']):
+        entry['fingerprint'] = old_entry['fingerprint']
+      else:
+        entry['fingerprint'] = _file_fingerprint(full_path)
+        if not (partition_ok and old_entry['size'] == entry['size'] and
+                old_entry['fingerprint'] == entry['fingerprint']):
+          to_parse.append(data_file)
+      new_manifest[data_file] = entry
+    logging.info('%i of %i files in "%s" are new or changed, using cache for '
+                 'the rest' % (len(to_parse), len(file_list), directory))
+
+    # parse new/changed files and save a partition for each
+    read_args = _schema_read_args(schema, date_cols, cols_to_use, None)
+    job_list = [(os.path.join(directory, data_file), date_cols, cols_to_use,
+                 None, read_args, row_filter) for data_file in to_parse]
+    parsed = dict(zip(to_parse, _read_csv_files(job_list, num_workers)))
+    for data_file in to_parse:
+      _write_partition(parsed[data_file], os.path.join(
+          cache_dir, new_manifest[data_file]['partition']), cache_format)
+
+    # drop partitions for files that are no longer in the directory, or that
+    # were saved in another format
+    for data_file in old_manifest:
+      old_partition = old_manifest[data_file]['partition']
+      if (data_file not in new_manifest or
+              new_manifest[data_file]['partition'] != old_partition):
+        logging.info('Removing old cached partition %s' % old_partition)
+        _remove_path(os.path.join(cache_dir, old_partition))
+    _save_manifest(manifest_path, new_manifest)
+    _prune_views(cache_dir, manifest_path, cache_keep_views)
+
+    frames = []
+    for data_file in file_list:
+      if data_file in parsed:
+        frame = parsed.pop(data_file)
+      else:
+        frame = _read_partition(os.path.join(
+            cache_dir, new_manifest[data_file]['partition']), cache_format)
+      logging.info('Adding %s with length %i rows' % (data_file, len(frame.index)))
+      frames.append(frame)
+    df = _concat_frames(frames)
+    del frames
     df = optimize_df_memory(df)
-    os.chdir(orig_dir)
+    logging.info('Total combined length is %i rows\n' % len(df.index))
     return df
-  except IOError as ex:
-    logging.info('HDF5 or hash file not found in "%s", loading from CSV files. Details:\n%s' % (directory, ex))
-  except AssertionError as ex:
-    logging.info('New hash for files in "%s" has changed, reloading from CSV files' % (directory))
-  
-  return csv_files_to_df(directory, regex, date_cols=date_cols, cols_to_use=cols_to_use, dtypes=None, save_hdf=True)
+  except Exception as err:
+    logging.error('An exception happened: ' + str(err))
+    raise
+
+# candidate formats for date columns, most common in the exports first
+# (%z reads a trailing Z as UTC, the same as pandas does without a format)
+date_formats = ['%Y-%m-%d', '%Y-%m-%dT%H:%M:%S.%f%z', '%Y-%m-%dT%H:%M:%S%z',
+                '%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S',
+                '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S',
+                '%m/%d/%Y', '%d/%m/%Y', '%m/%d/%Y %H:%M', '%d-%m-%Y']
+schema_file = getattr(settings, 'SCHEMA_FILE',
+                      os.path.join(DATA_DIR, 'dtype_schemas.json'))
+_dtype_schemas = {'mtime': None, 'schemas': {}}
+# dates already parsed by to_datetime_fast, by format, shared by all callers
+_date_cache = {}
+# download threads can parse dates (ie - ingest_csv) at the same time
+_date_cache_lock = threading.Lock()
+date_cache_size = 1000000
+
+
+def load_dtype_schemas():
+    '''
+    Return all saved dtype schemas as a dict keyed by export type.  The file
+    is only read again if it has changed since the last call.
+    '''
+    if not os.path.isfile(schema_file):
+        return {}
+    mtime = os.path.getmtime(schema_file)
+    if _dtype_schemas['mtime'] != mtime:
+        with open(schema_file, 'r') as f:
+            _dtype_schemas['schemas'] = json.load(f)
+        _dtype_schemas['mtime'] = mtime
+    return _dtype_schemas['schemas']
+
+
+def get_dtype_schema(export_type):
+    '''Return the saved dtype schema for an export type, or None'''
+    return load_dtype_schemas().get(export_type)
+
+
+def save_dtype_schema(export_type, schema):
+    '''Add or replace the dtype schema for an export type in the schema file'''
+    schemas = dict(load_dtype_schemas())
+    schemas[export_type] = schema
+    tmp_path = schema_file + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(schemas, f, indent=1, sort_keys=True)
+    if os.path.isfile(schema_file):
+        os.remove(schema_file)
+    os.rename(tmp_path, schema_file)
+    logging.info('Saved dtype schema for %s to %s' % (export_type, schema_file))
+
+
+def detect_date_format(values, max_values=1000):
+    '''
+    Find a format from date_formats that parses every value given.
+
+    Parameters
+    ----------
+    values : list-like of strings
+      Values to check (nulls are ignored, only max_values are tested)
+    max_values : integer
+      Number of unique values to test (optional, defaults to 1000)
+
+    Returns
+    -------
+    output : string
+      strftime style format, or None if no format fits all values
+    '''
+    values = pd.Series(pd.unique(pd.Series(values).dropna()))[:max_values]
+    if len(values) == 0 or pd.api.types.infer_dtype(values) not in ('string', 'unicode'):
+        return None
+    if not values.str.match(r'^\d{1,4}[-/]\d').all():
+        return None
+    for fmt in date_formats:
+        try:
+            pd.to_datetime(values, format=fmt, errors='raise')
+            return fmt
+        except (ValueError, TypeError):
+            continue
+    return None
+
+
+def _to_datetime_index(values, date_format, errors):
+    '''
+    pd.to_datetime for to_datetime_fast.  If date_format doesn't fit, falls
+    back to letting pandas work out the format.  Returns the parsed index
+    (None if the values aren't dates and errors='ignore') and whether
+    date_format was what parsed them.
+    '''
+    try:
+        if date_format is None:
+            return (pd.DatetimeIndex(pd.to_datetime(values,
+                                                    infer_datetime_format=True)),
+                    True)
+        return pd.DatetimeIndex(pd.to_datetime(values, format=date_format)), True
+    except (ValueError, TypeError):
+        if date_format is not None:
+            return _to_datetime_index(values, None, errors)[0], False
+        if errors == 'raise':
+            raise
+        if errors == 'ignore':
+            return None, True
+        return (pd.DatetimeIndex(pd.to_datetime(values, infer_datetime_format=True,
+                                                errors='coerce')), True)
+
+
+def _parse_unique_dates(uniques, date_format, errors):
+    '''
+    Parse an index of unique values, taking values parsed before (with the
+    same format) from _date_cache.  Returns None as _to_datetime_index does.
+    Values are only cached under a format that parsed them, if date_format
+    doesn't fit and pandas has to work out the format nothing is cached.
+    '''
+    if date_format is None:
+        date_format = detect_date_format(uniques)
+    if date_format is None or len(uniques) > date_cache_size // 10:
+        return _to_datetime_index(uniques, date_format, errors)[0]
+    with _date_cache_lock:
+        cache = _date_cache.get(date_format, {})
+        missing = pd.Index([v for v in uniques if v not in cache])
+    to_parse = uniques if len(missing) == len(uniques) else missing
+    parsed, exact = _to_datetime_index(to_parse, date_format, errors)
+    if parsed is None:
+        return None
+    if not exact:
+        # the values don't all fit date_format, parse them all the same way
+        # and keep them out of the cache
+        if to_parse is uniques:
+            return parsed
+        return _to_datetime_index(uniques, date_format, errors)[0]
+    with _date_cache_lock:
+        if sum(len(c) for c in _date_cache.values()) > date_cache_size:
+            _date_cache.clear()
+        cache = _date_cache.setdefault(date_format, {})
+        # only remember dates that parsed, so a later errors='raise' still
+        # raises
+        cache.update((v, d) for v, d in zip(to_parse, parsed) if d is not pd.NaT)
+        if to_parse is uniques:
+            return parsed
+        return pd.DatetimeIndex([cache.get(v, pd.NaT) for v in uniques])
+
+
+def to_datetime_fast(values, date_format=None, errors='coerce'):
+    '''
+    Convert a column of date strings to datetimes by parsing each unique
+    value once and mapping the results back to the rows.  Date columns in
+    the exports have few unique values for their length (ie - a dob column
+    of millions of rows has tens of thousands of days), so this costs about
+    the number of unique values rather than the number of rows.
+
+    The format is worked out once from the values (see detect_date_format)
+    unless given, and parsed values are kept for the rest of the run, so a
+    column parsed while loading isn't parsed again by later calls.
+
+    Parameters
+    ----------
+    values : pandas series or list-like
+      Values to convert.  Categorical columns only have their categories
+      parsed.  Columns that are already datetimes are returned as they are.
+    date_format : string
+      strftime style format of the values (optional, defaults to None to
+      detect it)
+    errors : string
+      'coerce' turns values that aren't dates into NaT, 'raise' raises, and
+      'ignore' returns the values unchanged (optional, defaults to 'coerce',
+      as pd.to_datetime(errors='coerce') is used in case_func)
+
+    Returns
+    -------
+    output : pandas series
+      Datetime series with the same index and name as values
+    '''
+    series = values if isinstance(values, pd.Series) else pd.Series(values)
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series
+    if pd.api.types.is_categorical_dtype(series):
+        codes = series.cat.codes.values
+        uniques = pd.Index(series.cat.categories)
+    else:
+        codes, uniques = pd.factorize(series.values)
+        uniques = pd.Index(uniques)
+    parsed = _parse_unique_dates(uniques, date_format, errors)
+    if parsed is None:
+        return series
+    # blanks have code -1, point them at a NaT added to the end
+    parsed = parsed.append(pd.DatetimeIndex([pd.NaT], tz=parsed.tz))
+    codes = np.where(codes < 0, len(parsed) - 1, codes)
+    return pd.Series(parsed.take(codes), index=series.index, name=series.name)
+
+
+def _infer_column_schema(series, max_cat_ratio=0.5):
+    '''Work out the dtype (and date format) to use for one sampled column'''
+    values = series.dropna()
+    if series.dtype == bool:
+        return {'dtype': 'bool'}
+    if pd.api.types.is_integer_dtype(series):
+        return {'dtype': str(pd.to_numeric(values, downcast='integer').dtype)}
+    if pd.api.types.is_float_dtype(series):
+        # float32 would silently change large values (ie - phone numbers
+        # with blanks), floats are narrowed after reading if nothing changes
+        return {'dtype': 'float64'}
+    if series.dtype != object:
+        return {'dtype': 'object'}
+    uniques = values.unique()
+    if len(uniques) and set(str(v) for v in uniques) <= set(['True', 'False']):
+        return {'dtype': 'bool' if len(values) == len(series) else 'category'}
+    output = {'dtype': 'object'}
+    if len(uniques) <= max_cat_ratio * len(series):
+        output['dtype'] = 'category'
+    date_format = detect_date_format(uniques)
+    if date_format is not None:
+        output['date_format'] = date_format
+    return output
+
+
+def build_dtype_schema(directory, regex, export_type, sample_rows=100000,
+                       max_cat_ratio=0.5, save=True):
+    '''
+    Build a dtype schema for a kind of export by sampling rows from its files,
+    and save it so csv_files_to_df/forms_to_df use it from then on.  Suggested
+    export types are usage_forms, tasks_cases, ccs_record, person_cases and
+    location.
+
+    Low cardinality strings become categories, True/False columns bools,
+    ints the narrowest int that fits the sample, floats float64 (narrowed
+    after reading by optimize_df_memory where no value changes), and string
+    columns of dates get the format they are written in, so that date_cols
+    can be parsed with an explicit format.
+
+    Parameters
+    ----------
+    directory : string
+      Full path to directory
+    regex : regex object
+      Regex used to specify filenames of desired csv files
+    export_type : string
+      Name to save the schema under
+    sample_rows : integer
+      Total number of rows to sample, spread over the files (optional,
+      defaults to 100000)
+    max_cat_ratio : float
+      Highest ratio of unique to total values for a category (optional,
+      defaults to 0.5, as in obj_to_cat)
+    save : boolean
+      Save the schema to the schema file (optional, defaults to True)
+
+    Returns
+    -------
+    schema : dictionary
+      header (list of columns in the files) and columns (dtype info by column)
+    '''
+    file_list = data_file_list(directory, regex)
+    if len(file_list) == 0:
+        raise IOError('No files matching regex in %s' % directory)
+    rows_per_file = max(1000, sample_rows // len(file_list))
+    frames = []
+    num_rows = 0
+    for data_file in file_list:
+        frame = pd.read_csv(os.path.join(directory, data_file),
+                            nrows=rows_per_file, low_memory=False)
+        frames.append(frame)
+        num_rows += len(frame.index)
+        if num_rows >= sample_rows:
+            break
+    header = frames[0].columns.tolist()
+    sample = pd.concat(frames, ignore_index=True)
+    columns = dict((col, _infer_column_schema(sample[col], max_cat_ratio))
+                   for col in sample.columns)
+    schema = {'header': header, 'columns': columns, 'sampled_rows': num_rows,
+              'created': str(datetime.datetime.now())}
+    logging.info('Built dtype schema for %s from %i rows of %i files'
+                 % (export_type, num_rows, len(frames)))
+    if save:
+        save_dtype_schema(export_type, schema)
+    return schema
+
+
+def _find_dtype_schema(directory, file_list, export_type=None):
+    '''
+    Return the dtype schema for export_type, or if that is None, the saved
+    schema whose header has the same columns as the first file.
+    '''
+    if export_type is not None:
+        schema = get_dtype_schema(export_type)
+        if schema is None:
+            logging.info('WARNING - no dtype schema saved for %s' % export_type)
+        return schema
+    schemas = load_dtype_schemas()
+    if not schemas or not file_list:
+        return None
+    header = set(pd.read_csv(os.path.join(directory, file_list[0]),
+                             nrows=0).columns)
+    for name in sorted(schemas):
+        if set(schemas[name]['header']) == header:
+            logging.info('Reading %s with dtype schema for %s' % (directory, name))
+            return schemas[name]
+    return None
+
+
+def _schema_read_args(schema, date_cols, cols_to_use, dtypes):
+    '''
+    Split a schema into the arguments used to read files with it - dtypes
+    for read_csv, date columns read_csv should still parse, date columns to
+    parse with a known format and int columns to narrow after reading (a
+    narrow int dtype in read_csv silently overflows).  Floats are always
+    read as float64, even from older schemas saved with float32, and left to
+    optimize_df_memory to narrow.  None if no schema.
+    '''
+    if schema is None:
+        return None
+    read_dtypes = {}
+    formats = {}
+    int_dtypes = {}
+    for col, info in schema['columns'].items():
+        if cols_to_use is not None and col not in cols_to_use:
+            continue
+        if date_cols and col in date_cols:
+            if 'date_format' in info:
+                formats[col] = info['date_format']
+                # few unique dates, read as category and parse those
+                read_dtypes[col] = 'category'
+        elif info['dtype'].startswith('int'):
+            int_dtypes[col] = info['dtype']
+        elif info['dtype'].startswith('float'):
+            read_dtypes[col] = 'float64'
+        elif info['dtype'] != 'object':
+            read_dtypes[col] = info['dtype']
+    if dtypes:
+        read_dtypes.update(dtypes)
+        for col in dtypes:
+            int_dtypes.pop(col, None)
+            formats.pop(col, None)
+    parse_dates = date_cols
+    if date_cols:
+        parse_dates = [col for col in date_cols if col not in formats]
+    return {'dtypes': read_dtypes or None, 'parse_dates': parse_dates,
+            'date_formats': formats, 'int_dtypes': int_dtypes}
+
+
+def _apply_schema_casts(frame, read_args):
+    '''Parse dates with known formats and narrow int columns after reading'''
+    for col, fmt in read_args.get('date_formats', {}).items():
+        if col not in frame.columns:
+            continue
+        frame[col] = to_datetime_fast(frame[col], date_format=fmt,
+                                      errors='ignore')
+    for col, dtype in read_args.get('int_dtypes', {}).items():
+        if col in frame.columns and pd.api.types.is_integer_dtype(frame[col]):
+            limits = np.iinfo(dtype)
+            if len(frame.index) and (frame[col].min() >= limits.min and
+                                     frame[col].max() <= limits.max):
+                frame[col] = frame[col].astype(dtype)
+    return frame
+
+
+def _read_csv_file(args):
+    '''
+    Read and memory optimize a single csv file.  Top level so that it can be
+    pickled and handed to a multiprocessing pool by csv_files_to_df.
+
+    If the dtypes from a schema don't fit the file (ie - a blank in a bool
+    column), the file is read again without them.
+
+    Parameters
+    ----------
+    args : tuple
+      (full path to csv file, date_cols, cols_to_use, dtypes, read_args,
+      row_filter) where read_args comes from _schema_read_args, or is None.
+      The path can also be a (path, header_end, start, stop) byte range of
+      the file, see csv_index.
+
+    Returns
+    -------
+    output : pandas dataframe
+      Memory optimized dataframe of the csv file
+    '''
+    data_file, date_cols, cols_to_use, dtypes, read_args, row_filter = args
+    frame = None
+    if read_args is not None:
+        try:
+            frame = _read_csv(data_file, cols_to_use, read_args['parse_dates'],
+                              read_args['dtypes'], row_filter)
+            frame = _apply_schema_casts(frame, read_args)
+        except (ValueError, TypeError) as err:
+            logging.warning('Schema dtypes do not fit %s, reading without '
+                            'them: %s' % (data_file, err))
+            frame = None
+    if frame is None:
+        frame = _read_csv(data_file, cols_to_use, date_cols, dtypes, row_filter)
+    return optimize_df_memory(frame)
+
+
+# operators allowed in a row_filter
+_row_filter_ops = {'==': lambda col, value: col == value,
+                   '!=': lambda col, value: col != value,
+                   '<': lambda col, value: col < value,
+                   '<=': lambda col, value: col <= value,
+                   '>': lambda col, value: col > value,
+                   '>=': lambda col, value: col >= value,
+                   'in': lambda col, value: col.isin(value),
+                   'not in': lambda col, value: ~col.isin(value)}
+
+
+def filter_rows(df, row_filter):
+    '''
+    Return the rows of df that match every condition in row_filter.
+
+    Parameters
+    ----------
+    df : pandas dataframe
+      Dataframe to filter
+    row_filter : list of tuples
+      (column, operator, value) conditions, all of which must be True to
+      keep a row.  Operators are ==, !=, <, <=, >, >=, in and not in, ie -
+      [('closed', '==', False), ('owner_id', 'in', owner_set)]
+
+    Returns
+    -------
+    df : pandas dataframe
+      Rows of df that match
+    '''
+    mask = np.ones(len(df.index), dtype=bool)
+    for col, op, value in row_filter:
+        if op not in _row_filter_ops:
+            raise ValueError('Unknown row_filter operator %s' % op)
+        mask &= np.asarray(_row_filter_ops[op](df[col], value), dtype=bool)
+    return df[mask]
+
+
+def _filter_read_cols(cols_to_use, row_filter):
+    '''
+    Return the columns to read so that a row filter can be evaluated, and
+    the filter columns to drop again afterwards.
+    '''
+    if cols_to_use is None or not row_filter:
+        return cols_to_use, []
+    extra_cols = []
+    for col, op, value in row_filter:
+        if col not in cols_to_use and col not in extra_cols:
+            extra_cols.append(col)
+    return list(cols_to_use) + extra_cols, extra_cols
+
 
-def csv_files_to_df(directory, regex, date_cols=None, cols_to_use=None, dtypes=None, save_hdf=False):
+def _date_read_dtypes(date_cols, dtypes):
+    '''
+    Add category dtypes for date columns to dtypes, so read_csv keeps one
+    copy of each date string and to_datetime_fast only parses those.
+    '''
+    if not date_cols:
+        return dtypes
+    output = dict(dtypes) if dtypes else {}
+    for col in date_cols:
+        output.setdefault(col, 'category')
+    return output
+
+
+def _parse_date_cols(frame, date_cols):
+    '''Parse date columns after reading, leaving columns that aren't dates'''
+    for col in date_cols or []:
+        if col in frame.columns:
+            frame[col] = to_datetime_fast(frame[col], errors='ignore')
+    return frame
+
+
+def _iter_filtered_csv(data_file, cols_to_use, date_cols, dtypes, row_filter,
+                       chunksize):
+    '''
+    Read a csv file a chunk at a time and yield only the rows that pass
+    row_filter.  Dates are parsed after filtering, so rows that are dropped
+    are never converted.
+    '''
+    read_cols, extra_cols = _filter_read_cols(cols_to_use, row_filter)
+    reader = pd.read_csv(_csv_source(data_file), usecols=read_cols,
+                         dtype=_date_read_dtypes(date_cols, dtypes),
+                         chunksize=chunksize)
+    for chunk in reader:
+        chunk = filter_rows(chunk, row_filter)
+        if extra_cols:
+            chunk = chunk.drop(extra_cols, axis=1)
+        yield _parse_date_cols(chunk, date_cols)
+
+
+def _read_csv(data_file, cols_to_use, date_cols, dtypes, row_filter=None,
+              chunksize=500000):
+    '''
+    pd.read_csv for a single file, keeping only rows that pass row_filter
+    (if given) as each chunk is read.  Dates are parsed with to_datetime_fast.
+    '''
+    if not row_filter:
+        frame = pd.read_csv(_csv_source(data_file), usecols=cols_to_use,
+                            dtype=_date_read_dtypes(date_cols, dtypes))
+        return _parse_date_cols(frame, date_cols)
+    frames = list(_iter_filtered_csv(data_file, cols_to_use, date_cols, dtypes,
+                                     row_filter, chunksize))
+    if len(frames) == 0:
+        # no rows in the file - return its empty frame
+        return pd.read_csv(_csv_source(data_file), usecols=cols_to_use,
+                           dtype=dtypes, nrows=0)
+    frame = _concat_frames(frames)
+    logging.debug('Kept %i rows of %s after row filter' % (len(frame.index),
+                                                           data_file))
+    return frame
+
+
+def _index_path(data_file):
+    '''Return where the row offset index of a csv file is kept'''
+    directory, file_name = os.path.split(data_file)
+    return os.path.join(directory, cache_dir_name, file_name + '.offsets.json')
+
+
+def _scan_csv_offsets(data_file, rows_per_range, block_size=16 * 1024 ** 2):
+    '''
+    Scan a csv file once and return the byte offset where the data starts,
+    the offsets where every rows_per_range-th row starts and the number of
+    rows.  Newlines inside quoted values are not treated as row ends.
+    '''
+    offsets = []
+    num_ends = 0
+    in_quotes = 0
+    position = 0
+    last_end = 0
+    with open(data_file, 'rb') as f:
+        block = f.read(block_size)
+        while block:
+            arr = np.frombuffer(block, dtype=np.uint8)
+            quote_pos = np.flatnonzero(arr == ord('"'))
+            newline_pos = np.flatnonzero(arr == ord('\n'))
+            # a newline ends a row if an even number of quotes came before it
+            quotes_before = np.searchsorted(quote_pos, newline_pos) + in_quotes
+            row_ends = newline_pos[quotes_before % 2 == 0] + position + 1
+            end_num = np.arange(num_ends, num_ends + len(row_ends))
+            offsets.extend(row_ends[end_num % rows_per_range == 0].tolist())
+            num_ends += len(row_ends)
+            if len(row_ends):
+                last_end = int(row_ends[-1])
+            in_quotes = (in_quotes + len(quote_pos)) % 2
+            position += len(block)
+            block = f.read(block_size)
+    if num_ends == 0:
+        # header only, without a trailing newline
+        return position, [], 0
+    header_end = offsets[0]
+    num_rows = num_ends - 1
+    if position > last_end:
+        # last row has no newline at the end
+        num_rows += 1
+    offsets = [offset for offset in offsets if offset < position]
+    return header_end, offsets, num_rows
+
+
+def csv_index(data_file, rows_per_range=None):
+    '''
+    Return the row offset index of a csv file, building it with a single scan
+    of the file if there isn't an index yet or the file has changed since.
+
+    The index is kept next to the file in the cache directory.  It lets a
+    large csv be read as independent ranges of rows, each with the header
+    put back on, instead of splitting it into smaller files.
+
+    Parameters
+    ----------
+    data_file : string
+      Full path to csv file
+    rows_per_range : integer
+      Number of rows in each range (optional, defaults to 1000000)
+
+    Returns
+    -------
+    index : dictionary
+      'header_end' is the byte offset of the first row, 'ranges' a list of
+      (start, stop) byte offsets that each hold rows_per_range rows (the last
+      one can hold fewer) and 'nrows' the number of rows in the file
+    '''
+    if rows_per_range is None:
+        rows_per_range = csv_range_rows
+    stat = os.stat(data_file)
+    index_path = _index_path(data_file)
+    try:
+        with open(index_path, 'r') as f:
+            index = json.load(f)
+        if (index['size'] == stat.st_size and index['mtime'] == stat.st_mtime
+                and index['rows_per_range'] == rows_per_range):
+            return index
+        logging.info('%s has changed, rebuilding its row index' % data_file)
+    except (IOError, OSError, ValueError, KeyError):
+        pass
+    logging.info('Building row index for %s' % data_file)
+    header_end, offsets, num_rows = _scan_csv_offsets(data_file, rows_per_range)
+    index = {'size': stat.st_size, 'mtime': stat.st_mtime,
+             'rows_per_range': rows_per_range, 'header_end': header_end,
+             'nrows': num_rows,
+             'ranges': list(zip(offsets, offsets[1:] + [stat.st_size]))}
+    try:
+        if not os.path.exists(os.path.dirname(index_path)):
+            os.makedirs(os.path.dirname(index_path))
+        _save_manifest(index_path, index)
+    except (IOError, OSError) as err:
+        logging.warning('Could not save row index %s: %s' % (index_path, err))
+    return index
+
+
+def _csv_source(data_file):
+    '''
+    Return something pd.read_csv can read for a csv path, or for a
+    (path, header_end, start, stop) byte range of a csv, which is read with
+    the header in front.
+    '''
+    if not isinstance(data_file, tuple):
+        return data_file
+    path, header_end, start, stop = data_file
+    with open(path, 'rb') as f:
+        header = f.read(header_end)
+        f.seek(start)
+        return BytesIO(header + f.read(stop - start))
+
+
+def _split_large_jobs(job_list):
+    '''
+    Replace the job for each csv file larger than csv_split_size by one job
+    per row range of the file.  Returns the new jobs and the number of jobs
+    each original job became.
+    '''
+    range_jobs = []
+    counts = []
+    for job in job_list:
+        data_file = job[0]
+        if (isinstance(data_file, tuple) or
+                os.path.getsize(data_file) <= csv_split_size):
+            range_jobs.append(job)
+            counts.append(1)
+            continue
+        index = csv_index(data_file)
+        if not index['ranges']:
+            range_jobs.append(job)
+            counts.append(1)
+            continue
+        logging.info('Reading %s as %i ranges of rows' %
+                     (data_file, len(index['ranges'])))
+        for start, stop in index['ranges']:
+            range_jobs.append(((data_file, index['header_end'], start, stop),)
+                              + tuple(job[1:]))
+        counts.append(len(index['ranges']))
+    return range_jobs, counts
+
+
+def _read_csv_files(job_list, num_workers=None):
+    '''
+    Run _read_csv_file over a list of jobs, with a pool of processes if
+    num_workers > 1.  Frames are returned in the same order as the jobs.
+
+    Files larger than csv_split_size (settings.CSV_SPLIT_SIZE) are read as
+    independent ranges of rows using csv_index, which can run in parallel,
+    and put back together into one frame per file.
+
+    Parameters
+    ----------
+    job_list : list of tuples
+      Arguments for _read_csv_file, one tuple per file
+
+    num_workers : integer
+      Number of processes to use (optional, defaults to settings.NUM_WORKERS,
+      or 1 if that isn't set)
+
+    Returns
+    -------
+    frames : list of pandas dataframes
+      One memory optimized dataframe per job
+    '''
+    if num_workers is None:
+        num_workers = getattr(settings, 'NUM_WORKERS', 1)
+    range_jobs, counts = _split_large_jobs(job_list)
+    if num_workers > 1 and len(range_jobs) > 1:
+        logging.info('Reading %i files with %i workers' %
+                     (len(range_jobs), num_workers))
+        pool = multiprocessing.Pool(min(num_workers, len(range_jobs)))
+        try:
+            range_frames = pool.map(_read_csv_file, range_jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        range_frames = [_read_csv_file(job) for job in range_jobs]
+    if len(range_jobs) == len(job_list):
+        return range_frames
+    frames = []
+    position = 0
+    for count in counts:
+        frames.append(_concat_frames(range_frames[position:position + count]))
+        position += count
+    return frames
+
+
+def _concat_frames(frames):
+    '''
+    Concat frames that were optimized separately.  Categorical columns are
+    given a shared set of categories first, otherwise pandas falls back to
+    object dtype when the categories of the frames differ.
+
+    Parameters
+    ----------
+    frames : list of pandas dataframes
+      Frames to concat, in the order they should appear
+
+    Returns
+    -------
+    output : pandas dataframe
+      Single dataframe of all frames
+    '''
+    if len(frames) > 1:
+        for col in frames[0].columns:
+            if all(col in f.columns and
+                   pd.api.types.is_categorical_dtype(f[col]) for f in frames):
+                first_cats = frames[0][col].cat.categories
+                if all(f[col].cat.categories.equals(first_cats) for f in frames):
+                    # already shared (ie - location names), concats as codes
+                    continue
+                cats = pd.api.types.union_categoricals(
+                        [f[col] for f in frames], sort_categories=True).categories
+                for f in frames:
+                    f[col] = f[col].cat.set_categories(cats)
+    return pd.concat(frames, ignore_index=True, copy=False)
+
+
+def _hdf_safe(df):
+    '''Return a copy of df with categories as objects for fixed format hdf'''
+    cat_cols = df.select_dtypes(include=['category']).columns
+    if len(cat_cols) == 0:
+        return df
+    return df.astype(dict((col, 'object') for col in cat_cols))
+
+
+def csv_files_to_df(directory, regex, date_cols=None, cols_to_use=None,
+                    dtypes=None, save_hdf=False, num_workers=None,
+                    export_type=None, row_filter=None):
     '''
     Combine all csv files in directory to a single dataframe.
 
+    Each file is read and memory optimized on its own, then the frames are
+    combined in file order.  With num_workers > 1 the files are read in
+    parallel by a pool of processes, which gives the same frame as reading
+    them one at a time.  NOTE - on Windows, scripts that use more than one
+    worker need an if __name__ == '__main__' guard.
+
+    If a dtype schema has been built for this kind of export (see
+    build_dtype_schema), it is used to read the files with compact dtypes
+    and known date formats.  dtypes passed in take precedence.
+
     Parameters
     ----------
     directory : string
@@ -169,6 +1166,20 @@ def csv_files_to_df(directory, regex, date_cols=None, cols_to_use=None, dtypes=N
     save_hdf : boolean
       Whether we should save a hash and hd5 export of the final dataframe
 
+    num_workers : integer
+      Number of processes used to read files (optional, defaults to
+      settings.NUM_WORKERS, or 1 if that isn't set)
+
+    export_type : string
+      Name of the dtype schema to read with (optional, defaults to None,
+      which uses a schema whose columns match the file headers if any)
+
+    row_filter : list of tuples
+      Only keep rows that match these (column, operator, value) conditions,
+      ie - [('closed', '==', False)].  Files are read in chunks and filtered
+      as they are read, so dropped rows are never held in memory, parsed
+      to dates or optimized.  See filter_rows.  (optional, defaults to None)
+
     Returns
     -------
     output : pandas dataframe
@@ -176,31 +1187,30 @@ def csv_files_to_df(directory, regex, date_cols=None, cols_to_use=None, dtypes=N
     '''
     try:
         file_list = data_file_list(directory, regex)
-        frames = []
         orig_dir = os.getcwd()
         os.chdir(directory)
-        # append frames to a list of frames, then concat into one large frame
-        for data_file in file_list:
-            frame = pd.DataFrame()
-            frame = frame.fillna('')
-            frame = pd.read_csv(data_file, usecols=cols_to_use,
-                                parse_dates=date_cols,
-                                infer_datetime_format=True,
-                                dtype = dtypes)
-            frames.append(frame)
+        schema = _find_dtype_schema(directory, file_list, export_type)
+        read_args = _schema_read_args(schema, date_cols, cols_to_use, dtypes)
+        job_list = [(os.path.join(directory, data_file), date_cols,
+                     cols_to_use, dtypes, read_args, row_filter)
+                    for data_file in file_list]
+        # read each file to a frame, then concat into one large frame
+        frames = _read_csv_files(job_list, num_workers)
+        for data_file, frame in zip(file_list, frames):
             logging.info('Adding %s with length %i rows' %
                           (data_file, len(frame.index)))
-        df = pd.concat(frames, ignore_index=True, copy=False)
+        df = _concat_frames(frames)
+        del frames
 
         if save_hdf:
-          current_hash = _hash_from_filesize_and_cols(directory, regex, cols_to_use)  
-          df.to_hdf('%s.hdf' % (current_hash), settings.HDF_KEY)
+          current_hash = _hash_from_filesize_and_cols(directory, regex, cols_to_use,
+                                                      row_filter)
+          # fixed format hdf can't store categories
+          _hdf_safe(df).to_hdf('%s.hdf' % (current_hash), settings.HDF_KEY)
           f = open(settings.HASH_FILE, 'a')
           f.write('%s.hdf\n' % (current_hash))
           f.close()
           
-        #TODO - to_hdf not using optimized df b/c can't handle categories.  Can save format='table'
-        #as setting, but causes other errors when importing due to 'operands broadcast together due to array size
         df = optimize_df_memory(df)
         logging.info('Total combined length is %i rows\n' % len(df.index))
         os.chdir(orig_dir)
@@ -210,10 +1220,486 @@ def csv_files_to_df(directory, regex, date_cols=None, cols_to_use=None, dtypes=N
         raise
 
 
-def combine_csvs(directory, new_directory, filename, regex, date_cols=None, cols_to_use=None):
+def iter_csv_chunks(directory, regex, date_cols=None, cols_to_use=None,
+                    dtypes=None, chunksize=500000, export_type=None,
+                    row_filter=None):
+    '''
+    Generator over all csv files in directory that yields dataframes of at
+    most chunksize rows, so an export can be worked through without ever
+    holding all of it in memory.  Chunks are not memory optimized, but are
+    read with the dtype schema for the export if there is one.
+
+    Parameters
+    ----------
+    directory : string
+      Full path to directory
+
+    regex : regex object
+      Regex used to specify filenames of desired csv files
+
+    date_cols : list of strings
+      Import specific columns in datetime format (optional, defaults to None)
+
+    cols_to_use : list of string
+      Import a subset of columns (optional, defaults to None)
+
+    dtypes : dictionary
+      Dictionary of column names and known data types
+
+    chunksize : integer
+      Maximum number of rows in each chunk (optional, defaults to 500000)
+
+    export_type : string
+      Name of the dtype schema to read with (optional, see csv_files_to_df)
+
+    row_filter : list of tuples
+      Only yield rows that match (optional, see csv_files_to_df)
+
+    Returns
+    -------
+    output : generator of pandas dataframes
+      Chunks of the csv files, in file order
+    '''
+    file_list = data_file_list(directory, regex)
+    schema = _find_dtype_schema(directory, file_list, export_type)
+    read_args = _schema_read_args(schema, date_cols, cols_to_use, dtypes)
+    if read_args is None:
+        read_args = {'parse_dates': date_cols, 'dtypes': dtypes}
+    for data_file in file_list:
+        logging.info('Reading %s in chunks of %i rows' % (data_file, chunksize))
+        if row_filter:
+            reader = _iter_filtered_csv(os.path.join(directory, data_file),
+                                        cols_to_use, read_args['parse_dates'],
+                                        read_args['dtypes'], row_filter,
+                                        chunksize)
+        else:
+            reader = (_parse_date_cols(chunk, read_args['parse_dates'])
+                      for chunk in pd.read_csv(
+                          os.path.join(directory, data_file),
+                          usecols=cols_to_use,
+                          dtype=_date_read_dtypes(read_args['parse_dates'],
+                                                  read_args['dtypes']),
+                          chunksize=chunksize))
+        for chunk in reader:
+            yield _apply_schema_casts(chunk, read_args)
+
+
+def _add_results(left, right):
+    '''
+    Default combine for map_reduce_csv_files.  Adds pandas objects aligned
+    on their index (missing labels count as 0), numbers with +, and tuples
+    or lists of those item by item.
+    '''
+    if isinstance(left, (tuple, list)):
+        return type(left)(_add_results(l, r) for l, r in zip(left, right))
+    if isinstance(left, (pd.Series, pd.DataFrame)):
+        output = left.add(right, fill_value=0)
+        if (isinstance(left, pd.Series) and
+                pd.api.types.is_integer_dtype(left) and
+                pd.api.types.is_integer_dtype(right)):
+            output = output.astype(np.result_type(left.dtype, right.dtype))
+        return output
+    return left + right
+
+
+def map_reduce_csv_files(directory, regex, map_func, combine_func=None,
+                         reduce_func=None, date_cols=None, cols_to_use=None,
+                         dtypes=None, chunksize=500000, export_type=None,
+                         row_filter=None):
+    '''
+    Run an aggregation over all csv files in directory one chunk at a time.
+    map_func turns each chunk into a small result (ie - a value_counts or a
+    groupby().sum()), combine_func merges those results as they come in,
+    and reduce_func (if given) finishes off the combined result.  Memory use
+    depends on chunksize and the size of the results, not the export size.
+
+    Example - number of open cases per owner:
+      map_reduce_csv_files(data_dir, regex,
+                           lambda df: df['owner_id'].value_counts(),
+                           cols_to_use=['owner_id'],
+                           row_filter=[('closed', '==', False)])
+
+    Parameters
+    ----------
+    directory : string
+      Full path to directory
+
+    regex : regex object
+      Regex used to specify filenames of desired csv files
+
+    map_func : function
+      Takes a chunk dataframe and returns a result for that chunk
+
+    combine_func : function
+      Takes two results and returns one (optional, defaults to adding pandas
+      objects on their index, which suits value_counts/groupby sums/sizes)
+
+    reduce_func : function
+      Applied to the final combined result (optional, defaults to None)
+
+    date_cols : list of strings
+      Import specific columns in datetime format (optional, defaults to None)
+
+    cols_to_use : list of string
+      Import a subset of columns (optional, defaults to None)
+
+    dtypes : dictionary
+      Dictionary of column names and known data types
+
+    chunksize : integer
+      Maximum number of rows read at a time (optional, defaults to 500000)
+
+    export_type : string
+      Name of the dtype schema to read with (optional, see csv_files_to_df)
+
+    row_filter : list of tuples
+      Only pass rows that match to map_func (optional, see csv_files_to_df)
+
+    Returns
+    -------
+    output : result of map_func/combine_func/reduce_func
+      None if there were no rows
+    '''
+    if combine_func is None:
+        combine_func = _add_results
+    output = None
+    num_rows = 0
+    for chunk in iter_csv_chunks(directory, regex, date_cols=date_cols,
+                                 cols_to_use=cols_to_use, dtypes=dtypes,
+                                 chunksize=chunksize,
+                                 export_type=export_type,
+                                 row_filter=row_filter):
+        num_rows += len(chunk.index)
+        result = map_func(chunk)
+        output = result if output is None else combine_func(output, result)
+    logging.info('Aggregated %i rows from %s' % (num_rows, directory))
+    if reduce_func is not None and output is not None:
+        output = reduce_func(output)
+    return output
+
+
+def _save_array(file_path, values):
+    '''
+    np.save, only allowing pickle when the array holds python objects.  A
+    file_path ending in .npz is saved compressed with np.savez_compressed.
+    '''
+    values = np.asarray(values)
+    if file_path.endswith('.npz'):
+        np.savez_compressed(file_path, values=values)
+    else:
+        np.save(file_path, values, allow_pickle=(values.dtype == object))
+
+
+def _load_array(file_path, mmap_mode=None, allow_pickle=False):
+    '''Load an array saved by _save_array, compressed ones are read whole'''
+    if file_path.endswith('.npz'):
+        with np.load(file_path, allow_pickle=allow_pickle) as f:
+            return f['values']
+    return np.load(file_path, mmap_mode=mmap_mode, allow_pickle=allow_pickle)
+
+
+def save_columnar(df, path, meta=None, compress=False):
+    '''
+    Save a dataframe as a folder with one .npy file per column and a small
+    header.json describing them.  Unlike csv or fixed format hdf, this keeps
+    categories, downcast ints/floats, bools and datetimes as they are, and
+    the number/date/category code files can be memory mapped when loading.
+
+    Object columns are stored as integer codes plus an array of unique
+    values.  The index is not saved.  With compress=True each column is a
+    compressed .npz file instead, which is several times smaller on disk
+    but has to be read whole (it can't be memory mapped).
+
+    Parameters
+    ----------
+    df : pandas dataframe
+      Dataframe to save
+    path : string
+      Full path of the folder to create.  Replaced if it already exists.
+    meta : dictionary
+      Anything else to keep in the header, read back with columnar_info
+      (optional, defaults to None)
+    compress : boolean
+      Save compressed column files (optional, defaults to False)
+
+    Returns
+    -------
+    None
+    '''
+    tmp_path = path + '.tmp'
+    _remove_path(tmp_path)
+    os.makedirs(tmp_path)
+    ext = '.npz' if compress else '.npy'
+    columns = []
+    for i, col in enumerate(df.columns):
+        series = df[col]
+        entry = {'name': col, 'dtype': str(series.dtype),
+                 'file': 'c%03d%s' % (i, ext)}
+        if pd.api.types.is_categorical_dtype(series):
+            entry['kind'] = 'category'
+            entry['ordered'] = bool(series.cat.ordered)
+            entry['categories_file'] = 'c%03d.cats%s' % (i, ext)
+            _save_array(os.path.join(tmp_path, entry['file']),
+                        series.cat.codes.values)
+            _save_array(os.path.join(tmp_path, entry['categories_file']),
+                        series.cat.categories.values)
+        elif isinstance(series.dtype, np.dtype) and series.dtype.kind in 'biufM':
+            entry['kind'] = 'values'
+            _save_array(os.path.join(tmp_path, entry['file']), series.values)
+        else:
+            # strings and anything else - store as codes + unique values
+            entry['kind'] = 'object'
+            entry['categories_file'] = 'c%03d.cats%s' % (i, ext)
+            codes, uniques = pd.factorize(series.astype(object).values)
+            _save_array(os.path.join(tmp_path, entry['file']),
+                        pd.to_numeric(codes, downcast='integer'))
+            _save_array(os.path.join(tmp_path, entry['categories_file']),
+                        np.asarray(uniques, dtype=object))
+        columns.append(entry)
+    with open(os.path.join(tmp_path, 'header.json'), 'w') as f:
+        json.dump({'version': 1, 'nrows': len(df.index), 'columns': columns,
+                   'meta': meta}, f, indent=1)
+    _remove_path(path)
+    os.rename(tmp_path, path)
+
+
+def columnar_info(path):
+    '''
+    Read the header of a folder written by save_columnar without touching
+    any of the column files.
+
+    Parameters
+    ----------
+    path : string
+      Full path of the folder written by save_columnar
+
+    Returns
+    -------
+    header : dictionary
+      'nrows' is the number of rows, 'columns' a list of entries with the
+      'name' and 'dtype' of each column and 'meta' what was given to
+      save_columnar
+    '''
+    with open(os.path.join(path, 'header.json'), 'r') as f:
+        return json.load(f)
+
+
+def load_columnar(path, columns=None, mmap_mode=None, start=None, stop=None):
+    '''
+    Load a dataframe saved by save_columnar.
+
+    Opening is only a read of the small header, column files that are not
+    asked for are never opened.  When a row range is given the column files
+    are memory mapped and only the pages holding those rows are read.
+
+    Parameters
+    ----------
+    path : string
+      Full path of the folder written by save_columnar
+    columns : list of strings
+      Only load these columns (optional, defaults to None for all columns)
+    mmap_mode : string
+      Passed to np.load, ie 'r' to memory map the column files rather than
+      read them (optional, defaults to None).  Compressed columns are always
+      read.
+    start : integer
+      First row to load (optional, defaults to None for the first row)
+    stop : integer
+      Load rows up to but not including this one (optional, defaults to None
+      for all remaining rows)
+
+    Returns
+    -------
+    df : pandas dataframe
+      Dataframe with the same columns and dtypes that were saved, indexed by
+      row number in the saved dataframe
+    '''
+    header = columnar_info(path)
+    rows = slice(start, stop)
+    data = {}
+    names = []
+    for entry in header['columns']:
+        if columns is not None and entry['name'] not in columns:
+            continue
+        names.append(entry['name'])
+        data[entry['name']] = _load_column(path, entry, mmap_mode, rows)
+    return pd.DataFrame(data, columns=names,
+                        index=pd.RangeIndex(header['nrows'])[rows])
+
+
+def _load_column(path, entry, mmap_mode=None, rows=slice(None)):
+    '''Build one column described by an entry in a columnar header.json'''
+    file_path = os.path.join(path, entry['file'])
+    if rows == slice(None):
+        values = _load_array(file_path, mmap_mode)
+    elif file_path.endswith('.npz'):
+        values = _load_array(file_path)[rows]
+    else:
+        # map the file so only the pages for the requested rows get read
+        values = np.load(file_path, mmap_mode='r')[rows]
+        if mmap_mode is None:
+            values = np.array(values)
+    if entry['kind'] == 'values':
+        return values
+    uniques = _load_array(os.path.join(path, entry['categories_file']),
+                          allow_pickle=True)
+    if entry['kind'] == 'category':
+        return pd.Categorical.from_codes(values, categories=uniques,
+                                         ordered=entry['ordered'])
+    output = np.empty(len(values), dtype=object)
+    output[:] = np.nan
+    has_value = values >= 0
+    output[has_value] = uniques[values[has_value]]
+    if entry['dtype'] != 'object':
+        return pd.Series(output).astype(entry['dtype']).array
+    return output
+
+
+def _ingest_path(data_file):
+    '''Return where the columnar partition of an ingested csv file is kept'''
+    directory, file_name = os.path.split(data_file)
+    return os.path.join(directory, cache_dir_name,
+                        os.path.splitext(file_name)[0] + '.cols')
+
+
+def _ingest_source(data_file, cols_to_use, date_cols):
+    '''What an ingested partition was made from, kept in its header'''
+    stat = os.stat(data_file)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime,
+            'cols_to_use': sorted(cols_to_use) if cols_to_use else None,
+            'date_cols': sorted(date_cols) if date_cols else None}
+
+
+def _ingested_meta(data_file):
+    '''Header meta of the partition of an ingested file, None if there's none'''
+    try:
+        return columnar_info(_ingest_path(data_file)).get('meta')
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _ingest_covers(meta, cols_to_use, date_cols):
+    '''True if a partition made as meta says holds cols_to_use and date_cols'''
+    have_cols = meta.get('cols_to_use')
+    if have_cols is not None and (cols_to_use is None or
+                                  not set(cols_to_use) <= set(have_cols)):
+        return False
+    return set(date_cols or []) <= set(meta.get('date_cols') or [])
+
+
+def ingest_csv(data_file, cols_to_use=None, date_cols=None, export_type=None):
+    '''
+    Parse a csv file once and save it as a typed, compressed columnar
+    partition (see save_columnar) in the cache directory next to it, so later
+    reads don't parse the csv again.  Meant to run as each file is
+    downloaded, see the ingest option of download_ucr, and by read_ingested
+    for files that haven't been ingested yet.
+
+    The columns and date columns of an earlier partition of the file are
+    kept as well, so one partition holds the union of what every caller
+    asked for.
+
+    Parameters
+    ----------
+    data_file : string
+      Full path to csv file
+    cols_to_use : list of strings
+      Columns to keep (optional, defaults to None for all).  Columns that
+      aren't in the file are left out.
+    date_cols : list of strings
+      Columns to parse as dates (optional, defaults to None)
+    export_type : string
+      Name of the dtype schema to read with (optional, defaults to the saved
+      schema matching the header, see csv_files_to_df)
+
+    Returns
+    -------
+    output : pandas dataframe
+      Memory optimized dataframe of the csv file
+    '''
+    directory, file_name = os.path.split(data_file)
+    old_meta = _ingested_meta(data_file)
+    if old_meta is not None:
+        if cols_to_use is not None and old_meta.get('cols_to_use') is not None:
+            cols_to_use = sorted(set(cols_to_use) | set(old_meta['cols_to_use']))
+        else:
+            cols_to_use = None
+        date_cols = sorted(set(date_cols or []) |
+                           set(old_meta.get('date_cols') or [])) or None
+    source = _ingest_source(data_file, cols_to_use, date_cols)
+    if cols_to_use is not None or date_cols is not None:
+        header = pd.read_csv(data_file, nrows=0).columns
+        if cols_to_use is not None:
+            cols_to_use = [col for col in cols_to_use if col in header]
+        if date_cols is not None:
+            date_cols = [col for col in date_cols if col in header]
+    schema = _find_dtype_schema(directory, [file_name], export_type)
+    read_args = _schema_read_args(schema, date_cols, cols_to_use, None)
+    output = _read_csv_file((data_file, date_cols, cols_to_use, None,
+                             read_args, None))
+    path = _ingest_path(data_file)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    save_columnar(output, path, meta=source, compress=True)
+    logging.info('Ingested %s, %i rows' % (file_name, len(output.index)))
+    return output
+
+
+def read_ingested(data_file, columns=None, cols_to_use=None, date_cols=None,
+                  export_type=None):
+    '''
+    Load columns of a csv file from the partition ingest_csv saved for it,
+    ingesting it first if that hasn't been done or the file has changed
+    since.  Only the columns asked for are read from the partition.
+
+    A partition that already holds cols_to_use (with date_cols parsed) is
+    used as is, whatever else it holds.  Otherwise the file is ingested
+    again once, with the union of the columns, see ingest_csv.
+
+    Parameters
+    ----------
+    data_file : string
+      Full path to csv file
+    columns : list of strings
+      Columns to return (optional, defaults to None for cols_to_use, or all
+      ingested columns if that is None too)
+    cols_to_use, date_cols, export_type
+      Passed on to ingest_csv
+
+    Returns
+    -------
+    output : pandas dataframe
+    '''
+    if columns is None:
+        columns = cols_to_use
+    output = None
+    meta = _ingested_meta(data_file)
+    if meta is not None:
+        stat = os.stat(data_file)
+        if (meta.get('size'), meta.get('mtime')) != (stat.st_size,
+                                                     stat.st_mtime):
+            logging.info('%s has changed since it was ingested' % data_file)
+        elif _ingest_covers(meta, cols_to_use, date_cols):
+            output = load_columnar(_ingest_path(data_file), columns)
+        else:
+            logging.info('Adding columns to the partition of %s' % data_file)
+    if output is None:
+        output = ingest_csv(data_file, cols_to_use, date_cols, export_type)
+    if columns is None:
+        return output
+    return output[[col for col in columns if col in output.columns]]
+
+
+def combine_csvs(directory, new_directory, filename, regex, date_cols=None, cols_to_use=None,
+                 output_format='csv'):
     '''
     Combine all csv files in directory to a single csv and saves to same directory.
 
+    With output_format='columnar' the combined data is saved with
+    save_columnar to a <filename>.cols folder instead, which downstream
+    scripts can open with load_columnar(path, mmap_mode='r') to only read the
+    columns and rows they use.
+
     Parameters
     ----------
     directory : string
@@ -228,16 +1714,26 @@ def combine_csvs(directory, new_directory, filename, regex, date_cols=None, cols
       Import specific columns in datetime format (optional, defaults to None)
     cols_to_use : list of string
       Import a subset of columns (optional, defaults to None)
+    output_format : string
+      'csv' for a single csv file or 'columnar' for a memory mappable folder
+      with one file per column (optional, defaults to 'csv')
 
     Returns
     -------
     output : pandas dataframe
       Dataframe of combined csv files
     '''
+    if output_format not in ('csv', 'columnar'):
+        raise ValueError('Unknown output_format %s' % output_format)
     big_df = csv_files_to_df(directory, regex, date_cols, cols_to_use)
-    output_file = os.path.join(new_directory, filename) + '.csv'
-    big_df.to_csv(output_file)
+    if output_format == 'columnar':
+        output_file = os.path.join(new_directory, filename) + '.cols'
+        save_columnar(big_df, output_file)
+    else:
+        output_file = os.path.join(new_directory, filename) + '.csv'
+        big_df.to_csv(output_file)
     logging.info('Saved output to %s' % output_file)
+    return big_df
 
 
 # hat tip: https://gist.github.com/jrivero/1085501
@@ -284,23 +1780,483 @@ def split_csvs(filehandler, delimiter=',', row_limit=10000,
         current_out_writer.writerow(row)
 
 
-def find_and_split_csvs(directory, file_limit=1000000000):
-    logging.info('Testing for csv files larger than %i bytes' % file_limit)
-    orig_dir = os.getcwd()
-    os.chdir(directory)
-    file_list = os.listdir(directory)
-    for myfile in file_list:
-        test_file = os.path.join(directory, myfile)
-        if os.path.getsize(test_file) > file_limit:
-            logging.info('%s exceeds limit.  Splitting file' % test_file)
-            split_csvs(open(test_file), row_limit=1000000, output_name_template = myfile[:-4] + '%s.csv')
-    os.chdir(orig_dir)
-    return
+def find_and_split_csvs(directory, file_limit=1000000000):
+    '''
+    Split csv files in directory larger than file_limit bytes into files of
+    1M rows.  The csv loaders don't need this anymore, they read large files
+    as ranges of rows using csv_index.
+    '''
+    logging.info('Testing for csv files larger than %i bytes' % file_limit)
+    orig_dir = os.getcwd()
+    os.chdir(directory)
+    file_list = os.listdir(directory)
+    for myfile in file_list:
+        test_file = os.path.join(directory, myfile)
+        if os.path.getsize(test_file) > file_limit:
+            logging.info('%s exceeds limit.  Splitting file' % test_file)
+            split_csvs(open(test_file), row_limit=1000000, output_name_template = myfile[:-4] + '%s.csv')
+    os.chdir(orig_dir)
+    return
+
+
+# process wide cache of the location fixture, see location_index
+_location_index = {'key': None}
+# when this process last refreshed the fixture, see refresh_locations
+_location_refresh = {'time': None}
+# levels of the location hierarchy, smallest first, and the id and name
+# columns for each level in the location fixture
+location_levels = ['awc', 'supervisor', 'block', 'district', 'state']
+_level_columns = {'awc': ('doc_id', 'awc_name'),
+                  'supervisor': ('supervisor_id', 'supervisor_name'),
+                  'block': ('block_id', 'block_name'),
+                  'district': ('district_id', 'district_name'),
+                  'state': ('state_id', 'state_name')}
+# location_type of an owner id and the fixture column those ids are in, in
+# the order used when an id is in more than one column
+usertypes = [('aww', 'doc_id'), ('ls', 'supervisor_id'), ('block', 'block_id'),
+             ('district', 'district_id'), ('state', 'state_id')]
+# fixture columns that get a prebuilt key to row lookup when compiled
+_location_key_cols = ['doc_id', 'awc_site_code', 'supervisor_id', 'block_id',
+                      'district_id', 'state_id']
+
+
+def _location_file_key(file_path):
+    '''Return (size, mtime) of a file so a replaced file can be spotted'''
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return (stat.st_size, stat.st_mtime)
+
+
+def _read_location_fixture(file_path):
+    '''
+    Read the location fixture with every text column as a category, using
+    the shared categories (see location_categories) for the name columns
+    '''
+    location_df = pd.read_csv(file_path, low_memory=False)
+    for col in location_df.columns[(location_df.dtypes == object).values]:
+        categorical = _to_categorical(location_df[col].values,
+                                      max_ratio=float('inf'))
+        if categorical is not None:
+            location_df[col] = categorical
+    location_df = optimize_df_memory(location_df)
+    return align_location_categories(location_df)
+
+
+# process wide cache of the shared location name categories
+_location_categories = {'key': None, 'categories': {}}
+# held while the shared categories are read, extended and saved
+_location_categories_lock = threading.RLock()
+
+
+def _location_categories_path():
+    '''Return where the shared location name categories are kept'''
+    return os.path.splitext(location_file_dir)[0] + '_categories.json'
+
+
+def location_categories():
+    '''
+    Return the shared categories of each location name column (awc_name,
+    supervisor_name, block_name, district_name and state_name).
+
+    Every location name column the location helpers return uses these as
+    its categories, so frames from different days, fixtures and scripts
+    concat, compare and groupby by integer code.  Names are only ever
+    added to the end, so codes never change.  The first set of names for a
+    column is sorted, later ones are sorted among themselves.
+
+    Returns
+    -------
+    categories : dictionary
+      List of names for each name column
+    '''
+    path = _location_categories_path()
+    key = (path, _location_file_key(path))
+    if _location_categories['key'] != key:
+        try:
+            with open(path, 'r') as f:
+                categories = json.load(f)
+        except (IOError, OSError, ValueError):
+            categories = {}
+        _location_categories.update({'key': key, 'categories': categories})
+    return _location_categories['categories']
+
+
+def align_location_categories(df):
+    '''
+    Give each location name column of df the shared categories (see
+    location_categories), adding any names that aren't in them yet.
+
+    Parameters
+    ----------
+    df : pandas dataframe
+      Dataframe with location name columns, as categories or strings
+
+    Returns
+    -------
+    df : pandas dataframe
+      df with its location name columns converted in place
+
+    The categories are read (again if the file changed), extended and saved
+    under a lock, and the file is replaced in one step, so threads never
+    hand out different codes for a name and readers never see a partly
+    written file.
+    '''
+    with _location_categories_lock:
+        categories = location_categories()
+        added = False
+        for level in location_levels:
+            col = _level_columns[level][1]
+            if col not in df.columns:
+                continue
+            known = categories.get(col, [])
+            if pd.api.types.is_categorical_dtype(df[col]):
+                names = df[col].cat.categories
+            else:
+                names = pd.Index(df[col].dropna().unique())
+            new_names = names.difference(pd.Index(known, dtype=object))
+            if len(new_names):
+                known = known + sorted(str(name) for name in new_names)
+                categories[col] = known
+                added = True
+            if pd.api.types.is_categorical_dtype(df[col]):
+                if not df[col].cat.categories.equals(pd.Index(known)):
+                    df[col] = df[col].cat.set_categories(known)
+            else:
+                df[col] = pd.Categorical(df[col], categories=known)
+        if added:
+            path = _location_categories_path()
+            _save_manifest(path, categories)
+            _location_categories['key'] = (path, _location_file_key(path))
+    return df
+
+
+def _code_map(from_col, to_col):
+    '''
+    Return an array giving the category code of to_col for each category
+    code of from_col (-1 if it never has a value), ie - the block of each
+    supervisor.
+    '''
+    from_codes = np.asarray(from_col.cat.codes)
+    to_codes = np.asarray(to_col.cat.codes)
+    output = np.full(len(from_col.cat.categories), -1, dtype=np.int32)
+    has_code = from_codes >= 0
+    output[from_codes[has_code]] = to_codes[has_code]
+    return output
+
+
+def _add_location_hierarchy(index):
+    '''
+    Add integer parent pointers and name codes for each location level to
+    the index.  Levels are numbered by the category codes of their id
+    column, so index['parents']['supervisor'][i] is the block code of
+    supervisor code i and index['name_codes']['block'][j] is the block_name
+    code of block code j.
+    '''
+    locations = index['locations']
+    index['parents'] = {}
+    index['name_codes'] = {}
+    levels = []
+    for level in location_levels:
+        if not pd.api.types.is_categorical_dtype(
+                locations.get(_level_columns[level][0])):
+            break
+        levels.append(level)
+    for child, parent in zip(levels[:-1], levels[1:]):
+        index['parents'][child] = _code_map(locations[_level_columns[child][0]],
+                                            locations[_level_columns[parent][0]])
+    for level in levels:
+        id_col, name_col = _level_columns[level]
+        if pd.api.types.is_categorical_dtype(locations.get(name_col)):
+            index['name_codes'][level] = _code_map(locations[id_col],
+                                                   locations[name_col])
+    return index
+
+
+def _compiled_location_dir():
+    '''Return where the precompiled copy of the location fixture is kept'''
+    return os.path.splitext(location_file_dir)[0] + '.cols'
+
+
+def compile_locations():
+    '''
+    Save a precompiled copy of the location fixture next to the csv, which
+    location_index loads instead of the csv while it is newer.  It holds the
+    fixture with text columns as category codes plus their name
+    dictionaries (see save_columnar), the key to row lookups for the id
+    columns and the parent pointers of the hierarchy, so loading it is just
+    memory mapping a few arrays.  refresh_locations calls this after each
+    download.
+
+    Returns
+    -------
+    path : string
+      Full path of the compiled folder
+    '''
+    logging.info('Compiling location fixture %s' % location_file_dir)
+    index = {'locations': _read_location_fixture(location_file_dir),
+             'lookups': {}}
+    _add_location_hierarchy(index)
+    path = _compiled_location_dir()
+    tmp_path = path + '.new'
+    save_columnar(index['locations'], tmp_path)
+    maps = {'lookups': {}, 'parents': {}, 'name_codes': {}}
+    for col in _location_key_cols:
+        if pd.api.types.is_categorical_dtype(index['locations'].get(col)):
+            maps['lookups'][col] = 'lookup.%s.npy' % col
+            _save_array(os.path.join(tmp_path, maps['lookups'][col]),
+                        _location_lookup(index, col)[1])
+    for kind in ('parents', 'name_codes'):
+        for level, values in index[kind].items():
+            maps[kind][level] = '%s.%s.npy' % (kind, level)
+            _save_array(os.path.join(tmp_path, maps[kind][level]), values)
+    with open(os.path.join(tmp_path, 'maps.json'), 'w') as f:
+        json.dump(maps, f, indent=1)
+    _remove_path(path)
+    os.rename(tmp_path, path)
+    logging.info('Saved compiled location fixture to %s' % path)
+    return path
+
+
+def _load_compiled_locations(path):
+    '''Load a folder written by compile_locations as a location index'''
+    locations = load_columnar(path, mmap_mode='r')
+    with open(os.path.join(path, 'maps.json'), 'r') as f:
+        maps = json.load(f)
+    index = {'locations': locations, 'lookups': {}}
+    for col, file_name in maps['lookups'].items():
+        index['lookups'][col] = (locations[col].cat.categories,
+                                 np.load(os.path.join(path, file_name),
+                                         mmap_mode='r'))
+    for kind in ('parents', 'name_codes'):
+        index[kind] = dict((level, np.load(os.path.join(path, file_name),
+                                           mmap_mode='r'))
+                           for level, file_name in maps[kind].items())
+    # the shared categories may have grown since it was compiled.  names are
+    # only added at the end, so codes only change if they were rebuilt
+    old_names = dict((col, locations[col].cat.categories)
+                     for col in locations.columns
+                     if pd.api.types.is_categorical_dtype(locations[col]))
+    align_location_categories(locations)
+    for level in index['name_codes']:
+        id_col, name_col = _level_columns[level]
+        old = old_names.get(name_col)
+        new = locations[name_col].cat.categories
+        if old is None or not new[:len(old)].equals(old):
+            index['name_codes'][level] = _code_map(locations[id_col],
+                                                   locations[name_col])
+    return index
+
+
+def location_index(refresh=False):
+    '''
+    Return the process wide location index that add_locations,
+    add_locations_by_username, num_by_location and add_usertype_from_id
+    share.  The location fixture is read the first time it is needed, then
+    kept in memory and only read again once the file changes (ie - after
+    refresh_locations).  If there is a compiled copy of the fixture (see
+    compile_locations) that is newer than the csv, it is loaded instead.
+
+    Parameters
+    ----------
+    refresh : boolean
+      Read the fixture again even if it hasn't changed (optional, defaults
+      to False)
+
+    Returns
+    -------
+    index : dictionary
+      'locations' is the fixture as a dataframe with text columns as
+      categories, 'lookups' holds the key to row maps built by
+      location_rows and 'parents'/'name_codes' the hierarchy (see
+      _add_location_hierarchy)
+    '''
+    csv_key = _location_file_key(location_file_dir)
+    compiled_path = _compiled_location_dir()
+    compiled_key = _location_file_key(os.path.join(compiled_path, 'maps.json'))
+    use_compiled = compiled_key is not None and (csv_key is None or
+                                                 compiled_key[1] >= csv_key[1])
+    if csv_key is None and not use_compiled:
+        raise IOError('Location file not found: %s' % location_file_dir)
+    key = (location_file_dir, csv_key, compiled_key if use_compiled else None)
+    if refresh or _location_index['key'] != key:
+        if use_compiled:
+            logging.info('Loading location index from %s' % compiled_path)
+            index = _load_compiled_locations(compiled_path)
+        else:
+            logging.info('Loading location index from %s' % location_file_dir)
+            index = {'locations': _read_location_fixture(location_file_dir),
+                     'lookups': {}}
+            _add_location_hierarchy(index)
+        index['key'] = key
+        _location_index.clear()
+        _location_index.update(index)
+    return _location_index
+
+
+def _location_lookup(index, key_col):
+    '''
+    Return the unique values of a fixture column and the fixture row for
+    each of them, building and keeping them in the index the first time.
+    If a value is in the fixture more than once the last row is used.
+    '''
+    if key_col not in index['lookups']:
+        column = index['locations'][key_col]
+        if pd.api.types.is_categorical_dtype(column):
+            codes = np.asarray(column.cat.codes)
+            uniques = column.cat.categories
+        else:
+            codes, uniques = pd.factorize(column)
+            uniques = pd.Index(uniques)
+        rows_by_code = np.full(len(uniques), -1, dtype=np.int64)
+        has_code = codes >= 0
+        rows_by_code[codes[has_code]] = np.flatnonzero(has_code)
+        index['lookups'][key_col] = (uniques, rows_by_code)
+    return index['lookups'][key_col]
+
+
+def location_rows(keys, key_col='doc_id', as_of=None):
+    '''
+    Find the row of the location fixture for each of a set of keys, using a
+    hashed lookup on the fixture column instead of a merge.
+
+    Parameters
+    ----------
+    keys : array like
+      Values to look up, ie - a column of owner_ids
+    key_col : string
+      Fixture column to look them up in (optional, defaults to doc_id)
+    as_of : datetime or string
+      Look the keys up in the fixture as it was at this date instead (see
+      location_snapshot_index), the rows are then rows of the snapshot
+      (optional, defaults to None for the current fixture)
+
+    Returns
+    -------
+    rows : numpy array
+      Row number in location_index()['locations'] for each key, -1 where
+      the key isn't in the fixture
+    '''
+    index = location_index() if as_of is None else location_snapshot_index(as_of)
+    uniques, rows_by_code = _location_lookup(index, key_col)
+    key_codes = _lookup_codes(uniques, keys)
+    return np.where(key_codes >= 0, rows_by_code[key_codes], -1)
+
+
+def _lookup_codes(uniques, keys):
+    '''
+    Return the position in uniques (a pandas index) of each key, -1 if not
+    there.  Categorical keys are looked up once per category.
+    '''
+    if pd.api.types.is_categorical_dtype(keys):
+        keys = pd.Categorical(keys)
+        key_codes = uniques.get_indexer(keys.categories)[keys.codes]
+        key_codes[keys.codes < 0] = -1
+        return key_codes
+    return uniques.get_indexer(np.asarray(keys))
+
+
+def location_columns(rows, column_names, index=None):
+    '''
+    Return a dataframe of fixture columns for rows from location_rows, with
+    blanks where the row is -1.
+
+    Parameters
+    ----------
+    rows : numpy array
+      Fixture rows, from location_rows
+    column_names : list of strings
+      Fixture columns to return
+    index : pandas index
+      Index to give the output (optional, defaults to None for a range)
+
+    Returns
+    -------
+    output : pandas dataframe
+      Location columns, one row for each of rows
+    '''
+    return _take_rows(location_index()['locations'], rows, column_names, index)
+
+
+def _take_rows(locations, rows, column_names, index=None):
+    '''Take column_names of locations at rows, blank where rows is -1'''
+    data = dict((col, pd.api.extensions.take(locations[col].values, rows,
+                                             allow_fill=True))
+                for col in column_names)
+    return pd.DataFrame(data, index=index, columns=column_names)
+
+
+def _state_mask(rows, state_list=None, locations=None):
+    '''
+    Return True for each location fixture row (from location_rows) that is
+    in one of the states in state_list, False for other rows and -1.  The
+    rows can be of another version of the fixture, given as locations.
+    '''
+    if state_list is None:
+        state_list = real_state_list
+    if locations is None:
+        locations = location_index()['locations']
+    state_names = locations['state_name']
+    allowed = np.append(np.asarray(state_names.cat.categories.isin(state_list)),
+                        False)
+    state_codes = np.asarray(state_names.cat.codes)
+    # code -1 (no row or no state) picks the False on the end of allowed
+    return allowed[np.where(rows >= 0, state_codes[rows], -1)]
+
+
+def real_state_ids(key_col='doc_id', state_list=None):
+    '''
+    Return the ids in a column of the location fixture whose location is in
+    a real state, to filter raw data on before adding locations, ie -
+    row_filter=[('owner_id', 'in', gf.real_state_ids())] in the csv loaders.
+
+    Parameters
+    ----------
+    key_col : string
+      Fixture column of the ids (optional, defaults to doc_id)
+    state_list : list of strings
+      State names to keep (optional, defaults to real_state_list, which is
+      settings.REAL_STATE_LIST if set)
+
+    Returns
+    -------
+    ids : pandas index
+      Unique ids in those states
+    '''
+    index = location_index()
+    column = index['locations'][key_col]
+    ids = column[_state_mask(np.arange(len(column)), state_list)].dropna()
+    return pd.Index(np.asarray(ids.unique()))
+
+
+def filter_real_states(df, id_col, key_col='doc_id', state_list=None):
+    '''
+    Return the rows of df whose id is at a location in a real state.  Only
+    the id column is looked up, no location columns are added.
+
+    Parameters
+    ----------
+    df : pandas dataframe
+      Dataframe to filter
+    id_col : string
+      Column of df with the ids, ie - owner_id or awc_id
+    key_col : string
+      Fixture column to look them up in (optional, defaults to doc_id)
+    state_list : list of strings
+      State names to keep (optional, defaults to real_state_list)
+
+    Returns
+    -------
+    df : pandas dataframe
+      Rows of df in those states
+    '''
+    return df[_state_mask(location_rows(df[id_col], key_col), state_list)]
 
 
 def add_locations(df, left_index_column=None, location_column_names=['doc_id',
                   'awc_name', 'block_name', 'district_name', 'state_name'],
-                  refresh_loc=False):
+                  refresh_loc=False, state_list=None):
     '''
     Add location columns to an existing dataframe (ie-awc/block/district/etc).
 
@@ -316,6 +2272,10 @@ def add_locations(df, left_index_column=None, location_column_names=['doc_id',
       block_name, district_name, state_name).  
     refresh_loc : boolean
       Will update the location fixture with the latest information if True
+    state_list : list of strings
+      Only keep rows at locations in these states, which is done before the
+      location columns are added (optional, defaults to None to keep all
+      rows, see real_state_list)
 
     Returns
     -------
@@ -323,83 +2283,206 @@ def add_locations(df, left_index_column=None, location_column_names=['doc_id',
       Dataframe with added location columns.
     '''
     if refresh_loc == True:
-        refresh_locations()
+        refresh_locations(once=True)
     try:
         orig_df_columns = df.columns.tolist()
-        known_dtype = {'awc_name':'object', 'block_name':'category',
-                       'district_name':'category', 'state_name':'category'}
         if location_column_names in orig_df_columns:
             logging.info('WARNING - column names to add already exist')
-        location_df = pd.read_csv(location_file_dir,
-                                  index_col=location_column_names[0],
-                                  usecols=location_column_names,
-                                  dtype=known_dtype)
-        location_df = optimize_df_memory(location_df)
         if left_index_column is not None:
-            df = pd.merge(df, location_df, left_on=left_index_column,
-                          right_index=True, how='left')
+            keys = df[left_index_column]
         else:
-            location_df = location_df.groupby(level=0).last()
-            df = pd.merge(df, location_df, left_index=True,
-                          right_index=True, how='left')
-        desired_columns = location_column_names[1:] + orig_df_columns
+            keys = df.index
+        rows = location_rows(keys, location_column_names[0])
+        if state_list is not None:
+            in_states = _state_mask(rows, state_list)
+            logging.info('Keeping %i of %i rows in real states' %
+                         (in_states.sum(), len(rows)))
+            df = df[in_states]
+            rows = rows[in_states]
+        location_df = location_columns(rows, location_column_names[1:],
+                                       df.index)
+        df = pd.concat([location_df, df], axis=1)
     except:
        logging.info('ERROR - unable to find location file, not adding \
                     location columns.  Looking in %s', location_file_dir)
        raise
-    return df[desired_columns]
+    return df
+
+
+def username_site_codes(usernames, numeric=True):
+    '''
+    Turn AWW usernames into the awc site codes they stand for by dropping a
+    leading zero.  The usernames are factorized first, so the string work is
+    done once per user rather than once per form.
+
+    Parameters
+    ----------
+    usernames : pandas series
+      Usernames, as strings/objects or categories
+    numeric : boolean
+      Return the site codes as numbers rather than strings, with NaN for
+      usernames that aren't numbers (optional, defaults to True)
+
+    Returns
+    -------
+    codes : numpy array
+      Position in site_codes of the username of each row, -1 for blanks
+    site_codes : numpy array
+      Site code for each unique username
+    '''
+    if pd.api.types.is_categorical_dtype(usernames):
+        codes = np.asarray(usernames.cat.codes)
+        uniques = usernames.cat.categories
+    else:
+        codes, uniques = pd.factorize(usernames)
+    text = pd.Series(np.asarray(uniques, dtype=object)).astype(str)
+    site_codes = text.where(~text.str.startswith('0'), text.str[1:])
+    if numeric:
+        site_codes = pd.to_numeric(site_codes, errors='coerce')
+    return codes, site_codes.values
+
+
+def _username_rows(usernames):
+    '''
+    Location fixture row of each username, through the site code of each
+    unique username (see username_site_codes).  Returns the codes of the
+    usernames, the row of each unique username and the row of each entry,
+    -1 where there's no location.
+    '''
+    locations = location_index()['locations']
+    numeric = pd.api.types.is_numeric_dtype(locations['awc_site_code'])
+    codes, site_codes = username_site_codes(usernames, numeric)
+    user_rows = location_rows(site_codes, 'awc_site_code')
+    rows = np.where(codes >= 0, user_rows[codes], -1)
+    return codes, user_rows, rows
+
+
+def username_location_rows(usernames, state_list=None):
+    '''
+    Find the location of each AWW username without adding any columns, ie -
+    to aggregate forms with location_rollup.
+
+    Parameters
+    ----------
+    usernames : pandas series
+      Usernames, as strings/objects or categories
+    state_list : list of strings
+      Treat locations outside these states as missing (optional, defaults
+      to None to keep all, see real_state_list)
+
+    Returns
+    -------
+    rows : numpy array
+      Row in location_index()['locations'] for each username, -1 if it isn't
+      in the fixture (or is outside state_list)
+    '''
+    rows = _username_rows(usernames)[2]
+    if state_list is not None:
+        rows = np.where(_state_mask(rows, state_list), rows, -1)
+    return rows
 
 
 def add_locations_by_username(df, location_column_names=['awc_site_code',
                   'awc_name', 'block_name', 'district_name', 'state_name'],
-                  refresh_loc=False):
+                  refresh_loc=False, report_out=False, state_list=None):
     '''
     Similar to add_locations, but for forms where location_id isn't available
     but 'username' is.  Takes username and adds location columns to an existing
     for locations (ie-awc/block/district/etc).
 
+    Each unique username is turned into a site code (see username_site_codes)
+    and looked up in the awc_site_code column of the location index, as a
+    number if the fixture's site codes are numbers.  Rows then take the
+    location of their username, so there is no string keyed merge.  The
+    output is the same as the merge this replaced: a new range index, a
+    username_fmt column, awc_site_code as text and the location columns in
+    the order asked for.
+
     Parameters
     ----------
     df : pandas dataframe
       Dataframe to add location columns to
     location_column_names : list of strings
       Location columns to add.  (Optional, defaults to awc_site_code, awc_name,
-      block_name, district_name, state_name).  NEED awc_site_code to match on
-      username
+      block_name, district_name, state_name).
     refresh_loc : boolean
       Will update the location fixture with the latest information if True
+    report_out : boolean
+      (Optional) Also return the usernames that didn't match a location.
+      False is default
+    state_list : list of strings
+      Only keep rows at locations in these states, which is done before the
+      location columns are added (optional, defaults to None to keep all
+      rows, see real_state_list)
 
     Returns
     -------
     output : pandas dataframe
-      Dataframe with added location columns.
+      Dataframe with username_fmt (the username without a leading zero) and
+      the location columns added, with a new range index.  Rows dropped by
+      state_list leave gaps in the range, as filtering after a merge would.
+    unmatched : pandas series
+      Number of rows for each username without a location, most rows first
+      (only included if report_out=True)
     '''
     if refresh_loc == True:
-        refresh_locations()
+        refresh_locations(once=True)
     try:
         orig_df_columns = df.columns.tolist()
-        known_dtype = {'awc_name':'object', 'block_name':'category',
-                       'district_name':'category', 'state_name':'category'}
         if location_column_names in orig_df_columns:
             logging.info('WARNING - column names to add already exist')
-        location_df = pd.read_csv(location_file_dir,
-                                  usecols=location_column_names,
-                                  dtype=known_dtype)
-        location_df = optimize_df_memory(location_df)
-        if 'awc_site_code' not in location_column_names:
-            logging.info('WARNING - awc_site_code required in location column list')
-        location_df['awc_site_code'] = location_df['awc_site_code'].astype(str)
-        
-        # format the username appropriately, dropping any leading zeros
-        df['username'] = df['username'].astype(str)
-        df['username_fmt'] = df['username'].apply(lambda x: x[1:] if x[0] == '0' else x)
-
-        # add location information for each user        
-        output_df = pd.merge(df, location_df, left_on='username_fmt', right_on='awc_site_code', how='left')
+        locations = location_index()['locations']
+        # the output has a new range index, like a merge would give it
+        df = df.reset_index(drop=True)
+        orig_usernames = df['username']
+        codes, user_rows, rows = _username_rows(orig_usernames)
+        user_text = username_site_codes(orig_usernames, numeric=False)[1]
+        # count unmatched users before any rows are dropped
+        user_counts = np.bincount(codes[codes >= 0], minlength=len(user_rows))
+        if state_list is not None:
+            in_states = _state_mask(rows, state_list)
+            logging.info('Keeping %i of %i rows in real states' %
+                         (in_states.sum(), len(rows)))
+            df = df[in_states]
+            rows = rows[in_states]
+            codes = codes[in_states]
+        # username without the leading zero, the text the site code matched
+        df = df.assign(username_fmt=pd.api.extensions.take(
+            np.asarray(user_text, dtype=object), codes, allow_fill=True))
+        location_df = location_columns(
+            rows, [col for col in location_column_names
+                   if col in locations.columns], df.index)
+        if 'awc_site_code' in location_df.columns:
+            # site codes are returned as text whatever type the fixture has
+            matched = user_rows >= 0
+            user_sites = np.full(len(user_rows), np.nan, dtype=object)
+            user_sites[matched] = locations['awc_site_code'].values[
+                user_rows[matched]].astype(str)
+            location_df['awc_site_code'] = pd.api.extensions.take(
+                user_sites, codes, allow_fill=True)
+        output_df = pd.concat([df, location_df], axis=1)
+
+        # report users that aren't in the fixture
+        if pd.api.types.is_categorical_dtype(orig_usernames):
+            uniques = orig_usernames.cat.categories
+        else:
+            uniques = pd.unique(orig_usernames.dropna())
+        missing = (user_rows < 0) & (user_counts > 0)
+        unmatched = pd.Series(user_counts[missing],
+                              index=np.asarray(uniques)[missing],
+                              name='num_rows').sort_values(ascending=False)
+        if len(unmatched):
+            logging.info('%i of %i usernames (%i rows) not matched to a '
+                         'location, ie - %s' %
+                         (len(unmatched), (user_counts > 0).sum(),
+                          unmatched.sum(), ', '.join(
+                              str(user) for user in unmatched.index[:5])))
     except:
        logging.info('ERROR - unable to find location file, not adding '
                     'location columns.  Looking in %s', location_file_dir)
        raise
+    if report_out:
+        return output_df, unmatched
     return output_df
 
 
@@ -422,11 +2505,8 @@ def num_by_location(column_name, filter_name):
       Number in input dataframe that match the specified filter
     '''
     try:
-        known_dtype = {'awc_name':'object', 'block_name':'category',
-                       'district_name':'category', 'state_name':'category'}
-        location_df = pd.read_csv(location_file_dir, index_col='doc_id', low_memory=False, dtype=known_dtype)
-        location_df = optimize_df_memory(location_df)
-        num_out = location_df[location_df[column_name] == filter_name].count()[column_name]
+        location_df = location_index()['locations']
+        num_out = (location_df[column_name] == filter_name).sum()
     except:
         logging.info('ERROR - unable to find location file, not adding \
                      location columns.  Looking in %s', location_file_dir)
@@ -450,23 +2530,161 @@ def folder_name_to_location(full_name):
       Full location name based on suffix lookup.
     '''
     suffix = full_name[full_name.find('-')+1:]
-    lookup_dict = {'ap': 'Andhra Pradesh', 'bihar': 'Bihar',
-                   'ch': 'Chhattisgarh', 'jh': 'Jharkhand',
-                   'mp': 'Madhya Pradesh', 'raj': 'Rajasthan',
-                   'up': 'Uttar Pradesh', 'mah': 'Maharashtra',
-                   'user': 'User', 'test': 'Test',
-                   'ap2': 'Andhra Pradesh2'}
-    if suffix in lookup_dict:
-        return lookup_dict[suffix]
+    if suffix in folder_locations:
+        return folder_locations[suffix]
     else:
         return 'None'
 
 
-def add_usertype_from_id(df, df_id_col):
+def _catalog_path(root_dir):
+    '''Return where the dataset catalog of a root directory is kept'''
+    return os.path.join(root_dir, cache_dir_name, 'catalog.json')
+
+
+def _catalog_file_entry(file_path, stat):
+    '''Return the catalog entry of one csv file, scanning it once'''
+    index = csv_index(file_path)
+    with open(file_path, 'rb') as f:
+        header = f.read(index['header_end'])
+    file_name = os.path.basename(file_path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime,
+            'nrows': index['nrows'],
+            'dataset_type': re.sub(r'_?\d*\.csv$', '', file_name).lower(),
+            'schema': hashlib.sha1(header.strip()).hexdigest()[:16]}
+
+
+def dataset_catalog(root_dir, regex=None, refresh=True):
+    '''
+    Return a catalog of the data folders in a root directory, one row per
+    folder with its state, files, size, row count and schema fingerprint.
+
+    The catalog is kept in the cache directory of root_dir.  On refresh only
+    files whose size or modification time changed since the last call are
+    read again (once, to count rows with csv_index and hash the header), so
+    scripts can pick folders by state or type and balance work by size
+    without going through the data each run.
+
+    Parameters
+    ----------
+    root_dir : string
+      Full path to directory holding one folder per dataset, ie - xxx-mp
+    regex : regex object
+      Regex used to specify filenames of csv files to catalog (optional,
+      defaults to all csv files)
+    refresh : boolean
+      Look for new or changed files (optional, defaults to True).  If False
+      the saved catalog is used as is.
+
+    Returns
+    -------
+    catalog : pandas dataframe
+      Indexed by folder name, with columns location, path, files (list of
+      file names), num_files, size (bytes), nrows, dataset_types (sorted
+      list) and schema (fingerprint of the headers of all files, so folders
+      with the same columns share it).  Folders without matching files are
+      left out.
+    '''
+    if regex is None:
+        regex = re.compile(r'.*\.csv$')
+    catalog_path = _catalog_path(root_dir)
+    saved = _load_manifest(catalog_path)
+    pattern = regex.pattern
+    folders = saved.get('folders', {}) if saved.get('regex') == pattern else {}
+    if refresh:
+        new_folders = {}
+        num_read = 0
+        for folder in sorted(os.listdir(root_dir)):
+            folder_path = os.path.join(root_dir, folder)
+            if folder == cache_dir_name or not os.path.isdir(folder_path):
+                continue
+            old_files = folders.get(folder, {}).get('files', {})
+            files = {}
+            for file_name in data_file_list(folder_path, regex):
+                file_path = os.path.join(folder_path, file_name)
+                stat = os.stat(file_path)
+                entry = old_files.get(file_name)
+                if (entry is None or entry['size'] != stat.st_size
+                        or entry['mtime'] != stat.st_mtime):
+                    entry = _catalog_file_entry(file_path, stat)
+                    num_read += 1
+                files[file_name] = entry
+            if files:
+                new_folders[folder] = {
+                    'location': folder_name_to_location(folder),
+                    'files': files}
+        if new_folders != folders:
+            logging.info('Dataset catalog of %s: %i folders, %i files read'
+                         % (root_dir, len(new_folders), num_read))
+            try:
+                if not os.path.exists(os.path.dirname(catalog_path)):
+                    os.makedirs(os.path.dirname(catalog_path))
+                _save_manifest(catalog_path, {'regex': pattern,
+                                              'folders': new_folders})
+            except (IOError, OSError) as err:
+                logging.warning('Could not save dataset catalog %s: %s'
+                                % (catalog_path, err))
+        folders = new_folders
+    rows = []
+    for folder in sorted(folders):
+        files = folders[folder]['files']
+        names = sorted(files)
+        schemas = sorted(set(files[name]['schema'] for name in names))
+        rows.append({
+            'folder': folder,
+            'location': folders[folder]['location'],
+            'path': os.path.join(root_dir, folder),
+            'files': names,
+            'num_files': len(names),
+            'size': sum(files[name]['size'] for name in names),
+            'nrows': sum(files[name]['nrows'] for name in names),
+            'dataset_types': sorted(set(files[name]['dataset_type']
+                                        for name in names)),
+            'schema': hashlib.sha1(','.join(schemas).encode()
+                                   ).hexdigest()[:16]})
+    columns = ['folder', 'location', 'path', 'files', 'num_files', 'size',
+               'nrows', 'dataset_types', 'schema']
+    return pd.DataFrame(rows, columns=columns).set_index('folder')
+
+
+def _usertype_lookup(index, precedence):
+    '''
+    Return a pandas index of every id in the location fixture and the
+    location_type code of each, keeping the first type in precedence for
+    ids that are in more than one column.  Kept in the index once built.
+    '''
+    key = ('usertype',) + tuple(precedence)
+    if key not in index['lookups']:
+        locations = index['locations']
+        type_names = [name for name, col in usertypes]
+        type_cols = dict(usertypes)
+        ids = []
+        types = []
+        for name in precedence:
+            column = locations.get(type_cols[name])
+            if column is None:
+                continue
+            if pd.api.types.is_categorical_dtype(column):
+                uniques = column.cat.categories
+            else:
+                uniques = column.dropna().unique()
+            ids.append(np.asarray(uniques, dtype=object))
+            types.append(np.full(len(uniques), type_names.index(name),
+                                 dtype=np.int8))
+        ids = pd.Index(np.concatenate(ids))
+        first = ~ids.duplicated(keep='first')
+        index['lookups'][key] = (ids[first], np.concatenate(types)[first])
+    return index['lookups'][key]
+
+
+def add_usertype_from_id(df, df_id_col, precedence=None):
     '''
     Based on id location column (like commcare_location_id),
     add a new column that shows id location type (aww/ls/block/district/state)
 
+    Ids are looked up in a single id to type table built once from the
+    location index.  An id that is in more than one level of the fixture
+    gets the first type in precedence.
+
     Parameters
     ----------
     df : pandas dataframe
@@ -475,32 +2693,177 @@ def add_usertype_from_id(df, df_id_col):
     df_id_col : string
       Name of column to use for location, ie commcare_location_id or owner_id
 
+    precedence : list of strings
+      Order of types to use for ids in more than one level (optional,
+      defaults to aww, ls, block, district, state)
+
     Returns
     -------
     df : pandas dataframe
-      Dataframe with 'location_type' column added.
+      Dataframe with 'location_type' column added, as a category with
+      aww/ls/block/district/state categories (blank if id isn't found)
     '''
     try:
-        col_names = ['doc_id', 'supervisor_id', 'block_id',
-                     'district_id', 'state_id']
-        known_dtype = {'awc_name':'object', 'block_name':'category',
-                       'district_name':'category', 'state_name':'category'}
-        loc_df = pd.read_csv(location_file_dir, usecols=col_names, dtype=known_dtype)
-        loc_df = optimize_df_memory(loc_df)
-        aww_series = pd.Series('aww', loc_df['doc_id'].unique())
-        ls_series = pd.Series('ls', loc_df['supervisor_id'].unique())
-        block_series = pd.Series('block', loc_df['block_id'].unique())
-        district_series = pd.Series('district', loc_df['district_id'].unique())
-        state_series = pd.Series('state', loc_df['state_id'].unique())
-        loc_series = pd.concat([aww_series, ls_series, block_series,
-                                district_series, state_series])
-        df['location_type'] = df[df_id_col].map(loc_series)
+        if precedence is None:
+            precedence = [name for name, col in usertypes]
+        ids, types = _usertype_lookup(location_index(), precedence)
+        key_codes = _lookup_codes(ids, df[df_id_col])
+        df['location_type'] = pd.Categorical.from_codes(
+            np.where(key_codes >= 0, types[key_codes], -1),
+            categories=[name for name, col in usertypes])
     except:
         logging.info('ERROR - unable to find location file, not adding \
                      location_type column.  Looking in %s', location_file_dir)
     return df
 
 
+def _reduce_to_parent(codes, size, sums, counts, mins, maxs):
+    '''
+    Aggregate arrays for one level of the hierarchy (or for rows) up to the
+    next one.  codes gives the parent of each entry, -1 entries are dropped.
+    sums and counts add, mins and maxs (if not None) take the min/max.
+    '''
+    keep = codes >= 0
+    codes = codes[keep]
+    output = [np.vstack([np.bincount(codes, weights=values[keep],
+                                     minlength=size) for values in sums]),
+              np.vstack([np.bincount(codes, weights=values[keep],
+                                     minlength=size) for values in counts]),
+              None, None]
+    if mins is not None:
+        output[2] = np.full((len(mins), size), np.inf)
+        output[3] = np.full((len(maxs), size), -np.inf)
+        for i in range(len(mins)):
+            np.fmin.at(output[2][i], codes, mins[i][keep])
+            np.fmax.at(output[3][i], codes, maxs[i][keep])
+    return output
+
+
+def location_rollup(rows, values, aggs=('sum',), ratios=None, levels=None,
+                    as_of=None):
+    '''
+    Aggregate values up every level of the location hierarchy at once.
+    Rows are added up to their awc with np.bincount, then each level is
+    added up to the next through the parent pointers in the location index,
+    so the whole frame is only grouped once whatever the number of levels.
+
+    Parameters
+    ----------
+    rows : numpy array
+      Location fixture row of each value, from location_rows.  Rows that
+      are -1 are left out.
+    values : pandas dataframe
+      Numeric or boolean columns to aggregate, one row per entry in rows
+    aggs : list of strings
+      Any of sum, count (of non-blank values), mean, min and max (optional,
+      defaults to sum)
+    ratios : dictionary
+      Name of a ratio column and a (numerator, denominator) tuple of columns
+      in values, ie {'home_pct': ('home_delivery', 'delivery')}.  Each ratio
+      is the sum of the numerator over the sum of the denominator at each
+      location (optional, defaults to None)
+    levels : list of strings
+      Levels of location_levels to return (optional, defaults to None for
+      all of them)
+    as_of : datetime or string
+      Roll up through the hierarchy as it was at this date, for rows found
+      with location_rows(..., as_of=as_of) (optional, defaults to None for
+      the current fixture)
+
+    Returns
+    -------
+    output : pandas dataframe
+      One row for each location with data, indexed by (level, location_id).
+      Columns are the id and name columns of the location and the levels
+      above it (ie - block_id, block_name, district_id ...), num_rows,
+      <column>_<agg> for each column and agg, and the ratios.  Sums of
+      integer or boolean columns are integers, other aggs are floats.
+    '''
+    index = location_index() if as_of is None else location_snapshot_index(as_of)
+    locations = index['locations']
+    chain = ['awc']
+    while chain[-1] in index['parents']:
+        chain.append(location_levels[location_levels.index(chain[-1]) + 1])
+    if levels is None:
+        levels = chain
+    missing = [level for level in levels if level not in chain]
+    if missing:
+        raise ValueError('No hierarchy in location fixture for %s' % missing)
+    need_min = 'min' in aggs or 'max' in aggs
+    ratios = ratios or {}
+
+    # rows up to awcs
+    rows = np.asarray(rows)
+    awc_codes = np.asarray(locations[_level_columns['awc'][0]].cat.codes)
+    codes = np.where(rows >= 0, awc_codes[rows], -1)
+    columns = list(values.columns)
+    # sums of integer and boolean columns are returned as integers
+    integral = [values[col].dtype.kind in 'biu' for col in columns]
+    data = [np.asarray(values[col], dtype=float) for col in columns]
+    sums = [np.ones(len(rows))] + [np.nan_to_num(col) for col in data]
+    counts = [(~np.isnan(col)).astype(float) for col in data]
+    mins = maxs = data if need_min else None
+    level_data = {}
+    level = 'awc'
+    while True:
+        size = len(locations[_level_columns[level][0]].cat.categories)
+        sums, counts, mins, maxs = _reduce_to_parent(codes, size, sums, counts,
+                                                     mins, maxs)
+        level_data[level] = (sums, counts, mins, maxs)
+        if level == chain[-1]:
+            break
+        codes = np.asarray(index['parents'][level])
+        level = chain[chain.index(level) + 1]
+
+    frames = []
+    for level in levels:
+        sums, counts, mins, maxs = level_data[level]
+        level_codes = np.flatnonzero(sums[0] > 0)
+        frame = pd.DataFrame(index=pd.Index(
+            locations[_level_columns[level][0]].cat.categories[level_codes],
+            name='location_id'))
+        codes = level_codes
+        for ancestor in chain[chain.index(level):]:
+            id_col, name_col = _level_columns[ancestor]
+            has_code = codes >= 0
+            frame[id_col] = pd.Categorical.from_codes(
+                codes, locations[id_col].cat.categories)
+            if ancestor in index['name_codes']:
+                name_codes = np.asarray(index['name_codes'][ancestor])
+                frame[name_col] = pd.Categorical.from_codes(
+                    np.where(has_code, name_codes[codes], -1),
+                    locations[name_col].cat.categories)
+            if ancestor in index['parents']:
+                parents = np.asarray(index['parents'][ancestor])
+                codes = np.where(has_code, parents[codes], -1)
+        frame['num_rows'] = sums[0][level_codes].astype(np.int64)
+        for i, col in enumerate(columns):
+            col_sum = sums[i + 1][level_codes]
+            col_count = counts[i][level_codes]
+            for agg in aggs:
+                if agg == 'sum':
+                    frame['%s_sum' % col] = (col_sum.astype(np.int64)
+                                             if integral[i] else col_sum)
+                elif agg == 'count':
+                    frame['%s_count' % col] = col_count.astype(np.int64)
+                elif agg == 'mean':
+                    frame['%s_mean' % col] = col_sum / np.where(
+                        col_count > 0, col_count, np.nan)
+                elif agg in ('min', 'max'):
+                    extreme = (mins if agg == 'min' else maxs)[i][level_codes]
+                    frame['%s_%s' % (col, agg)] = np.where(
+                        np.isinf(extreme), np.nan, extreme)
+                else:
+                    raise ValueError('Unknown rollup agg %s' % agg)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for name, (numerator, denominator) in ratios.items():
+                frame[name] = (
+                    sums[columns.index(numerator) + 1][level_codes] /
+                    sums[columns.index(denominator) + 1][level_codes])
+        frames.append(frame)
+    return pd.concat(frames, keys=levels, names=['level', 'location_id'])
+
+
 def start_logging(output_dir):
     '''
     Starts a log file.  logging.debug to a file, logging.info to the console
@@ -569,9 +2932,149 @@ def get_credentials(file_path, key):
     return user, password
 
 
-def download_ucr(url, user, password, new_file_name, target_dir):
+_http_sessions = {}
+_http_host_limits = {}
+_http_metrics = []
+_http_lock = threading.Lock()
+
+
+def http_session(user, password):
+    '''
+    Return the shared requests session for a set of credentials, creating it
+    the first time.  Sessions keep up to HTTP_POOL_SIZE connections per host
+    open between requests, so downloads after the first don't pay for a new
+    connection and TLS handshake.
+    '''
+    with _http_lock:
+        key = (user, password)
+        if key not in _http_sessions:
+            session = requests.Session()
+            session.auth = HTTPBasicAuth(user, password)
+            adapter = HTTPAdapter(pool_connections=http_pool_size,
+                                  pool_maxsize=http_pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _http_sessions[key] = session
+        return _http_sessions[key]
+
+
+def _host_limit(url):
+    '''Return the semaphore limiting requests to the host of url'''
+    host = requests.utils.urlparse(url).netloc
+    with _http_lock:
+        if host not in _http_host_limits:
+            _http_host_limits[host] = threading.BoundedSemaphore(http_host_limit)
+        return host, _http_host_limits[host]
+
+
+def http_download(url, user, password, out_file, chunk_size=None):
+    '''
+    Download url into an open file through the shared session, streaming it
+    in chunks.  At most HTTP_HOST_LIMIT downloads run against one host at a
+    time, others wait for a free slot.  The timing of each request is kept,
+    see http_metrics.  Raises an exception for an http error status, or if
+    connecting takes more than HTTP_CONNECT_TIMEOUT seconds or the server
+    sends nothing for HTTP_READ_TIMEOUT seconds, so a stalled download fails
+    (and can be retried) rather than hanging its worker.
+
+    Parameters
+    ----------
+    url : string
+      URL to download
+    user : string
+      Username
+    password : string
+      Password
+    out_file : file object
+      Open binary file to write the response to
+    chunk_size : integer
+      Bytes read at a time (optional, defaults to 1MB)
+
+    Returns
+    -------
+    num_bytes : integer
+      Size of the download
+    '''
+    chunk_size = download_chunk_size if chunk_size is None else chunk_size
+    session = http_session(user, password)
+    host, limit = _host_limit(url)
+    metric = {'url': url, 'host': host, 'status': None, 'num_bytes': 0,
+              'started': time.time()}
+    limit.acquire()
+    try:
+        request_start = time.time()
+        metric['wait_secs'] = request_start - metric['started']
+        try:
+            r = session.get(url, stream=True,
+                            timeout=(http_connect_timeout, http_read_timeout))
+            try:
+                metric['status'] = r.status_code
+                metric['first_byte_secs'] = time.time() - request_start
+                r.raise_for_status()
+                for chunk in r.iter_content(chunk_size=chunk_size):
+                    out_file.write(chunk)
+                    metric['num_bytes'] += len(chunk)
+            finally:
+                r.close()
+        finally:
+            metric['secs'] = time.time() - request_start
+            with _http_lock:
+                _http_metrics.append(metric)
+    finally:
+        limit.release()
+    return metric['num_bytes']
+
+
+def http_metrics(reset=False):
+    '''
+    Return the timing of every request made with http_download.
+
+    Parameters
+    ----------
+    reset : boolean
+      Forget the requests returned (optional, defaults to False)
+
+    Returns
+    -------
+    metrics : pandas dataframe
+      One row per request with url, host, status, num_bytes, started (unix
+      time), wait_secs (waiting for a free slot for the host),
+      first_byte_secs (until the response headers came back) and secs (the
+      whole request, without the wait)
+    '''
+    with _http_lock:
+        metrics = list(_http_metrics)
+        if reset:
+            del _http_metrics[:]
+    return pd.DataFrame(metrics, columns=['url', 'host', 'status', 'num_bytes',
+                                          'started', 'wait_secs',
+                                          'first_byte_secs', 'secs'])
+
+
+def _move_into_place(tmp_path, file_path):
+    '''
+    Rename a finished file to its final name, replacing any old file in one
+    step (python 2 has no os.replace, so there the old file is removed first)
+    '''
+    if hasattr(os, 'replace'):
+        os.replace(tmp_path, file_path)
+        return
+    if os.path.isfile(file_path):
+        os.remove(file_path)
+    os.rename(tmp_path, file_path)
+
+
+def download_ucr(url, user, password, new_file_name, target_dir, ingest=None):
     '''Downloads a UCR file if given the url, credentials, and full location to
-    save the filename.  Assumes is only one file in the downloaded UCR
+    save the filename.  Assumes is only one file in the downloaded UCR.
+    The file only gets its new name once it is complete, so an interrupted
+    download never leaves a partial file behind that looks finished.  Raises
+    an exception if the download fails.
+
+    The response is streamed in chunks to a spooled temp file (a zip can
+    only be read once it is all there) and the member is streamed from it
+    to the new file, so memory use stays at a few megabytes whatever the
+    size of the export.  Goes through the shared session, see http_download.
     
     Parameters
     ----------
@@ -586,52 +3089,526 @@ def download_ucr(url, user, password, new_file_name, target_dir):
       What you want to call your new file, including the file extension
     target_dir : string
       Path to the directory where you want to extract the file
+    ingest : function
+      Called with the full path of the new file once it is in place, ie -
+      to save it with ingest_csv (optional, defaults to None).  If it fails
+      the file is kept and a warning logged.
     
     Returns
     -------
-    None
+    num_bytes : integer
+      Size of the download
     '''
     # go to the right place in commcare and download the file
-    r = requests.get(url, auth=HTTPBasicAuth(user, password))
+    spool = tempfile.SpooledTemporaryFile(max_size=download_spool_size)
     try:
-        r.raise_for_status()
-    except Exception as exc:
-        print('There was a problem: %s' % (exc))
-    logging.info('Download complete')
-
-    # its a zipfile, so unpack and save in target_dir
-    logging.info('Unzipping file...')
-    z = zipfile.ZipFile(BytesIO(r.content))
-    cur_file_name = z.extract(z.namelist()[0], target_dir)
-    shutil.move(cur_file_name, os.path.join(target_dir, new_file_name))
+        num_bytes = http_download(url, user, password, spool)
+        logging.info('Download complete')
+
+        # its a zipfile, so unpack to a temp file of its own in target_dir,
+        # so downloads running at the same time don't collide
+        logging.info('Unzipping file...')
+        spool.seek(0)
+        z = zipfile.ZipFile(spool)
+        fd, tmp_path = tempfile.mkstemp(prefix='.download-', dir=target_dir)
+        try:
+            with os.fdopen(fd, 'wb') as out_file:
+                member = z.open(z.namelist()[0])
+                shutil.copyfileobj(member, out_file, download_chunk_size)
+                member.close()
+            _move_into_place(tmp_path, os.path.join(target_dir, new_file_name))
+        except Exception:
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+            raise
+        finally:
+            z.close()
+    finally:
+        spool.close()
     logging.info('Moved new file %s to %s directory' % (new_file_name, target_dir))
-    z.close()
+    if ingest is not None:
+        try:
+            ingest(os.path.join(target_dir, new_file_name))
+        except Exception as err:
+            logging.warning('Could not ingest %s: %s' % (new_file_name, err))
+    return num_bytes
+
+
+def _download_job(args):
+    '''
+    Download one file for download_ucr_files, retrying with exponential
+    backoff.  Returns the file name, bytes downloaded and the error of the
+    last try (None if it worked).
+    '''
+    (url, user, password, new_file_name, target_dir, retries, backoff,
+     ingest) = args
+    for attempt in range(retries + 1):
+        try:
+            num_bytes = download_ucr(url, user, password, new_file_name,
+                                     target_dir, ingest)
+            return new_file_name, num_bytes, None
+        except Exception as err:
+            if attempt == retries:
+                logging.error('Giving up on %s: %s' % (new_file_name, err))
+                return new_file_name, 0, str(err)
+            wait = backoff * 2 ** attempt
+            logging.warning('Download of %s failed (%s), retry %i of %i in '
+                            '%0.1f seconds' % (new_file_name, err, attempt + 1,
+                                               retries, wait))
+            time.sleep(wait)
+
+
+def download_ucr_files(jobs, user, password, num_workers=None, retries=None,
+                       backoff=None, overwrite=False, ingest=None):
+    '''
+    Download several UCR files at once with a pool of threads sharing one
+    session (see http_download).  Unless overwrite is set, files that are
+    already in their target directory are skipped, so running the same
+    jobs again after an interruption or failure resumes where it stopped.
+    Each file is retried with exponential backoff and only gets its name
+    once complete (see download_ucr).  Progress in files and bytes per
+    second is logged as files finish.
+
+    Parameters
+    ----------
+    jobs : list of tuples
+      (url, new_file_name, target_dir) of each file to download
+    user : string
+      Username
+    password : string
+      Password
+    num_workers : integer
+      Number of downloads at a time (optional, defaults to DOWNLOAD_WORKERS
+      in settings or 4)
+    retries : integer
+      Number of times to retry a failed download (optional, defaults to
+      DOWNLOAD_RETRIES in settings or 3)
+    backoff : float
+      Seconds to wait before the first retry, doubled for each one after
+      (optional, defaults to DOWNLOAD_BACKOFF in settings or 5)
+    overwrite : boolean
+      Download files that are already there again (optional, defaults to
+      False)
+    ingest : function
+      Called with the path of each new file (optional, see download_ucr)
+
+    Returns
+    -------
+    failed : dictionary
+      Error message by file name for the files that couldn't be downloaded
+    '''
+    num_workers = download_workers if num_workers is None else num_workers
+    retries = download_retries if retries is None else retries
+    backoff = download_backoff if backoff is None else backoff
+    todo = [(url, user, password, new_file_name, target_dir, retries, backoff,
+             ingest)
+            for url, new_file_name, target_dir in jobs
+            if overwrite or
+            not os.path.isfile(os.path.join(target_dir, new_file_name))]
+    if len(todo) < len(jobs):
+        logging.info('%i of %i files already downloaded' %
+                     (len(jobs) - len(todo), len(jobs)))
+    failed = {}
+    if not todo:
+        return failed
+    num_workers = max(1, min(num_workers, len(todo)))
+    logging.info('Downloading %i files with %i workers' %
+                 (len(todo), num_workers))
+    start = time.time()
+    num_done = 0
+    num_bytes = 0
+    pool = multiprocessing.pool.ThreadPool(num_workers)
+    try:
+        for new_file_name, file_bytes, err in pool.imap_unordered(_download_job, todo):
+            num_done += 1
+            num_bytes += file_bytes
+            if err is not None:
+                failed[new_file_name] = err
+            elapsed = max(time.time() - start, 1e-6)
+            logging.info('%i of %i files done (%i failed), %0.2f files/s, '
+                         '%0.2f MB/s' % (num_done, len(todo), len(failed),
+                                         num_done / elapsed,
+                                         num_bytes / elapsed / 1024 ** 2))
+    finally:
+        pool.close()
+        pool.join()
+    return failed
+
+def _unique_by(df, key_col, cols):
+    '''Return cols of df indexed by key_col, keeping the last row per key'''
+    cols = [col for col in cols if col in df.columns]
+    output = df[[key_col] + cols].drop_duplicates(key_col, keep='last')
+    return output.set_index(key_col).astype(object).fillna('')
+
+
+def diff_locations(old_df, new_df):
+    '''
+    Compare two versions of the location fixture.
+
+    Parameters
+    ----------
+    old_df : pandas dataframe
+      Previous location fixture
+    new_df : pandas dataframe
+      New location fixture
+
+    Returns
+    -------
+    changes : dictionary
+      'added' and 'removed' awc doc_ids, 'moved' awcs whose supervisor,
+      block, district or state changed, 'renamed' ids by level whose name
+      changed (ie - changes['renamed']['block']), and 'affected', every awc
+      whose location columns are different in new_df
+    '''
+    parent_cols = [_level_columns[level][0] for level in location_levels[1:]]
+    old = _unique_by(old_df, 'doc_id', parent_cols)
+    new = _unique_by(new_df, 'doc_id', parent_cols)
+    added = new.index.difference(old.index)
+    removed = old.index.difference(new.index)
+    common = new.index.intersection(old.index)
+    cols = [col for col in parent_cols if col in old.columns and col in new.columns]
+    moved = common[(old.loc[common, cols] != new.loc[common, cols]).any(axis=1).values]
+    affected = added.union(removed).union(moved)
+    renamed = {}
+    for level in location_levels:
+        id_col, name_col = _level_columns[level]
+        if not all(col in df.columns for df in (old_df, new_df)
+                   for col in (id_col, name_col)):
+            continue
+        old_names = _unique_by(old_df, id_col, [name_col])[name_col]
+        new_names = _unique_by(new_df, id_col, [name_col])[name_col]
+        common_ids = new_names.index.intersection(old_names.index)
+        changed = common_ids[(old_names[common_ids] !=
+                              new_names[common_ids]).values]
+        if len(changed):
+            renamed[level] = sorted(changed)
+            awcs = new_df.loc[new_df[id_col].isin(changed), 'doc_id']
+            affected = affected.union(pd.Index(awcs.astype(object).unique()))
+    return {'added': sorted(added), 'removed': sorted(removed),
+            'moved': sorted(moved), 'renamed': renamed,
+            'affected': sorted(affected)}
+
+
+def _location_changes_path():
+    '''Return where the changelog of the location fixture is kept'''
+    return os.path.splitext(location_file_dir)[0] + '_changes.json'
+
+
+def location_changes(since=None):
+    '''
+    Return the changelog entries refresh_locations saved, oldest first.
+
+    Parameters
+    ----------
+    since : datetime or string
+      Only return entries after this time (optional, defaults to None for
+      all entries)
+
+    Returns
+    -------
+    changes : list of dictionaries
+      Output of diff_locations for each refresh that changed the fixture,
+      with the 'time' of the refresh as an iso format string
+    '''
+    try:
+        with open(_location_changes_path(), 'r') as f:
+            changes = json.load(f)
+    except (IOError, OSError, ValueError):
+        return []
+    if since is None:
+        return changes
+    if isinstance(since, datetime.datetime):
+        since = since.isoformat()
+    return [entry for entry in changes if entry['time'] > since]
+
+
+def _location_history_dir():
+    '''Return where the location deltas saved by refresh_locations are kept'''
+    return os.path.splitext(location_file_dir)[0] + '_history'
+
+
+def _save_location_delta(old_df, changes):
+    '''
+    Save the rows of the old location fixture for the awcs a refresh
+    changed, as they were before it, and a row for each added awc marking
+    that it wasn't there yet.  Returns the name of the saved folder.
+    '''
+    delta = old_df[old_df['doc_id'].isin(changes['affected'])].copy()
+    delta['_present'] = True
+    added = pd.DataFrame({'doc_id': changes['added'], '_present': False})
+    delta = pd.concat([delta, added], ignore_index=True, sort=False)
+    history_dir = _location_history_dir()
+    if not os.path.exists(history_dir):
+        os.makedirs(history_dir)
+    file_name = changes['time'].replace(':', '') + '.cols'
+    save_columnar(delta, os.path.join(history_dir, file_name))
+    return file_name
+
+
+def _location_history(index):
+    '''
+    Build (and keep in the index) every version of every awc: the current
+    fixture plus the deltas of each refresh in the changelog.  Version j of
+    an awc is valid until the time of refresh j, the current one after the
+    last refresh.  Versions are sorted by awc code * number of versions + j
+    so an as-of lookup is a single np.searchsorted.
+    '''
+    if 'history' not in index:
+        history_dir = _location_history_dir()
+        entries = []
+        for entry in location_changes():
+            if 'snapshot' not in entry:
+                continue
+            if not os.path.isdir(os.path.join(history_dir, entry['snapshot'])):
+                logging.warning('Missing location delta %s, history before '
+                                '%s will be wrong' % (entry['snapshot'],
+                                                      entry['time']))
+                continue
+            entries.append(entry)
+        frames = []
+        version_nums = []
+        for j, entry in enumerate(entries):
+            frames.append(load_columnar(os.path.join(history_dir,
+                                                     entry['snapshot'])))
+            version_nums.append(np.full(len(frames[-1].index), j))
+        current = index['locations'].copy()
+        current['_present'] = True
+        frames.append(current)
+        version_nums.append(np.full(len(current.index), len(entries)))
+        versions = pd.concat(frames, ignore_index=True, sort=False)
+        versions = align_location_categories(versions)
+        doc_codes, doc_ids = pd.factorize(versions['doc_id'].astype(object))
+        num_versions = len(entries) + 1
+        composite = (doc_codes.astype(np.int64) * num_versions +
+                     np.concatenate(version_nums))
+        order = np.argsort(composite, kind='mergesort')
+        index['history'] = {
+            'times': np.array([pd.Timestamp(entry['time']).value
+                               for entry in entries], dtype=np.int64),
+            'doc_ids': pd.Index(doc_ids), 'composite': composite[order],
+            'rows': order, 'versions': versions,
+            'present': versions['_present'].fillna(False).values.astype(bool)}
+    return index['history']
+
+
+def location_rows_as_of(keys, dates):
+    '''
+    Find the version of the location of each awc that was valid on a date,
+    using the deltas refresh_locations keeps.  Vectorized - the version
+    valid at each date is found with np.searchsorted.
+
+    Parameters
+    ----------
+    keys : array like
+      awc doc_ids, ie - a column of owner_ids or awc_ids
+    dates : array like
+      Date of each row, ie - form_date.  Blank dates get the current
+      location.
+
+    Returns
+    -------
+    rows : numpy array
+      Row in location_history()['versions'] for each key, -1 if the awc
+      didn't exist at that date or isn't in the fixture
+    '''
+    history = _location_history(location_index())
+    num_versions = len(history['times']) + 1
+    key_codes = _lookup_codes(history['doc_ids'], keys)
+    dates = pd.to_datetime(pd.Series(np.asarray(dates)))
+    if getattr(dates.dt, 'tz', None) is not None:
+        dates = dates.dt.tz_localize(None)
+    version = np.searchsorted(history['times'],
+                              dates.values.astype('datetime64[ns]').astype(np.int64),
+                              side='right')
+    version[dates.isnull().values] = num_versions - 1
+    composite = history['composite']
+    pos = np.searchsorted(composite, key_codes * num_versions + version)
+    pos_ok = pos < len(composite)
+    pos = np.where(pos_ok, pos, 0)
+    found = (key_codes >= 0) & pos_ok & (composite[pos] // num_versions == key_codes)
+    rows = np.where(found, history['rows'][pos], -1)
+    rows[found] = np.where(history['present'][rows[found]], rows[found], -1)
+    return rows
+
+
+def location_history():
+    '''
+    Return every version of every awc in the location changelog, see
+    _location_history.  'versions' is a dataframe of location columns and
+    'times' the times of the refreshes, as int64 nanoseconds.
+    '''
+    return _location_history(location_index())
+
+
+def add_locations_as_of(df, id_col, date_col, location_column_names=['doc_id',
+                        'awc_name', 'block_name', 'district_name', 'state_name'],
+                        state_list=None):
+    '''
+    Like add_locations, but each row gets the location its awc had on the
+    row's date rather than today's.  Earlier locations come from the deltas
+    refresh_locations saves, so only refreshes since deltas were kept are
+    known, before that the oldest known location is used.
+
+    Parameters
+    ----------
+    df : pandas dataframe
+      Dataframe to add location columns to
+    id_col : string
+      Column with awc doc_ids, ie - awc_id or owner_id (if None, the index
+      of df is used)
+    date_col : string
+      Column with the date of each row, ie - form_date
+    location_column_names : list of strings
+      doc_id and the location columns to add.  (Optional, defaults to doc_id,
+      awc_name, block_name, district_name, state_name).
+    state_list : list of strings
+      Only keep rows at locations that were in these states at the row's
+      date (optional, defaults to None to keep all rows, see real_state_list)
+
+    Returns
+    -------
+    output : pandas dataframe
+      Dataframe with added location columns.
+    '''
+    keys = df.index if id_col is None else df[id_col]
+    rows = location_rows_as_of(keys, df[date_col])
+    versions = location_history()['versions']
+    if state_list is not None:
+        in_states = _state_mask(rows, state_list, versions)
+        logging.info('Keeping %i of %i rows in real states' %
+                     (in_states.sum(), len(rows)))
+        df = df[in_states]
+        rows = rows[in_states]
+    location_df = _take_rows(versions, rows, location_column_names[1:],
+                             df.index)
+    return pd.concat([location_df, df], axis=1)
+
+
+def location_snapshot(as_of):
+    '''
+    Return the location fixture as it was at a date, rebuilt from the
+    current fixture and the deltas refresh_locations keeps.
+
+    Parameters
+    ----------
+    as_of : datetime or string
+      Date of the snapshot
+
+    Returns
+    -------
+    output : pandas dataframe
+      One row per awc that existed at as_of
+    '''
+    history = location_history()
+    ids = history['doc_ids']
+    rows = location_rows_as_of(ids, [as_of] * len(ids))
+    versions = history['versions']
+    output = versions.iloc[rows[rows >= 0]].drop('_present', axis=1)
+    return output.reset_index(drop=True)
 
-def refresh_locations():
-    '''Will delete and re-download the static location file from ucr'''
+
+
+def location_snapshot_index(as_of):
+    '''
+    Return a location index (see location_index) of the fixture as it was at
+    a date, with the parent pointers of the hierarchy then, so location_rows
+    and location_rollup can use it.  Kept with the location history, one per
+    date.
+    '''
+    history = location_history()
+    snapshots = history.setdefault('snapshots', {})
+    key = pd.Timestamp(as_of).value
+    if key not in snapshots:
+        snapshot = location_snapshot(as_of)
+        # versions of different refreshes don't share id categories
+        for level in location_levels:
+            id_col = _level_columns[level][0]
+            if id_col in snapshot.columns:
+                snapshot[id_col] = snapshot[id_col].astype('category')
+        snapshots[key] = _add_location_hierarchy({'locations': snapshot,
+                                                  'lookups': {}})
+    return snapshots[key]
+
+def refresh_locations(once=False):
+    '''
+    Download the static location file from ucr and replace the old one.  If
+    the download is identical to the old file the old one is kept, so nothing
+    that depends on it is reloaded.  Otherwise the new file is always
+    installed, and it is compared to the old one - awcs that were added,
+    removed or moved and renamed locations are added to the location
+    changelog (see location_changes), with the rows of the old file that
+    changed kept as a delta so earlier versions of the fixture can be used
+    (see add_locations_as_of).
+
+    Parameters
+    ----------
+    once : boolean
+      Only download if the fixture hasn't been refreshed yet by this process,
+      which is what add_locations(refresh_loc=True) uses so a script that
+      adds locations many times downloads it once (optional, defaults to
+      False)
+
+    Returns
+    -------
+    changes : dictionary
+      Output of diff_locations, or None if there was no old file, the file
+      didn't change or it was already refreshed
+    '''
+    if once and _location_refresh['time'] is not None:
+        logging.info('Location file already refreshed at %s' %
+                     _location_refresh['time'])
+        return None
     logging.info('Refreshing data file: %s' % location_file_dir)
     try:
-        location_download_link = 'https://www.icds-cas.gov.in/a/icds-cas/configurable_reports/data_sources/export/static-icds-cas-static-awc_location/?format=csv'
+        location_download_link = ucr_base_url + 'static-icds-cas-static-awc_location/?format=csv'
         user, password = get_credentials(credential_path, 'icds')
 
-        # rename and verify download before delete - and see if file even exists
-        old_file_name = location_file_dir[:-4] + 'OLD.csv'
+        # download next to the old file and verify before replacing it
+        new_file_name = location_file_dir[:-4] + 'NEW.csv'
+        download_ucr(location_download_link, user, password, os.path.basename(new_file_name), os.path.dirname(location_file_dir))
+        _location_refresh['time'] = datetime.datetime.now().isoformat()
+        changes = None
         if os.path.isfile(location_file_dir):
-            logging.info('Found older location file.  Getting latest data.')
-            os.rename(location_file_dir, old_file_name)
-
-        download_ucr(location_download_link, user, password, os.path.basename(location_file_dir), os.path.dirname(location_file_dir))
-        if os.path.isfile(location_file_dir) and os.path.isfile(old_file_name):
-            logging.info('Deleting old location file.  New one downloaded.')
-            os.remove(old_file_name)
-        return
+            if filecmp.cmp(location_file_dir, new_file_name, shallow=False):
+                logging.info('Location file unchanged, keeping old file.')
+                os.remove(new_file_name)
+                return None
+            logging.info('Found older location file.  Comparing to latest data.')
+            old_df = pd.read_csv(location_file_dir, low_memory=False)
+            changes = diff_locations(old_df, pd.read_csv(new_file_name,
+                                                         low_memory=False))
+            changes['time'] = _location_refresh['time']
+            if changes['affected']:
+                logging.info('%i awcs added, %i removed, %i moved, renamed: %s' %
+                             (len(changes['added']), len(changes['removed']),
+                              len(changes['moved']),
+                              dict((level, len(ids)) for level, ids
+                                   in changes['renamed'].items())))
+                changes['snapshot'] = _save_location_delta(old_df, changes)
+                _save_manifest(_location_changes_path(),
+                               location_changes() + [changes])
+            else:
+                # only columns outside of the hierarchy changed
+                logging.info('No awcs moved, replacing location file.')
+        _move_into_place(new_file_name, location_file_dir)
+        # make the location index read the new file
+        _location_index['key'] = None
+        try:
+            compile_locations()
+        except Exception as err:
+            # the csv is newer than any old compiled copy, so that is used
+            logging.warning('Could not compile location fixture: %s' % err)
+        return changes
     except Exception as err:
         logging.error('An exception happened: ' + str(err))
         raise
 
-def iterate_ucr_download(ucr_name, my_filter, filter_list, target_dir):
+def iterate_ucr_download(ucr_name, my_filter, filter_list, target_dir,
+                         num_workers=1):
     '''Downloads mulitple UCR data from HQ.  Use sparingly.
-    Format of files is csv.
+    Format of files is csv.  Slices can be downloaded in parallel over the
+    shared session with num_workers > 1, still at most HTTP_HOST_LIMIT at a
+    time.
     
     Parameters
     ----------
@@ -646,21 +3623,27 @@ def iterate_ucr_download(ucr_name, my_filter, filter_list, target_dir):
       iterate through      
     target_dir : absolute path
       Path to the folder you want to save the data to
+    num_workers : integer
+      Number of slices to download at a time (optional, defaults to 1)
 
     Returns
     -------
     None
     '''
     
-    base_url = 'https://www.icds-cas.gov.in/a/icds-cas/configurable_reports/data_sources/export/'
-    # eventually find a way not to hardcode this
-    user, password = get_credentials(r'C:\Users\theism\Documents\Dimagi\Admin\user_info.csv', 'icds')
+    base_url = ucr_base_url
+    user, password = get_credentials(credential_path, 'icds')
+    jobs = []
     i = 1
     for item in filter_list:
         download_url = base_url + ucr_name + '/?format=csv&' + my_filter + '=' + item
         new_file_name = ucr_name + '_' + str(i) + '.csv'
-        download_ucr(download_url, user, password, new_file_name, target_dir)
+        jobs.append((download_url, new_file_name, target_dir))
         i += 1
+    failed = download_ucr_files(jobs, user, password, num_workers,
+                                overwrite=True)
+    if failed:
+        raise IOError('Could not download %s' % sorted(failed))
     return
 
 def renumber_files(directory, start_num, basename):
@@ -707,61 +3690,128 @@ def mem_usage(pandas_obj):
     return "{:03.2f} MB".format(usage_mb)
 
 
+def _to_categorical(values, max_ratio=0.5, sample_size=100000):
+    '''
+    Return values as a pandas Categorical if the ratio of unique to total
+    values is below max_ratio, otherwise None.
+
+    Uniques are found with a single factorize, which also gives the codes
+    for the Categorical, so the column is only hashed once.  If the first
+    sample_size values are already more than max_ratio unique the column is
+    taken to be an id and left alone without hashing the rest of it.
+    '''
+    num_total_values = len(values)
+    if num_total_values == 0:
+        return None
+    if num_total_values > sample_size:
+        num_sample_unique = len(pd.unique(values[:sample_size]))
+        if num_sample_unique >= max_ratio * sample_size:
+            return None
+    codes, uniques = pd.factorize(values, sort=False)
+    if len(uniques) >= max_ratio * num_total_values:
+        return None
+    try:
+        # sort categories as astype('category') would
+        order = np.argsort(uniques, kind='mergesort')
+    except TypeError:
+        # mixed types that can't be compared, keep order of appearance
+        return pd.Categorical.from_codes(codes, categories=uniques)
+    new_codes = np.empty(len(order), dtype=codes.dtype)
+    new_codes[order] = np.arange(len(order), dtype=codes.dtype)
+    codes = np.where(codes >= 0, new_codes[codes], -1)
+    return pd.Categorical.from_codes(codes, categories=uniques[order])
+
+
+def _downcast_int(series):
+    '''Return the smallest signed int dtype that holds all values in series'''
+    if len(series) == 0:
+        return series.dtype
+    col_min = series.min()
+    col_max = series.max()
+    for dtype in (np.int8, np.int16, np.int32):
+        limits = np.iinfo(dtype)
+        if col_min >= limits.min and col_max <= limits.max:
+            return np.dtype(dtype)
+    return series.dtype
+
+
 # hat tip: https://www.dataquest.io/blog/pandas-big-data/
-def obj_to_cat(df):
-    '''Changes object column types to categoricals if more efficient
+def obj_to_cat(df, max_ratio=0.5):
+    '''Changes object column types to categoricals if more efficient.
+    Columns are converted one at a time, in place.
     Warning - need to reconvert a column back to numeric dtype to do math on it
     
     Parameters
     ----------
     df : pandas dataframe
+    max_ratio : float
+      Convert if ratio of unique to total values is below this (optional,
+      defaults to 0.5)
     
-    Parameters
-    ----------
+    Returns
+    -------
     df : pandas dataframe with object columns turned to categories (where makes sense)
     '''
-    df_obj = df.select_dtypes(include=['object'])
-    converted_obj = pd.DataFrame()
-    for col in df_obj.columns:
-        num_unique_values = len(df_obj[col].unique())
-        num_total_values = len(df_obj[col])
-        if num_unique_values / num_total_values < 0.5:
-            converted_obj.loc[:,col] = df_obj[col].astype('category')
-        else:
-            converted_obj.loc[:,col] = df_obj[col]
-    df[converted_obj.columns] = converted_obj
+    for col in df.columns[(df.dtypes == object).values]:
+        categorical = _to_categorical(df[col].values, max_ratio)
+        if categorical is not None:
+            df[col] = categorical
     return df
 
 
+def _column_memory(df, deep):
+    '''Memory in bytes of each column of df, without the index'''
+    return df.memory_usage(index=False, deep=deep)
+
+
 # combining goodness from: https://www.dataquest.io/blog/pandas-big-data/
-def optimize_df_memory(df):
+def optimize_df_memory(df, deep=False, report_out=False):
     '''Optimize the memory usage of a dataframe by turning objects into 
-    categories and downcasting floats and ints
+    categories and downcasting floats and ints.  Makes a single pass over
+    the columns, converting each in place.
     
     Parameters
     ----------
     df : pandas dataframe
+    deep : boolean
+      Measure memory including the contents of object columns, which takes
+      a full scan of the strings (optional, defaults to False)
+    report_out : boolean
+      (Optional) Also return a dataframe of savings by column.  False is
+      default
     
-    Parameters
-    ----------
+    Returns
+    -------
     df : memory optimized pandas dataframe
+    report : pandas dataframe
+      old_dtype, new_dtype, before_bytes, after_bytes and saved_bytes by
+      column (only included if report_out=True)
     '''
     logging.info('Optimizing dataframe memory...')
-    initial_mem = mem_usage(df)
-    types = df.dtypes.unique()    
-    # turn objects to categories
-    if object in types:
-        df = obj_to_cat(df)
-    # downcast float
-    if float in types:
-        df_float = df.select_dtypes(include=['float'])
-        conv_float = df_float.apply(pd.to_numeric,downcast='float')
-        df[conv_float.columns] = conv_float    
-    # downcast int
-    if int in types:
-        df_int = df.select_dtypes(include=['int'])
-        conv_int = df_int.apply(pd.to_numeric,downcast='integer')
-        df[conv_int.columns] = conv_int
-    end_mem = mem_usage(df)
-    logging.info('Dataframe memory optimized from %s to %s' % (initial_mem, end_mem))
-    return df
\ No newline at end of file
+    old_dtypes = df.dtypes.copy()
+    initial_mem = _column_memory(df, deep)
+    for col, dtype in zip(df.columns, old_dtypes):
+        if dtype == object:
+            categorical = _to_categorical(df[col].values)
+            if categorical is not None:
+                df[col] = categorical
+        elif dtype.kind == 'f' and dtype.itemsize > 4:
+            df[col] = pd.to_numeric(df[col], downcast='float')
+        elif dtype.kind == 'i' and dtype.itemsize > 1:
+            new_dtype = _downcast_int(df[col])
+            if new_dtype != dtype:
+                df[col] = df[col].astype(new_dtype)
+    end_mem = _column_memory(df, deep)
+    logging.info('Dataframe memory optimized from %03.2f MB to %03.2f MB%s' %
+                 (initial_mem.sum() / 1024 ** 2, end_mem.sum() / 1024 ** 2,
+                  '' if deep else ' (not counting strings)'))
+    if not report_out:
+        return df
+    report = pd.DataFrame({'old_dtype': old_dtypes.astype(str),
+                           'new_dtype': df.dtypes.astype(str),
+                           'before_bytes': initial_mem,
+                           'after_bytes': end_mem},
+                          columns=['old_dtype', 'new_dtype', 'before_bytes',
+                                   'after_bytes'])
+    report['saved_bytes'] = report['before_bytes'] - report['after_bytes']
+    return df, report
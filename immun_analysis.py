@@ -33,6 +33,15 @@ def is_date(string):
     except ValueError:
         return False
 
+def sums_by_state(df, values, state_list):
+    '''number of rows and sum of each column of values (aligned with df) for
+    each state in state_list, in one pass with gf.location_rollup.  States
+    without rows are blank.'''
+    rows = gf.location_rows(df['owner_id'])
+    by_state = gf.location_rollup(rows, values, levels=['state']).loc['state']
+    by_state.index = np.asarray(by_state['state_name'], dtype=object)
+    return by_state.reindex(state_list)
+
     
 # ----------------  USER EDITS -------------------------------
 # download date - this sets relative age for analysis
@@ -147,8 +156,8 @@ logging.info(tasks_in_df['tasks_type'].value_counts(dropna=False) / tasks_in_df.
 logging.info('Adding location data and removing test data ...')
 if refresh_locations:
     gf.refresh_locations()
-tasks_in_df = gf.add_locations(tasks_in_df, 'owner_id', location_columns)
-tasks_in_df = tasks_in_df.loc[(tasks_in_df['state_name'].isin(real_state_list))]
+tasks_in_df = gf.add_locations(tasks_in_df, 'owner_id', location_columns,
+                               state_list=real_state_list)
 
 
 #---------------------------------------------------------------------------------
@@ -174,8 +183,8 @@ if run_child:
                     'date_turns_one_yr', 'open_child_count', 'is_migrated', 
                     'is_availing']
     dob_data_regex = re.compile(r'static-icds-cas-static-tasks_cases_\d+.csv')
-    # know these files can get big.  split larger csvs.  Eventually wrap this into other function
-    gf.find_and_split_csvs(dob_dir)
+    # these files can get big.  forms_to_df reads files over CSV_SPLIT_SIZE as
+    # ranges of rows from an offset index rather than splitting them
     child_dob_df = gf.forms_to_df(dob_dir, dob_data_regex, dob_date_cols, dob_use_cols)
     child_dob_df = child_dob_df.set_index('doc_id')
     logging.info('Merging dob info with immunization data...')
@@ -204,13 +213,13 @@ if run_child:
     immun_dist_pct = child_tasks_df[immun_list].count(axis=0) / num_open_child * 100.
     immun_out = immun_dist_pct
     logging.info(immun_dist_pct.sort_values(ascending=False)[0:5])
-    for state in real_state_list:
-        logging.info(state)
-        temp = child_tasks_df[child_tasks_df['state_name'] == state]
-        temp_num_open_child = temp.shape[0]
-        temp_immun_dist_pct = temp[immun_list].count(axis=0) / temp_num_open_child * 100.
-        #logging.info(temp_immun_dist_pct.sort_values(ascending=False)[0:5])
-        immun_out = pd.concat([immun_out, temp_immun_dist_pct.rename(state)], axis=1)
+    state_counts = sums_by_state(child_tasks_df, child_tasks_df[immun_list].notnull(),
+                                 real_state_list)
+    state_immun_dist_pct = pd.DataFrame(
+        (state_counts[[i + '_sum' for i in immun_list]].values.T /
+         state_counts['num_rows'].values * 100.),
+        index=immun_list, columns=real_state_list)
+    immun_out = pd.concat([immun_out, state_immun_dist_pct], axis=1)
     
     immun_out.to_csv('immun_pcts.csv')
     
@@ -256,14 +265,19 @@ if run_child:
 
       
     
-    for state in real_state_list:
-        temp = child_tasks_df[child_tasks_df['state_name'] == state]
-        temp_num_open_child = temp.shape[0]
+    eligible = child_tasks_df['age_days'] >= 273
+    state_counts = sums_by_state(child_tasks_df, pd.DataFrame({
+        'over_one_yr': eligible,
+        'over_one_complete': eligible & (child_tasks_df['immun_one_year_complete'] == 'yes'),
+        'completed_eventually': eligible & (child_tasks_df['immun_one_year_date_is_date'] == True)}),
+        real_state_list)
+    for state, temp in state_counts.iterrows():
+        temp_num_open_child = temp['num_rows']
         if temp_num_open_child > 0:
-            temp_num_child_over_one_yr = (temp['age_days'] >= 273).sum()
-            temp_over_one_complete = ((temp['age_days'] >= 273) & (temp['immun_one_year_complete'] == 'yes')).sum()
+            temp_num_child_over_one_yr = temp['over_one_yr_sum']
+            temp_over_one_complete = temp['over_one_complete_sum']
             #temp_under_one_complete = ((temp['age_days'] < 365.25) & (temp['immun_one_year_complete'] == 'yes')).sum()
-            temp_completed_eventually = ((temp['age_days'] >= 273) & (temp['immun_one_year_date_is_date'] == True)).sum()    
+            temp_completed_eventually = temp['completed_eventually_sum']
             logging.info('%i children in %s (%0.1f pct of open children)' % (temp_num_open_child, state, temp_num_open_child * 100. / num_open_child))
             logging.info('Children eligible for 1 yr immuns: %i (%0.1f pct of open children in state)' % (temp_num_child_over_one_yr, (temp_num_child_over_one_yr * 100. / temp_num_open_child)))
             logging.info('Children eligible w/ all one year immuns on time: %i (%0.1f pct of eligible children in state)' % (temp_over_one_complete, (temp_over_one_complete * 100. / temp_num_child_over_one_yr)))
@@ -358,14 +372,18 @@ if run_child:
     logging.info('Pct on Penta out of on some sched: %0.1f' % (child_w_task_df['on_penta'].sum() * 100. / child_on_some_sched))
     logging.info('Pct on DPT / HepB out of on some sched: %0.1f' % (child_w_task_df['on_dpt_hepb'].sum() * 100. / child_on_some_sched))
     logging.info('Pct on None: %0.1f' % (child_w_task_df['on_none'].sum() * 100. / num_child_w_1plus_task))
-    for state in real_state_list:
-        temp = child_w_task_df[child_w_task_df['state_name'] == state]
-        denom2 = temp.shape[0]
-        denom1 = (temp['on_none'] != True).sum()
-        if denom2 != 0:
-            penta = temp['on_penta'].sum() * 100. / denom1
-            none = temp['on_none'].sum() * 100. / denom1
-            dpt = temp['on_dpt_hepb'].sum() * 100. / denom2
+    state_counts = sums_by_state(child_w_task_df, pd.DataFrame({
+        'on_some_sched': child_w_task_df['on_none'] != True,
+        'on_penta': child_w_task_df['on_penta'],
+        'on_none': child_w_task_df['on_none'],
+        'on_dpt_hepb': child_w_task_df['on_dpt_hepb']}), real_state_list)
+    for state, temp in state_counts.iterrows():
+        denom2 = temp['num_rows']
+        denom1 = temp['on_some_sched_sum']
+        if denom2 > 0:
+            penta = temp['on_penta_sum'] * 100. / denom1
+            none = temp['on_none_sum'] * 100. / denom1
+            dpt = temp['on_dpt_hepb_sum'] * 100. / denom2
             logging.info('%s: Penta: %0.1f  DPT: %0.1f  None: %0.1f' % (state, penta, dpt, none))
 
     child_w_task_df.iloc[0:200].to_csv('test.csv')
@@ -47,11 +47,6 @@ date_cols = ['received_on']
 col_names = ['username', 'received_on', 'userID']
 location_columns = ['awc_site_code', 'awc_name', 'block_name', 'district_name', 'state_name']
 
-# because these forms have username (which is awc_site_code), but not userID, need finagling
-location_file_dir = r'C:\Users\theism\Documents\Dimagi\Data\static-awc_location.csv'
-location_df = pd.read_csv(location_file_dir, usecols=location_columns)
-location_df['awc_site_code'] = location_df['awc_site_code'].astype(str)
-
 # a bit hacky of an output, but going with it for now
 wb = openpyxl.Workbook()
 sheet = wb.active
@@ -77,16 +72,14 @@ for folder in folder_list:
 
         # combine all csv into one dataframe
         input_df = gf.csv_files_to_df(os.path.join(target_dir, folder), data_regex, date_cols, col_names_to_use)
-        input_df['username2'] = input_df['username'].apply(lambda x: x[1:] if x[0] == '0' else x)
 
-        # add location information for each user        
-        forms_df = pd.merge(input_df, location_df, left_on='username2', right_on='awc_site_code', how='left')
-        forms_df['received_on'] = pd.to_datetime(forms_df['received_on'])
-        
-        # filter to real states
-        # logging.info('%i users unmatched to location so far' % forms_df['awc_name'].isnull().sum())
+        # add location information for each user - these forms have username
+        # (which is awc_site_code), but not userID
+        # and only keep users from real states
         logging.info('only getting users from real states...')
-        forms_df = forms_df.loc[(forms_df['state_name'].isin(real_state_list))]
+        forms_df = gf.add_locations_by_username(input_df, location_columns,
+                                                state_list=real_state_list)
+        forms_df['received_on'] = gf.to_datetime_fast(forms_df['received_on'], errors='raise')
         logging.info('%i users unmatched to location still' % forms_df['awc_name'].isnull().sum())
         logging.info('------- ANALYSIS: --------')
         logging.info('%i submissions of %s form' % (forms_df.shape[0], folder))
@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the CommCare UCR exports
+
+Serves synthetic zipped csv exports at the same paths as the real data
+sources, so the download helpers in gen_func and form_func can be tested
+and benchmarked without going to icds-cas.gov.in.  Point gen_func at it with
+gen_func.ucr_base_url = server.base_url (or UCR_BASE_URL in settings).
+
+Exports served:
+  static-icds-cas-static-awc_location - the location fixture
+  static-icds-cas-static-usage_forms - one day of forms per form_date
+  static-icds-cas-static-tasks_cases - task cases for a filter, ie - state_id
+
+Latency, failures and throttling can be added to see how the downloaders
+cope.  Run this file to serve until stopped, settings in the 'user edit'
+section.
+"""
+import io
+import logging
+import random
+import threading
+import time
+import zipfile
+import zlib
+import numpy as np
+import pandas as pd
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+export_path = '/a/icds-cas/configurable_reports/data_sources/export/'
+mock_states = ['Madhya Pradesh', 'Chhattisgarh', 'Andhra Pradesh', 'Bihar',
+               'Jharkhand', 'Rajasthan', 'Uttar Pradesh', 'Maharashtra',
+               'Test State']
+form_count_cols = ['pse', 'gmp', 'thr', 'add_household', 'add_person',
+                   'add_pregnancy', 'home_visit', 'bp_tri1', 'bp_tri2',
+                   'bp_tri3', 'delivery', 'pnc', 'ebf', 'cf', 'due_list_ccs',
+                   'due_list_child']
+
+
+def mock_locations(num_awcs, seed=0):
+    '''
+    Location fixture with num_awcs awcs spread over mock_states, with the
+    same columns as static-awc_location (10 awcs per supervisor, 10
+    supervisors per block, 10 blocks per district)
+
+    Parameters
+    ----------
+    num_awcs : integer
+      Number of awcs
+    seed : integer
+      Seed for the ids (optional, defaults to 0)
+
+    Returns
+    -------
+    df : pandas dataframe
+    '''
+    rng = np.random.RandomState(seed)
+    awc = np.arange(num_awcs)
+    supervisor = awc // 10
+    block = supervisor // 10
+    district = block // 10
+    state = district % len(mock_states)
+
+    def ids(codes):
+        num = codes.max() + 1
+        return np.array(['%016x%016x' % tuple(rng.randint(0, 2 ** 62, 2))
+                         for i in range(num)], dtype=object)[codes]
+
+    return pd.DataFrame({
+        'doc_id': ids(awc),
+        'awc_name': ['AWC %i' % i for i in awc],
+        'awc_site_code': 10000000000 + awc,
+        'supervisor_id': ids(supervisor),
+        'supervisor_name': ['Supervisor %i' % i for i in supervisor],
+        'block_id': ids(block),
+        'block_name': ['Block %i' % i for i in block],
+        'district_id': ids(district),
+        'district_name': ['District %i' % i for i in district],
+        'state_id': ids(state),
+        'state_name': np.array(mock_states, dtype=object)[state]},
+        columns=['doc_id', 'awc_name', 'awc_site_code', 'supervisor_id',
+                 'supervisor_name', 'block_id', 'block_name', 'district_id',
+                 'district_name', 'state_id', 'state_name'])
+
+
+def mock_usage_forms(locations, form_date, num_rows, seed=0):
+    '''One day of the usage_forms export, one row per awc form summary'''
+    rng = np.random.RandomState(seed)
+    day = pd.Timestamp(form_date)
+    form_time = day + pd.to_timedelta(rng.randint(6 * 3600, 20 * 3600, num_rows), 's')
+    received_on = form_time + pd.to_timedelta(rng.exponential(6 * 3600, num_rows), 's')
+    df = pd.DataFrame({'form_date': day.strftime('%Y-%m-%d'),
+                       'form_time': form_time.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+                       'received_on': received_on.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+                       'awc_id': locations['doc_id'].values[
+                           rng.randint(0, len(locations.index), num_rows)]},
+                      columns=['form_date', 'form_time', 'received_on', 'awc_id'])
+    for col in form_count_cols:
+        df[col] = rng.poisson(0.5, num_rows)
+    return df
+
+
+def mock_tasks_cases(locations, filter_col, filter_value, num_rows, seed=0):
+    '''Task cases export for the awcs where filter_col is filter_value'''
+    rng = np.random.RandomState(seed)
+    awcs = locations['doc_id'].values
+    if filter_col in locations.columns:
+        awcs = awcs[(locations[filter_col] == filter_value).values]
+    if len(awcs) == 0:
+        num_rows = 0
+        awcs = np.array([''], dtype=object)
+    dob = pd.Timestamp('2016-01-01') + pd.to_timedelta(rng.randint(0, 900, num_rows), 'D')
+    return pd.DataFrame({
+        'doc_id': ['%016x%016x' % tuple(rng.randint(0, 2 ** 62, 2))
+                   for i in range(num_rows)],
+        'owner_id': awcs[rng.randint(0, len(awcs), num_rows)],
+        filter_col: filter_value,
+        'tasks_type': np.array(['child', 'pregnancy'], dtype=object)[
+            rng.randint(0, 2, num_rows)],
+        'closed': rng.rand(num_rows) < 0.1,
+        'dob': dob.strftime('%Y-%m-%d'),
+        'date_turns_one_yr': (dob + pd.DateOffset(years=1)).strftime('%Y-%m-%d'),
+        'open_child_1yr_immun_complete': rng.randint(0, 2, num_rows),
+        'open_child_count': rng.randint(0, 2, num_rows),
+        'is_migrated': rng.randint(0, 2, num_rows),
+        'is_availing': rng.randint(0, 2, num_rows)},
+        columns=['doc_id', 'owner_id', filter_col, 'tasks_type', 'closed',
+                 'dob', 'date_turns_one_yr', 'open_child_1yr_immun_complete',
+                 'open_child_count', 'is_migrated', 'is_availing'])
+
+
+def _zip_csv(df, member_name):
+    '''Zip a dataframe as a single csv member, like the UCR exports'''
+    out = io.BytesIO()
+    z = zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED)
+    z.writestr(member_name, df.to_csv(index=False))
+    z.close()
+    return out.getvalue()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _UCRHandler(BaseHTTPRequestHandler):
+    '''Answers export requests for the MockUCRServer in self.server.mock'''
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logging.debug('mock ucr: ' + format % args)
+
+    def _send(self, status, body, content_type='text/plain', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        mock = self.server.mock
+        if not mock._enter():
+            self._send(429, b'Too many requests', headers={'Retry-After': '1'})
+            return
+        try:
+            status, body = mock._respond(self.path)
+            if status == 200:
+                self._send(200, body, 'application/zip')
+                mock._count('bytes', len(body))
+            else:
+                self._send(status, body)
+        finally:
+            mock._leave()
+
+
+class MockUCRServer(object):
+    '''
+    Local http server serving synthetic UCR exports.  Exports are built the
+    first time they are asked for and kept, so the same url always gets the
+    same file.
+
+    Parameters
+    ----------
+    num_awcs : integer
+      Number of awcs in the location fixture (optional, defaults to 1000)
+    rows_per_file : integer
+      Rows in each usage_forms and tasks_cases export (optional, defaults to
+      10000)
+    latency : float
+      Seconds to wait before answering each request (optional, defaults to 0)
+    fail_rate : float
+      Fraction of requests answered with a 500 error (optional, defaults to 0)
+    max_concurrent : integer
+      Requests answered at a time, others get a 429 (optional, defaults to
+      None for no limit)
+    seed : integer
+      Seed for the data and the failures (optional, defaults to 0)
+    port : integer
+      Port to listen on (optional, defaults to 0 for any free port)
+
+    Attributes
+    ----------
+    base_url : string
+      What to use as gen_func.ucr_base_url, set by start
+    stats : dictionary
+      Counts of requests, ok, failed and throttled requests, bytes served
+      and the most requests that were being answered at once
+    '''
+    def __init__(self, num_awcs=1000, rows_per_file=10000, latency=0,
+                 fail_rate=0, max_concurrent=None, seed=0, port=0):
+        self.rows_per_file = rows_per_file
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.max_concurrent = max_concurrent
+        self.seed = seed
+        self.port = port
+        self.locations = mock_locations(num_awcs, seed)
+        self.base_url = None
+        self.stats = {}
+        self._exports = {}
+        self._active = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._lock:
+            self.stats = {'requests': 0, 'ok': 0, 'failed': 0, 'throttled': 0,
+                          'bytes': 0, 'max_active': 0}
+
+    def start(self):
+        '''Start serving in a background thread, returns base_url'''
+        self._server = _ThreadingHTTPServer(('127.0.0.1', self.port), _UCRHandler)
+        self._server.mock = self
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        self.base_url = 'http://127.0.0.1:%i%s' % (self._server.server_address[1],
+                                                   export_path)
+        logging.info('Mock UCR server at %s' % self.base_url)
+        return self.base_url
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+    def _count(self, key, num=1):
+        with self._lock:
+            self.stats[key] += num
+
+    def _enter(self):
+        '''Count a request, False if it should be throttled'''
+        with self._lock:
+            self.stats['requests'] += 1
+            if (self.max_concurrent is not None and
+                    self._active >= self.max_concurrent):
+                self.stats['throttled'] += 1
+                return False
+            self._active += 1
+            self.stats['max_active'] = max(self.stats['max_active'], self._active)
+            return True
+
+    def _leave(self):
+        with self._lock:
+            self._active -= 1
+
+    def _respond(self, path):
+        '''Return the status and body for a request path'''
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            fail = self._random.random() < self.fail_rate
+        if fail:
+            self._count('failed')
+            return 500, b'Injected failure'
+        url = urlparse(path)
+        if not url.path.startswith(export_path):
+            return 404, b'Not found'
+        name = url.path[len(export_path):].strip('/')
+        query = dict((key, values[0]) for key, values in parse_qs(url.query).items())
+        query.pop('format', None)
+        key = (name, tuple(sorted(query.items())))
+        with self._lock:
+            body = self._exports.get(key)
+        if body is None:
+            seed = (self.seed + zlib.crc32(repr(key).encode())) % 2 ** 32
+            df = self._build_export(name, query, seed)
+            if df is None:
+                return 404, b'Unknown data source'
+            body = _zip_csv(df, name + '.csv')
+            with self._lock:
+                self._exports[key] = body
+        self._count('ok')
+        return 200, body
+
+    def _build_export(self, name, query, seed):
+        '''Dataframe for an export, None if the data source isn't served'''
+        if name == 'static-icds-cas-static-awc_location':
+            return self.locations
+        if name == 'static-icds-cas-static-usage_forms':
+            return mock_usage_forms(self.locations,
+                                    query.get('form_date', '2017-03-20'),
+                                    self.rows_per_file, seed)
+        if name == 'static-icds-cas-static-tasks_cases':
+            filter_col, filter_value = (sorted(query.items()) or
+                                        [('state_id', '')])[0]
+            return mock_tasks_cases(self.locations, filter_col, filter_value,
+                                    self.rows_per_file, seed)
+        return None
+
+
+# ----------------  USER EDITS -------------------------------
+num_awcs = 1000
+rows_per_file = 10000
+latency = 0.2
+fail_rate = 0.05
+max_concurrent = 8
+port = 8765
+# ------------- don't edit below here -----------------------------
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    server = MockUCRServer(num_awcs, rows_per_file, latency, fail_rate,
+                           max_concurrent, port=port)
+    server.start()
+    try:
+        while True:
+            time.sleep(60)
+            logging.info(server.stats)
+    except KeyboardInterrupt:
+        server.stop()
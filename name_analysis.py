@@ -29,9 +29,10 @@ output_dir = (r'C:\Users\theism\Documents\Dimagi\Results\Name')
 gen_func.start_logging(output_dir)
 
 # identify all the states files to go through
-folder_list = os.listdir(target_dir)
 case_date_cols = ['opened_date', 'last_modified_date', 'dob']
 case_data_regex = re.compile(r'cases_\d\d\d.csv')
+catalog = gen_func.dataset_catalog(target_dir, case_data_regex)
+folder_list = catalog.index.tolist()
 
 # initialize outputs
 output_dict = {}
@@ -46,7 +47,7 @@ for folder in folder_list:
     bad_df = bad_df.fillna('')
 
     if os.path.isdir(os.path.join(target_dir, folder)):
-        location_name = gen_func.folder_name_to_location(folder)
+        location_name = catalog.loc[folder, 'location']
         logging.info('-------------------------------------------')
         logging.info('Going through data for: %s' % location_name)
         logging.info('-------------------------------------------')
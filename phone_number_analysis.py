@@ -49,7 +49,8 @@ deep_dive_dups = False
 gen_func.start_logging(output_dir)
 
 # identify all the states files to go through
-folder_list = os.listdir(target_dir)
+catalog = gen_func.dataset_catalog(target_dir, case_data_regex)
+folder_list = catalog.index.tolist()
 
 
 # initialize outputs
@@ -64,7 +65,7 @@ for folder in folder_list:
     bad_num_list = bad_num_list.fillna('')
 
     if os.path.isdir(os.path.join(target_dir, folder)):
-        location_name = gen_func.folder_name_to_location(folder)
+        location_name = catalog.loc[folder, 'location']
         logging.info('-------------------------------------------')
         logging.info('Going through data for: %s' % location_name)
         logging.info('-------------------------------------------')
@@ -110,12 +111,12 @@ for folder in folder_list:
         # , 'Uttar Pradesh', 'Maharashtra']
         if user_case:
             location_columns = ['doc_id', 'awc_name', 'supervisor_name', 'block_name', 'district_name', 'state_name']
-            bad_num_list = gen_func.add_locations(bad_num_list, 'commcare_location_id', location_columns)
-            bad_num_list = bad_num_list.loc[(bad_num_list['state_name'].isin(real_state_list))]
+            bad_num_list = gen_func.add_locations(bad_num_list, 'commcare_location_id', location_columns,
+                                                  state_list=real_state_list)
         else:
             location_columns = ['doc_id', 'block_name', 'district_name']
-            bad_num_list = gen_func.add_locations(bad_num_list, 'owner_id', location_columns)
-            bad_num_list = bad_num_list.loc[(bad_num_list['state_name'].isin(real_state_list))]
+            bad_num_list = gen_func.add_locations(bad_num_list, 'owner_id', location_columns,
+                                                  state_list=real_state_list)
             bad_num_list = bad_num_list.drop(['has_aadhar', 'aadhar_number',
                                               'raw_aadhar_string', 'name',
                                               'has_rch', 'rch_id'], axis=1)
@@ -208,8 +209,8 @@ phone_output.to_csv(os.path.join(output_dir, (
 
 # create raw output too
 if user_case:
-    output2 = gen_func.add_locations(case_clean_df, 'commcare_location_id', location_columns)
-    output2 = output2.loc[(output2['state_name'].isin(real_state_list))].set_index('commcare_location_id')
+    output2 = gen_func.add_locations(case_clean_df, 'commcare_location_id', location_columns,
+                                     state_list=real_state_list).set_index('commcare_location_id')
     mybad = bad_num_list.drop_duplicates(subset=['commcare_location_id']).filter(items=['commcare_location_id', 'error']).set_index('commcare_location_id')
     output2 = output2.merge(mybad, how='left', left_index=True, right_index=True)
     output2.to_csv(os.path.join(output_dir, (
@@ -85,8 +85,8 @@ logging.info(tasks_in_df['tasks_type'].value_counts(dropna=False) * 100. / tasks
 logging.info('Adding location data and removing test data ...')
 if refresh_locations:
     gf.refresh_locations()
-tasks_in_df = gf.add_locations(tasks_in_df, 'owner_id', location_columns)
-tasks_in_df = tasks_in_df.loc[(tasks_in_df['state_name'].isin(real_state_list))]
+tasks_in_df = gf.add_locations(tasks_in_df, 'owner_id', location_columns,
+                               state_list=real_state_list)
 
 
 #---------------------------------------------------------------------------------
@@ -44,8 +44,8 @@ for data_file in file_list:
     print(output_df.shape)
     
 # add location in order to get rid of test locations
-output_df = gf.add_locations(output_df, 'userID', location_columns)
-output_df = output_df.loc[(output_df['state_name'].isin(real_state_list))]
+output_df = gf.add_locations(output_df, 'userID', location_columns,
+                             state_list=real_state_list)
 
 # perform calcs interested in
 output_df['days_since_add'] = output_df['form.case_load_ccs_record0.case.@date_modified'] - output_df['form.add']
@@ -48,8 +48,8 @@ output_dict = {}
 case_clean_df, output_dict = case_func.clean_case_data(case_df, output_dict)
 case_clean_df = case_func.add_age_info(case_clean_df)
 location_column_names = ['doc_id', 'district_name']
-case_clean_df = gen_func.add_locations(case_clean_df, 'owner_id', location_column_names)
-case_clean_df = case_clean_df.loc[(case_clean_df['state_name'].isin(real_state_list))]
+case_clean_df = gen_func.add_locations(case_clean_df, 'owner_id', location_column_names,
+                                       state_list=real_state_list)
 
 logging.info(case_clean_df['sex'].value_counts())
 logging.info(case_clean_df['age_bracket'].value_counts())
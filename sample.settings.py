@@ -13,3 +13,58 @@ OUTPUT_DIR = os.path.join(ROOT_FOLDER, 'Results')
 
 HASH_FILE = 'files.hash'
 HDF_KEY = 'table'
+
+# number of processes used to read csv files in parallel
+NUM_WORKERS = 1
+
+# folder created inside each data directory to hold cached partitions
+CACHE_DIR_NAME = 'cache'
+
+# format of cached partitions: 'columnar' (numpy files, keeps dtypes) or
+# 'hdf' (needs pytables)
+CACHE_FORMAT = 'columnar'
+
+# number of views (sets of columns) of a data directory whose caches are
+# kept; raise it if several scripts read the same directory differently
+CACHE_KEEP_VIEWS = 1
+
+# csv files larger than this many bytes are read as ranges of rows, in
+# parallel if NUM_WORKERS > 1
+CSV_SPLIT_SIZE = 1000000000
+
+# where dtype schemas built by gen_func.build_dtype_schema are saved
+SCHEMA_FILE = os.path.join(DATA_DIR, 'dtype_schemas.json')
+
+# states with real (not test) locations, used by gen_func.real_state_ids and
+# friends when a script doesn't give its own list
+REAL_STATE_LIST = ['Madhya Pradesh', 'Chhattisgarh', 'Andhra Pradesh', 'Bihar',
+                   'Jharkhand', 'Rajasthan', 'Uttar Pradesh', 'Maharashtra']
+
+# state names for the suffix of data folder names (ie - xxx-mp), used by
+# gen_func.folder_name_to_location and the dataset catalog
+FOLDER_LOCATIONS = {'ap': 'Andhra Pradesh', 'bihar': 'Bihar',
+                    'ch': 'Chhattisgarh', 'jh': 'Jharkhand',
+                    'mp': 'Madhya Pradesh', 'raj': 'Rajasthan',
+                    'up': 'Uttar Pradesh', 'mah': 'Maharashtra',
+                    'user': 'User', 'test': 'Test', 'ap2': 'Andhra Pradesh2'}
+
+# where UCR data sources are exported from (point at a local server to test
+# downloads)
+UCR_BASE_URL = 'https://www.icds-cas.gov.in/a/icds-cas/configurable_reports/data_sources/export/'
+
+# UCR files downloaded at a time, retries of a failed download and seconds
+# to wait before the first retry (doubled for each retry after)
+DOWNLOAD_WORKERS = 4
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_BACKOFF = 5
+
+# connections kept open per host by the shared http sessions, and most
+# requests to one host at a time however many download workers there are
+HTTP_POOL_SIZE = 10
+HTTP_HOST_LIMIT = 4
+
+# seconds to wait for a connection to a host, and for more of a response,
+# before a download fails (and is retried).  UCR exports can take a while to
+# start, so the read timeout is long
+HTTP_CONNECT_TIMEOUT = 10
+HTTP_READ_TIMEOUT = 300
@@ -43,16 +43,14 @@ os.chdir(output_dir)
 bp_dir = os.path.join(target_dir, '[DA] Birth Preparedness - min_video')
 bp_df = gf.csv_files_to_df(bp_dir, data_regex, date_cols = ['completed_time'])
 logging.info('raw BP forms: %i' % bp_df.shape[0])
-bp_df = gf.add_locations_by_username(bp_df)
-logging.info('raw BP forms after add locations: %i' % bp_df.shape[0])
-bp_df = bp_df.loc[(bp_df['state_name'].isin(real_state_list))]
+bp_df = gf.add_locations_by_username(bp_df, state_list=real_state_list)
 num_bp_forms = bp_df.shape[0]
 logging.info('Num Birth Prep forms in real locations: %i' % num_bp_forms)
 logging.info('%i different users submitted this form' % bp_df['awc_name'].nunique())
 logging.info('%.2f average forms per user' % bp_df['awc_name'].value_counts().mean())
 # try to also coordinate with birth phase
-bp_df['completed_time'] = pd.to_datetime(bp_df['completed_time'])
-bp_df['started_time'] = pd.to_datetime(bp_df['started_time'])
+bp_df['completed_time'] = gf.to_datetime_fast(bp_df['completed_time'], errors='raise')
+bp_df['started_time'] = gf.to_datetime_fast(bp_df['started_time'], errors='raise')
 bp_df['form_duration'] = (bp_df['completed_time'] - bp_df['started_time']) / np.timedelta64(1, 'm')
 bp_df['form.cur_edd'] = pd.to_datetime(bp_df['form.cur_edd'])
 bp_df['days_to_edd'] = (bp_df['form.cur_edd'] - bp_df['completed_time']) / np.timedelta64(1, 'D')
@@ -123,17 +121,15 @@ logging.info('Pct of users answering Skip over 90pct of time: %0.1f' % ((bp_fp_u
 cf_dir = os.path.join(target_dir, '[DA] Complementary Feeding - min_video')
 cf_df = gf.csv_files_to_df(cf_dir, data_regex, date_cols = ['completed_time'])
 logging.info('raw CF forms: %i' % cf_df.shape[0])
-cf_df = gf.add_locations_by_username(cf_df)
-logging.info('raw CF forms after add locations: %i' % cf_df.shape[0])
-cf_df = cf_df.loc[(cf_df['state_name'].isin(real_state_list))]
+cf_df = gf.add_locations_by_username(cf_df, state_list=real_state_list)
 num_cf_forms = cf_df.shape[0]
 logging.info('Num Comp Feeding forms in real locations: %i' % num_cf_forms)
 logging.info('%i different users submitted this form' % cf_df['awc_name'].nunique())
 logging.info('%.2f average forms per user' % cf_df['awc_name'].value_counts().mean())
 
 cf_df['form.add'] = pd.to_datetime(cf_df['form.add'])
-cf_df['completed_time'] = pd.to_datetime(cf_df['completed_time'])
-cf_df['started_time'] = pd.to_datetime(cf_df['started_time'])
+cf_df['completed_time'] = gf.to_datetime_fast(cf_df['completed_time'], errors='raise')
+cf_df['started_time'] = gf.to_datetime_fast(cf_df['started_time'], errors='raise')
 cf_df['form_duration'] = (cf_df['completed_time'] - cf_df['started_time']) / np.timedelta64(1, 'm')
 cf_df['days_age'] = (cf_df['completed_time'] - cf_df['form.add']) / np.timedelta64(1, 'D')
 
@@ -162,9 +158,7 @@ logging.info('CF forms w/ watch != Yes  Mean: %0.1f Median: %0.1f' % (cf_df[(cf_
 vid_dir = os.path.join(target_dir, '[DA] Video Library')
 vid_df = gf.csv_files_to_df(vid_dir, data_regex, vid_date_cols)
 logging.info('raw vid library forms: %i' % vid_df.shape[0])
-vid_df = gf.add_locations_by_username(vid_df)
-logging.info('raw vid libary forms after add locations: %i' % vid_df.shape[0])
-vid_df = vid_df.loc[(vid_df['state_name'].isin(real_state_list))]
+vid_df = gf.add_locations_by_username(vid_df, state_list=real_state_list)
 num_vid_forms = vid_df.shape[0]
 logging.info('Num Video Library forms in real locations: %i' % num_vid_forms)
 logging.info('%i different users submitted this form' % vid_df['awc_name'].nunique())